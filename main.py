@@ -4,7 +4,6 @@ from astrbot.api import logger, AstrBotConfig
 from astrbot.api.message_components import Node, Plain, Nodes
 
 import os
-import re
 import time
 import asyncio
 import pathlib
@@ -17,11 +16,32 @@ from .src.interpreter import HexagramInterpreter
 from .src.glyphs import HexagramRenderer
 from .src.history import HistoryManager
 from .src.limit import UsageLimit
+from .src.data_constants import HEXAGRAM_NAMES, HEXAGRAM_MAP
+from .src.router import CommandRouter, Command
+from .src.group import GroupReadingPool
+from .src.search import HistoryIndex
+from .src.export import HistoryExporter
+from .src.retention import HistoryArchive, RetentionSweeper
+from .src.textstore import TextStore
+from .src.lunar import solar_to_lunar, ganzhi, cycle_name, format_lunar
+from .src.coordinator import SharedState, LLMCache
+from .src.scheduler import RequestScheduler, SchedulerBusy
+from .src.pregen import PregenStore, Pregenerator, combinations
+from .src.capture import TrafficCapture
+from .src.followup import FollowUpCache
+from .src.similar import stored_code, describe_code
+from .src.degrade import DegradationController, DEFER_WRITES, SIMPLE_RENDER, NO_LLM, SHED
+from .src import storage
+from .src import log
 
 @register("oracle_lang", "errore, original by ydzat", "一个基于易经原理的智能算卦插件。支持多种起卦方式，提供专业的卦象解读。", "1.0.0")
 class OracleLangPlugin(Star):
     # 命令前缀
     CMD_PREFIX = "算卦"
+    # 预生成任务在工作池中使用的用户ID
+    PREGEN_USER = "__pregen__"
+    # 相似查询允许的最大汉明距离（3 爻以内需访问 299 个桶）
+    SIMILAR_MAX_DISTANCE = 3
 
     def __init__(self, context: Context, config: AstrBotConfig):
         super().__init__(context)
@@ -34,18 +54,166 @@ class OracleLangPlugin(Star):
         os.makedirs(os.path.join(self.plugin_dir, "data/history"), exist_ok=True)
         os.makedirs(os.path.join(self.plugin_dir, "data/static"), exist_ok=True)
         os.makedirs(os.path.join(self.plugin_dir, "data/limits"), exist_ok=True)
+        os.makedirs(os.path.join(self.plugin_dir, "data/index"), exist_ok=True)
 
         # 初始化各模块
         self.config = config
+        # 各模块的日志经队列交给后台线程格式化并转交 AstrBot 日志器
+        log_config = self.config.get("logging", {}) or {}
+        log.configure(
+            level=log_config.get("level", "INFO"),
+            module_levels=log.parse_module_levels(log_config.get("module_levels", [])),
+            sink=logger,
+            window=log_config.get("rate_limit_window", 60),
+            burst=log_config.get("rate_limit_burst", 5),
+            sample_every=log_config.get("debug_sample", 1)
+        )
+        storage_config = self.config.get("storage", {}) or {}
+        storage.configure(
+            fsync=storage_config.get("fsync", "always"),
+            interval=storage_config.get("fsync_interval", 1),
+            lock_timeout=storage_config.get("lock_timeout", 10)
+        )
         self.use_llm = config["llm"]["enabled"]
         logger.info(f"LLM 启用状态: {self.use_llm}")
         self.admin_list = self.config.get("admin_users", [])
-        self.calculator = HexagramCalculator()
+        self.calculator = HexagramCalculator(self.config)
         self.interpreter = HexagramInterpreter(self.config, self.plugin_dir)
         self.renderer = HexagramRenderer()
-        self.history = HistoryManager(os.path.join(self.plugin_dir, "data/history"))
+        self.search_index = HistoryIndex(os.path.join(self.plugin_dir, "data/index"))
+        # 历史记录保留策略与冷归档
+        history_config = self.config.get("history", {}) or {}
+        history_dir = os.path.join(self.plugin_dir, "data/history")
+        self.archive = HistoryArchive(os.path.join(history_dir, "archive"))
+        self.history = HistoryManager(
+            history_dir,
+            index=self.search_index,
+            max_records=history_config.get("max_records", 20),
+            archive=self.archive,
+            text_store=TextStore(os.path.join(self.plugin_dir, "data/texts")),
+            cache_size=history_config.get("cache_size", 256),
+            # 启用协调时多个进程共用历史目录，缓存需按文件校验
+            validate_cache=bool((self.config.get("coordinator", {}) or {}).get("enabled", False))
+        )
+        self.retention = RetentionSweeper(
+            self.history,
+            self.archive,
+            expire_days=history_config.get("expire_days", 0),
+            archive_after_days=history_config.get("archive_after_days", 30),
+            batch=history_config.get("sweep_batch", 50)
+        )
+        self.sweep_interval = max(1, int(history_config.get("sweep_interval", 300)))
+        self._sweep_task = None
+        self.exporter = HistoryExporter(self.history, os.path.join(self.plugin_dir, "data/exports"))
         self.limit = UsageLimit(self.config, os.path.join(self.plugin_dir, "data/limits"))
 
+        # 使用次数、历史写入与大语言模型缓存的统一入口，多进程部署时由协调进程持有
+        coordinator_config = self.config.get("coordinator", {}) or {}
+        socket_path = None
+        if coordinator_config.get("enabled", False):
+            socket_path = coordinator_config.get("socket_path") or os.path.join(self.plugin_dir, "data/coordinator.sock")
+        self.shared = SharedState(
+            self.limit,
+            self.history,
+            LLMCache((self.config.get("llm", {}) or {}).get("cache_size", 256)),
+            search_index=self.search_index,
+            socket_path=socket_path,
+            timeout=coordinator_config.get("timeout", 2),
+            retry_interval=coordinator_config.get("retry_interval", 5)
+        )
+        self.interpreter.llm_cache = self.shared
+
+        # 请求调度：廉价命令走快速通道，大语言模型解卦进入按用户公平排队的工作池
+        scheduler_config = self.config.get("scheduler", {}) or {}
+        self.scheduler = RequestScheduler(
+            workers=scheduler_config.get("workers", 4),
+            max_pending=scheduler_config.get("max_pending", 3)
+        )
+        self.interpreter.scheduler = self.scheduler
+
+        # 预生成的通用解释：无问题时直接使用，工作池繁忙或调用失败时作为后备
+        pregen_config = self.config.get("pregen", {}) or {}
+        self.pregen_max_moving = pregen_config.get("max_moving", 1)
+        self.pregen = PregenStore(os.path.join(self.plugin_dir, "data/pregen"))
+        self.interpreter.pregen = self.pregen
+        # 预生成请求与用户请求共用工作池，按用户轮转，不会挤占用户的解卦
+        self.pregenerator = Pregenerator(
+            self.pregen,
+            self._generate_pregen,
+            concurrency=min(pregen_config.get("concurrency", 2), self.scheduler.max_pending)
+        )
+        self._flush_tasks = set()
+
+        # 流量采集（可选）：匿名化的请求元数据写入 data/capture，可用 python -m src.replay 重放
+        capture_config = self.config.get("capture", {}) or {}
+        self.capture = None
+        if capture_config.get("enabled", False):
+            self.capture = TrafficCapture(
+                os.path.join(self.plugin_dir, "data/capture"),
+                max_bytes=int(capture_config.get("max_mb", 16)) * 1024 * 1024,
+                backups=capture_config.get("backups", 3),
+                salt=capture_config.get("salt", "")
+            )
+
+        # 过载降级：按事件循环延迟与存储延迟逐级延迟写入、简化渲染、停用大语言模型、拒绝非管理员请求
+        degrade_config = self.config.get("degrade", {}) or {}
+        self.degrade = None
+        self._deferred: List = []
+        self._deferred_timer = None
+        self.defer_seconds = max(0.1, float(degrade_config.get("defer_seconds", 10)))
+        self._in_flight = 0
+        if degrade_config.get("enabled", False):
+            self.degrade = DegradationController(
+                os.path.join(self.plugin_dir, "data/.probe"),
+                interval=degrade_config.get("interval", 0.5),
+                lag_ms=degrade_config.get("lag_ms", 100),
+                io_ms=degrade_config.get("io_ms", 200),
+                recover_seconds=degrade_config.get("recover_seconds", 10),
+                max_level=degrade_config.get("max_level", SHED),
+                active=lambda: self._in_flight > 0
+            )
+            self.degrade.on_change(self._on_degrade_change)
+
+        # 追问：保留每个用户最近一次起卦的上下文，追问时只发送新问题
+        followup_config = self.config.get("followup", {}) or {}
+        self.followups = None
+        if followup_config.get("enabled", True):
+            self.followups = FollowUpCache(
+                max_users=followup_config.get("max_users", 1024),
+                ttl=followup_config.get("ttl", 1800),
+                max_turns=followup_config.get("max_turns", 3)
+            )
+
+        # 群组共享起卦（可选）
+        group_config = self.config.get("group_reading", {}) or {}
+        self.group_pool = None
+        if group_config.get("enabled", False):
+            self.group_pool = GroupReadingPool(
+                window=group_config.get("window", 60),
+                flush_delay=group_config.get("flush_delay", 2)
+            )
+            self.group_pool.set_writer(self._flush_group_records)
+
+        # 命令路由与子命令处理函数
+        self.router = CommandRouter(self.CMD_PREFIX)
+        self.router.register("搜索", "search")
+        self.router.register("相似", "similar")
+        self.router.register("追问", "followup")
+        self.router.register("导出", "export", admin=True)
+        self.router.register("时间表", "time_table", exact=True)
+        self.router.register("预生成", "pregen", admin=True)
+        self._handlers = {
+            "help": self._show_help,
+            "my_id": self._show_user_id,
+            "history": self._show_history,
+            "search": self._search_history,
+            "similar": self._similar_readings,
+            "export": self._export_history,
+            "time_table": self._show_time_table,
+            "admin": self._handle_admin_commands,
+            "pregen": self._handle_pregen,
+        }
+
         logger.info("OracleLang 插件初始化完成")
 
         # 加载数据
@@ -57,93 +225,178 @@ class OracleLangPlugin(Star):
         await self.interpreter.load_data()
         logger.info("卦象数据加载完成")
 
+        # 首次启用检索，或索引由旧版本建立（文档中没有起卦编码）时，由历史记录重建索引
+        if len(self.search_index) == 0 or self.search_index.outdated:
+            await asyncio.to_thread(self.search_index.rebuild, self.history.iter_records())
+            logger.info(f"历史检索索引已建立，共 {len(self.search_index)} 条记录")
+
+        # 选出协调进程或连接到已有的协调进程
+        await self.shared.start()
+        if self.shared.mode != "local":
+            logger.info(f"多进程协调模式: {self.shared.mode}")
+
+        # 启动历史记录后台清理
+        self._sweep_task = asyncio.create_task(self._retention_loop())
+
+        if self.degrade is not None:
+            self.degrade.start()
+
+        # 校验文本起卦算法，避免同一问题在升级后得到不同卦象
+        if not self.calculator.verify_text_compatibility():
+            logger.error("文本起卦算法与兼容性向量不一致，同一问题的卦象可能已发生变化")
+
+    async def _retention_loop(self):
+        """定期执行历史记录清理，每次只处理一批文件"""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            # 多进程部署时只由协调进程清理文件
+            if self.shared.mode == "client":
+                continue
+            try:
+                # 文件读写、归档与文本存储压缩在工作线程中进行
+                await self.retention.run()
+            except Exception as e:
+                logger.error(f"历史记录清理出错: {str(e)}")
+
+    def _degraded(self, level: int) -> bool:
+        """当前是否处于指定降级级别或更高级别"""
+        return self.degrade is not None and self.degrade.level >= level
+
+    def _on_degrade_change(self, previous: int, level: int):
+        """恢复到不延迟写入的级别时立即写入积压的历史记录"""
+        if level < DEFER_WRITES:
+            self._flush_deferred()
+
+    def _defer_record(self, entry):
+        """过载时暂存历史记录，defer_seconds 秒后批量写入"""
+        self._deferred.append(entry)
+        if self._deferred_timer is None:
+            self._deferred_timer = asyncio.get_running_loop().call_later(self.defer_seconds, self._flush_deferred)
+
+    def _flush_deferred(self):
+        """写入暂存的历史记录"""
+        if self._deferred_timer is not None:
+            self._deferred_timer.cancel()
+            self._deferred_timer = None
+        batch, self._deferred = self._deferred, []
+        if batch:
+            self._flush_group_records(batch)
+
     @filter.command(CMD_PREFIX)
     async def oracle(self, event: AstrMessageEvent):
         """这是一个易经算卦命令""" # 命令描述
-        # 清理文本，移除@信息
-        msg = event.message_str
+        # 正在处理的请求数，降级控制器空闲时不探测存储延迟
+        self._in_flight += 1
+        try:
+            if self.capture is None:
+                async for result in self._dispatch(event, {}):
+                    yield result
+                return
+
+            # 流量采集：记录匿名化的请求元数据，供本地重放
+            trace: Dict[str, Any] = {}
+            arrived, started = time.time(), time.monotonic()
+            try:
+                async for result in self._dispatch(event, trace):
+                    yield result
+            finally:
+                if trace:
+                    group_id = event.get_group_id()
+                    self.capture.record(arrived, event.get_sender_id(), group_id, trace, time.monotonic() - started)
+        finally:
+            self._in_flight -= 1
+
+    async def _dispatch(self, event: AstrMessageEvent, trace: Dict[str, Any]):
+        """
+        解析并处理一条算卦命令
+
+        参数:
+            trace: 处理过程中写入命令类别、参数长度、大语言模型耗时与结果，供流量采集使用
+        """
         sender_id = event.get_sender_id()
 
-        # 清理文本，移除@信息和命令前缀
-        cleaned_text = re.sub(r'@\S+\s*', '', msg).strip()
-        if not cleaned_text.startswith(self.CMD_PREFIX):
+        # 一次性解析命令
+        command = self.router.parse(event.message_str, is_admin=self._is_admin(sender_id))
+        if command is None:
             return
+        trace.update(k=command.kind, m=command.method, p=len(command.params or ""), q=len(command.question))
 
-        # 提取命令参数
-        cmd_args = cleaned_text[len(self.CMD_PREFIX):].strip()
-
-        # 处理帮助命令
-        if cmd_args.strip() == "帮助":
-            await self._show_help(event)
+        # 最高降级级别下只处理管理员的请求
+        if self._degraded(SHED) and not self._is_admin(sender_id):
+            trace["r"] = "shed"
+            yield event.plain_result("当前请求过多，请稍后再试。")
             return
 
-        # 处理用户ID查询命令
-        if cmd_args.strip() == "我的ID":
-            yield event.plain_result(f"您的用户ID是: {sender_id}")
+        # 追问会调用大语言模型，在工作池中执行，不走快速通道
+        if command.kind == "followup":
+            async for result in self._follow_up(event, command, trace):
+                yield result
             return
 
-        # 处理管理命令（仅管理员可用）
-        if self._is_admin(sender_id) and (cmd_args.startswith("设置") or cmd_args.startswith("重置") or cmd_args.startswith("统计")):
-            await self._handle_admin_commands(event, cmd_args)
+        # 处理帮助、ID、历史、管理等子命令
+        handler = self._handlers.get(command.kind)
+        if handler is not None:
+            # 快速通道：直接执行，只统计处理耗时（不含消息发送）
+            busy, started = 0.0, time.monotonic()
+            async for result in handler(event, command):
+                busy += time.monotonic() - started
+                yield result
+                started = time.monotonic()
+            self.scheduler.record("fast", 0.0, busy + time.monotonic() - started)
             return
 
         # 检查用户当日使用次数
-        if not self.limit.check_user_limit(sender_id):
+        if not await self.shared.check_user_limit(sender_id):
+            trace["r"] = "limit"
             remaining_time = self.limit.get_reset_time()
             yield event.plain_result(f"您今日的算卦次数已达上限（{self.config['limit']['daily_max']}次/天），请等待重置。\n"
                                   f"下次重置时间: {remaining_time}")
             return
 
-        # 解析命令参数
-        method, params, question = self._parse_command(cmd_args)
-
-        # 处理历史记录查询
-        if method == "历史":
-            await self._show_history(event, sender_id)
-            return
+        method, params, question = command.method, command.params, command.question
 
         # 生成卦象
         try:
             logger.info(f"用户 {sender_id} 使用方法 {method} 算卦，参数：{params}，问题：{question}")
-            hexagram_data = await self.calculator.calculate(
-                method=method,
-                input_text=params or question,
-                user_id=sender_id
-            )
-
-            # 生成卦象图示
-            style = self.config["display"]["style"]
-            visual = self.renderer.render_hexagram(
-                hexagram_data["original"],
-                hexagram_data["changed"],
-                hexagram_data["moving"],
-                style=style
-            )
-
-            # 获取卦象解释
-            interpretation = await self.interpreter.interpret(
-                hexagram_original=hexagram_data["hexagram_original"],
-                hexagram_changed=hexagram_data["hexagram_changed"],
-                moving=hexagram_data["moving"],
-                question=question,
-                use_llm=self.use_llm,
-                context=self.context
-            )
-
-            # 构建并发送分段响应消息
-            messages = self._format_response(question, hexagram_data, interpretation, visual)
-
-            # 记录到历史
-            self.history.save_record(
-                user_id=sender_id,
-                question=question,
-                hexagram_data=hexagram_data,
-                interpretation=interpretation
-            )
-
-            # 更新用户使用次数
-            self.limit.update_usage(sender_id)
-            remaining = self.limit.get_remaining(sender_id)
+            started = time.monotonic()
+
+            group_id = event.get_group_id() if self.group_pool is not None else None
+            if group_id and method == "text" and question:
+                # 群组共享模式：同一窗口内的相同问题只计算一次
+                key = self.group_pool.make_key(group_id, self.calculator.normalize_text(question))
+                reading = await self.group_pool.get_or_compute(
+                    key, lambda: self._compute_reading(method, params, question, sender_id)
+                )
+                hexagram_data, interpretation, messages = reading["hexagram_data"], reading["interpretation"], reading["messages"]
+
+                # 历史记录与使用次数稍后批量写入
+                self.group_pool.record(sender_id, question, hexagram_data, interpretation, int(time.time()))
+                await self.shared.update_usage(sender_id, persist=False)
+            else:
+                reading = await self._compute_reading(method, params, question, sender_id)
+                hexagram_data, interpretation, messages = reading["hexagram_data"], reading["interpretation"], reading["messages"]
+
+                if self._degraded(DEFER_WRITES):
+                    # 过载时历史记录与使用次数稍后批量写入
+                    self._defer_record((sender_id, question, hexagram_data, interpretation, int(time.time())))
+                    await self.shared.update_usage(sender_id, persist=False)
+                else:
+                    # 记录到历史
+                    await self.shared.save_record(
+                        user_id=sender_id,
+                        question=question,
+                        hexagram_data=hexagram_data,
+                        interpretation=interpretation
+                    )
+
+                    # 更新用户使用次数
+                    await self.shared.update_usage(sender_id)
+
+            self.scheduler.record("reading", 0.0, time.monotonic() - started)
+            trace["llm"] = interpretation.get("llm_seconds", 0.0)
+            self._remember_followup(sender_id, question, interpretation)
+
+            remaining = await self.shared.get_remaining(sender_id)
             chain = Nodes([])
             # 发送第一部分: 卦象和动爻
             node = Node(
@@ -173,28 +426,130 @@ class OracleLangPlugin(Star):
             # 添加使用次数提示
             yield event.plain_result(f"今日剩余算卦次数: {remaining}/{self.config['limit']['daily_max']}")
 
+        except SchedulerBusy:
+            # 未计入使用次数
+            trace["r"] = "busy"
+            yield event.plain_result(f"您已有 {self.scheduler.pending(sender_id)} 个算卦请求在排队，请等待结果后再问。")
+
         except Exception as e:
+            trace["r"] = "error"
             logger.error(f"算卦过程出错: {str(e)}")
             yield event.plain_result(f"算卦过程出现错误: {str(e)}\n请稍后再试或联系管理员。")
 
-    def _parse_command(self, cmd_args: str) -> tuple:
-        """解析命令参数，返回 (起卦方法, 方法参数, 问题)"""
-        # 支持的起卦方法
-        methods = ["数字", "时间", "历史"]
+    def _remember_followup(self, user_id: str, question: str, interpretation: Dict[str, Any]):
+        """保存本次起卦的追问上下文"""
+        if self.followups is None or not self.use_llm:
+            return
+        summary, reply = self.interpreter.followup_context(question, interpretation)
+        original, changed = interpretation["original"]["name"], interpretation["changed"]["name"]
+        self.followups.put(user_id, summary, reply, original if original == changed else f"{original}变{changed}")
+
+    async def _follow_up(self, event: AstrMessageEvent, command: Command, trace: Dict[str, Any]):
+        """追问上一次算卦：复用缓存的卦象上下文，只发送新问题，不计入使用次数"""
+        sender_id = event.get_sender_id()
+        question = command.question.strip()
+
+        if self.followups is None or not self.use_llm:
+            yield event.plain_result("追问功能未启用。")
+            return
+        if not question:
+            yield event.plain_result("请在 追问 后写上想继续问的内容，例如：算卦 追问 那我应该什么时候行动？")
+            return
+
+        entry = self.followups.get(sender_id)
+        if entry is None:
+            yield event.plain_result(
+                f"没有可以追问的卦象（算卦后 {int(self.followups.ttl // 60)} 分钟内可追问），请先算卦。"
+            )
+            return
+        if self._degraded(NO_LLM):
+            trace["r"] = "shed"
+            yield event.plain_result("当前请求较多，暂时无法追问，请稍后再试。")
+            return
+        # 调用前先占用次数，同时发出的追问不会超过上限
+        if not self.followups.reserve(entry):
+            yield event.plain_result(f"这一卦已追问 {self.followups.max_turns} 次，请重新算卦。")
+            return
 
-        method = "text"  # 默认为文本起卦
-        params = None
-        question = cmd_args
+        started = time.monotonic()
+        answer = ""
+        try:
+            answer = await self.interpreter.follow_up(
+                self.context, self.followups.messages(entry), question, user_id=sender_id
+            )
+        except SchedulerBusy:
+            trace["r"] = "busy"
+            yield event.plain_result(f"您已有 {self.scheduler.pending(sender_id)} 个请求在排队，请等待结果后再问。")
+            return
+        finally:
+            # 调用失败、排队已满或被取消时退还次数
+            if not answer:
+                self.followups.cancel(entry)
+        trace["llm"] = time.monotonic() - started
+
+        if not answer:
+            trace["r"] = "error"
+            yield event.plain_result("追问失败，请稍后再试。")
+            return
 
-        # 检查是否指定了起卦方法
-        parts = cmd_args.split(maxsplit=2)
-        if parts and parts[0] in methods:
-            method = parts[0]
-            if len(parts) >= 2:
-                params = parts[1]
-                question = parts[2] if len(parts) >= 3 else ""
+        self.followups.append(entry, question, answer)
+        yield event.plain_result(
+            f"🔮 关于「{entry['label']}」的追问：\n{answer}\n\n"
+            f"（追问不计入算卦次数，这一卦还可追问 {self.followups.remaining(entry)} 次）"
+        )
+
+    async def _compute_reading(self, method: str, params: Optional[str], question: str, user_id: str) -> Dict[str, Any]:
+        """执行起卦、渲染与解释，返回卦象数据、解释与格式化后的消息"""
+        hexagram_data = await self.calculator.calculate(
+            method=method,
+            input_text=params or question,
+            user_id=user_id
+        )
+
+        # 生成卦象图示
+        style = "simple" if self._degraded(SIMPLE_RENDER) else self.config["display"]["style"]
+        visual = self.renderer.render_hexagram(
+            hexagram_data["original"],
+            hexagram_data["changed"],
+            hexagram_data["moving"],
+            style=style
+        )
+
+        # 获取卦象解释
+        interpretation = await self.interpreter.interpret(
+            hexagram_original=hexagram_data["hexagram_original"],
+            hexagram_changed=hexagram_data["hexagram_changed"],
+            moving=hexagram_data["moving"],
+            question=question,
+            use_llm=self.use_llm,
+            context=self.context,
+            user_id=user_id,
+            cached_only=self._degraded(NO_LLM)
+        )
+
+        # 构建分段响应消息
+        messages = self._format_response(question, hexagram_data, interpretation, visual)
 
-        return method, params, question
+        return {
+            "hexagram_data": hexagram_data,
+            "interpretation": interpretation,
+            "messages": messages
+        }
+
+    def _flush_group_records(self, batch: List):
+        """
+        批量写入群组共享模式或过载时暂存的历史记录与使用次数
+
+        写入会等待历史文件锁，放到后台任务中：客户端模式交给协调进程，其余模式在工作线程中写入。
+        """
+        task = asyncio.create_task(self._flush_shared(batch))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush_shared(self, batch: List):
+        """写入一批记录与使用次数"""
+        await self.shared.save_records(batch)
+        await self.shared.save_limits()
 
     def _format_response(self, question: str, hexagram_data: Dict, interpretation: Dict, visual: str) -> Dict[str, str]:
         """格式化响应消息,返回分段消息字典"""
@@ -216,9 +571,21 @@ class OracleLangPlugin(Star):
                 if line:
                     part1.append(f"  {line}")
 
+        # 占断依据：按动爻数选出的卦辞或爻辞，第一条为主（无动爻时即卦辞，不再重复）
+        if hexagram_data['moving'].count(1) > 0 and interpretation.get("governing"):
+            part1.append(f"\n⚖️ 占断: {interpretation['rule']}")
+            for text in interpretation["governing"]:
+                part1.append(f"  {text}")
+
+        # 卦象关系：上下卦与互、综、错卦
+        if interpretation.get("relations"):
+            part1.append("\n🔗 卦象关系:")
+            for line in self.interpreter.describe_relations(interpretation["relations"]):
+                part1.append(f"  {line}")
+
         # 第二部分：总体解释
         part2 = [
-            "📜 解释:",
+            "📜 解释（通用解读）:" if interpretation.get("pregenerated") else "📜 解释:",
             interpretation['overall_meaning']
         ]
 
@@ -236,9 +603,42 @@ class OracleLangPlugin(Star):
             "part3": "\n".join(part3) if part3 else None
         }
     
-    async def _show_history(self, event: AstrMessageEvent, user_id: str):
+    async def _show_user_id(self, event: AstrMessageEvent, command: Command):
+        """显示用户ID"""
+        yield event.plain_result(f"您的用户ID是: {event.get_sender_id()}")
+
+    async def _show_time_table(self, event: AstrMessageEvent, command: Command):
+        """显示今天十二时辰的时间起卦结果"""
+        now = time.localtime()
+        current = self.calculator._shichen_index(now.tm_hour)
+        if self.calculator.time_algorithm == "meihua":
+            result = ["今日时间起卦表（梅花易数）："]
+        else:
+            result = ["今日时间起卦表（各时辰起始时刻，实际结果随分秒变化）："]
+
+        try:
+            _, lunar_month, lunar_day, leap = solar_to_lunar(now.tm_year, now.tm_mon, now.tm_mday)
+            pillars = ganzhi(now.tm_year, now.tm_mon, now.tm_mday, now.tm_hour)
+            result.append("农历{}  {}年 {}月 {}日 {}时\n".format(
+                format_lunar(lunar_month, lunar_day, leap), *(cycle_name(p) for p in pillars)))
+        except ValueError:
+            result.append("")
+
+        for index, (label, original, moving) in enumerate(self.calculator.time_table()):
+            original_name = HEXAGRAM_NAMES.get(HEXAGRAM_MAP.get(original), "未知")
+            line = f"{label} {original_name}"
+            if moving:
+                changed_name = HEXAGRAM_NAMES.get(HEXAGRAM_MAP.get(original ^ moving), "未知")
+                line += f" 变 {changed_name}"
+            if index == current:
+                line += "  ← 当前"
+            result.append(line)
+
+        yield event.plain_result("\n".join(result))
+
+    async def _show_history(self, event: AstrMessageEvent, command: Command):
         """显示用户历史记录"""
-        records = self.history.get_recent_records(user_id, limit=5)
+        records = await asyncio.to_thread(self.history.get_recent_records, event.get_sender_id(), 5)
         
         if not records:
             yield event.plain_result("您还没有算卦记录。")
@@ -257,17 +657,160 @@ class OracleLangPlugin(Star):
                 
         yield event.plain_result("\n".join(result))
         
-    async def _handle_admin_commands(self, event: AstrMessageEvent, cmd: str):
+    async def _search_history(self, event: AstrMessageEvent, command: Command):
+        """检索历史记录：普通用户检索自己的记录，管理员可加 全部 检索所有用户"""
+        keywords = list(command.args[1:])
+        user_id = event.get_sender_id()
+        since = None
+
+        if keywords and keywords[0] == "全部" and self._is_admin(user_id):
+            keywords = keywords[1:]
+            user_id = None
+
+        # 末尾的 N天 表示时间范围
+        if keywords and keywords[-1].endswith("天") and keywords[-1][:-1].isdigit():
+            since = time.time() - int(keywords[-1][:-1]) * 86400
+            keywords = keywords[:-1]
+
+        if not keywords:
+            yield event.plain_result("请提供关键词，例如：算卦 搜索 投资\n也可使用卦名或吉/凶/平，例如：算卦 搜索 坎 7天")
+            return
+
+        matches = await self.shared.search(" ".join(keywords), user_id=user_id, since=since)
+        if not matches:
+            yield event.plain_result("没有找到匹配的算卦记录。")
+            return
+
+        result = [f"找到以下算卦记录（最多显示{len(matches)}条）：\n"]
+        for i, match in enumerate(matches, 1):
+            original = HEXAGRAM_NAMES.get(match["hexagram_original"], "未知")
+            changed = HEXAGRAM_NAMES.get(match["hexagram_changed"], "未知")
+            owner = f"[{match['user_id']}] " if user_id is None else ""
+            result.append(f"{i}. {owner}[{match['timestamp']}] {match['question'] or '随缘一卦'}")
+            if original == changed:
+                result.append(f"   {original}，{match['fortune']}")
+            else:
+                result.append(f"   {original}变{changed}，{match['fortune']}")
+
+        yield event.plain_result("\n".join(result))
+
+    async def _similar_readings(self, event: AstrMessageEvent, command: Command):
+        """
+        查找相似的起卦：与自己的某条记录相差不超过 N 爻的记录
+
+        管理员可加 全部 在所有用户中查找，或用 聚类 查看记录最集中的卦象
+        """
+        args = list(command.args[1:])
+        user_id = event.get_sender_id()
+        scope = user_id
+        clusters = False
+
+        if args and args[0] in ("全部", "聚类") and self._is_admin(user_id):
+            clusters = args[0] == "聚类"
+            scope = None
+            args = args[1:]
+
+        # 末尾的 N爻 表示汉明距离
+        distance = 1
+        if args and args[-1].endswith("爻") and args[-1][:-1].isdigit():
+            distance = min(self.SIMILAR_MAX_DISTANCE, int(args[-1][:-1]))
+            args = args[:-1]
+
+        if clusters:
+            dense = await self.shared.clusters(distance=distance, limit=5)
+            if not dense:
+                yield event.plain_result("还没有算卦记录。")
+                return
+            result = [f"记录最集中的卦象（相差 {distance} 爻以内）：\n"]
+            for i, (code, count, nearby) in enumerate(dense, 1):
+                result.append(f"{i}. {describe_code(code)}：{count} 次，邻近共 {nearby} 次")
+            yield event.plain_result("\n".join(result))
+            return
+
+        # 参考记录：历史中的第 N 条，默认最近一条
+        index = int(args[0]) if args and args[0].isdigit() else 1
+        record = await asyncio.to_thread(self.history.get_record_by_index, user_id, index)
+        if record is None:
+            yield event.plain_result(f"没有找到您的第 {index} 条算卦记录，可先用 算卦 历史 查看。")
+            return
+
+        code = stored_code(record)
+        if code is None:
+            yield event.plain_result("这条记录的卦象无法比较。")
+            return
+
+        try:
+            timestamp = int(time.mktime(time.strptime(record.get("timestamp", ""), "%Y-%m-%d %H:%M:%S")))
+        except ValueError:
+            timestamp = 0
+        matches = await self.shared.similar(
+            code, user_id=scope, distance=distance, limit=10,
+            skip=[str(user_id), timestamp, record.get("question", "")]
+        )
+
+        reference = f"[{record.get('timestamp', '未知时间')}] {record.get('question') or '随缘一卦'}"
+        if not matches:
+            yield event.plain_result(f"没有与 {reference}（{describe_code(code)}）相差 {distance} 爻以内的记录。")
+            return
+
+        result = [f"与 {reference}（{describe_code(code)}）相差 {distance} 爻以内的记录：\n"]
+        for i, match in enumerate(matches, 1):
+            original = HEXAGRAM_NAMES.get(match["hexagram_original"], "未知")
+            changed = HEXAGRAM_NAMES.get(match["hexagram_changed"], "未知")
+            owner = f"[{match['user_id']}] " if scope is None else ""
+            result.append(f"{i}. {owner}[{match['timestamp']}] {match['question'] or '随缘一卦'}")
+            hexagrams = original if original == changed else f"{original}变{changed}"
+            closeness = "卦象相同" if match["distance"] == 0 else f"相差 {match['distance']} 爻"
+            result.append(f"   {hexagrams}，{match['fortune']}，{closeness}")
+
+        yield event.plain_result("\n".join(result))
+
+    async def _export_history(self, event: AstrMessageEvent, command: Command):
+        """导出历史记录（管理员）：算卦 导出 [jsonl|csv] [开始日期] [结束日期] [卦序或卦名]"""
+        fmt, start, end, hexagram = "jsonl", None, None, None
+        for arg in command.args[1:]:
+            if arg in HistoryExporter.FORMATS:
+                fmt = arg
+            elif len(arg) == 10 and arg[4] == "-" and arg[7] == "-":
+                if start is None:
+                    start = arg
+                else:
+                    end = arg
+            elif arg.isdigit() and 1 <= int(arg) <= 64:
+                hexagram = int(arg)
+            elif arg in HistoryIndex.HEXAGRAM_LOOKUP:
+                hexagram = HistoryIndex.HEXAGRAM_LOOKUP[arg]
+            else:
+                yield event.plain_result("格式错误，请使用：算卦 导出 [jsonl|csv] [开始日期] [结束日期] [卦序或卦名]\n"
+                                         "例如：算卦 导出 csv 2024-01-01 2024-01-31 坎")
+                return
+
+        # 导出可能涉及大量文件，放到线程中执行
+        path, stats = await asyncio.to_thread(self.exporter.export, fmt, start, end, hexagram)
+
+        top = sorted(stats["hexagrams"].items(), key=lambda item: item[1], reverse=True)[:5]
+        result = [
+            f"导出完成，共 {stats['total']} 条记录",
+            f"文件: {path}",
+            "吉凶分布: " + ("，".join(f"{k} {v}" for k, v in stats["fortunes"].items()) or "无"),
+            "最常见的卦: " + ("，".join(f"{HEXAGRAM_NAMES.get(k, k)} {v}" for k, v in top) or "无"),
+        ]
+        if stats["active_users"]:
+            days = len(stats["active_users"])
+            average = sum(stats["active_users"].values()) / days
+            result.append(f"活跃天数: {days}，日均活跃用户: {average:.1f}")
+        yield event.plain_result("\n".join(result))
+
+    async def _handle_admin_commands(self, event: AstrMessageEvent, command: Command):
         """处理管理员命令"""
-        sender_id = event.get_sender_id()
-        parts = cmd.split()
+        parts = command.args
         
         if parts[0] == "设置" and len(parts) >= 3 and parts[1] == "次数":
             try:
                 new_limit = int(parts[2])
                 if new_limit > 0:
                     self.config["limit"]["daily_max"] = new_limit
-                    config.save_config(self.config, self.plugin_dir)
+                    self.config.save_config()
                     yield event.plain_result(f"每日算卦次数上限已设置为 {new_limit} 次")
                 else:
                     yield event.plain_result("次数必须为正整数")
@@ -276,18 +819,89 @@ class OracleLangPlugin(Star):
                 
         elif parts[0] == "重置" and len(parts) >= 2:
             target_user = parts[1]
-            self.limit.reset_user(target_user)
+            await self.shared.reset_user(target_user)
             yield event.plain_result(f"已重置用户 {target_user} 的算卦次数")
+
+        elif parts[0] == "清除" and len(parts) >= 2:
+            target_user = parts[1]
+            if self.followups is not None:
+                self.followups.discard(target_user)
+            if await self.shared.clear_history(target_user):
+                yield event.plain_result(f"已清除用户 {target_user} 的全部算卦记录")
+            else:
+                yield event.plain_result(f"用户 {target_user} 没有算卦记录")
             
         elif parts[0] == "统计":
-            stats = self.limit.get_usage_statistics()
+            stats = await self.shared.get_usage_statistics()
             total_users = stats.get("total_users", 0)
             total_usage = stats.get("total_usage", 0)
-            yield event.plain_result(f"算卦统计:\n总用户数: {total_users}\n总使用次数: {total_usage}")
+            lines = [f"算卦统计:\n总用户数: {total_users}\n总使用次数: {total_usage}", "\n请求延迟:"]
+            lines.extend(self.scheduler.report())
+            cache = self.history.cache_info()
+            lines.append(
+                f"\n历史缓存: 命中率 {cache['hit_rate'] * 100:.1f}%（命中 {cache['hits']}，"
+                f"读取文件 {cache['misses']}，无记录 {cache['absent']}），"
+                f"缓存 {cache['cached']}/{cache['capacity']} 个用户"
+            )
+            if self.degrade is not None:
+                lines.append("")
+                lines.extend(self.degrade.report())
+            if self.followups is not None:
+                stats = self.followups.stats
+                lines.append(
+                    f"追问上下文: {len(self.followups)} 个用户，命中 {stats['hits']}，"
+                    f"无上下文 {stats['misses']}，已过期 {stats['expired']}"
+                )
+            log_stats = log.stats()
+            lines.append(f"日志: 限流抑制 {log_stats['suppressed']} 条，采样略过 {log_stats['sampled_out']} 条")
+            yield event.plain_result("\n".join(lines))
         
         else:
-            yield event.plain_result("无效的管理命令，支持的命令：\n算卦 设置 次数 [数字]\n算卦 重置 [用户ID]\n算卦 统计")
+            yield event.plain_result("无效的管理命令，支持的命令：\n算卦 设置 次数 [数字]\n算卦 重置 [用户ID]\n"
+                                     "算卦 清除 [用户ID]\n算卦 统计")
     
+    async def _generate_pregen(self, number: int, mask: int) -> Dict[str, str]:
+        """为预生成任务生成单个组合的通用解释"""
+        return await self.scheduler.run(
+            self.PREGEN_USER,
+            lambda: self.interpreter.generate_generic(number, mask, self.context),
+            name="pregen"
+        )
+
+    async def _handle_pregen(self, event: AstrMessageEvent, command: Command):
+        """管理员命令：预生成通用解释，可随时停止，再次开始时跳过已完成的组合"""
+        action = command.params or "状态"
+
+        if action == "开始":
+            if not self.use_llm:
+                yield event.plain_result("未启用大语言模型，无法预生成解释")
+                return
+            max_moving = self.pregen_max_moving
+            if len(command.args) >= 3:
+                try:
+                    max_moving = min(6, max(0, int(command.args[2])))
+                except ValueError:
+                    yield event.plain_result("格式错误，请使用：算卦 预生成 开始 [最多动爻数]")
+                    return
+            if not self.pregenerator.start(combinations(max_moving)):
+                yield event.plain_result("预生成任务已在运行")
+                return
+            status = self.pregenerator.status()
+            yield event.plain_result(f"预生成任务已开始：最多 {max_moving} 个动爻，"
+                                     f"待生成 {status['total']} 个组合（已有 {status['stored']} 个）")
+
+        elif action == "停止":
+            await self.pregenerator.stop()
+            yield event.plain_result(f"预生成任务已停止，已保存 {len(self.pregen)} 个组合，再次开始时从中断处继续")
+
+        else:
+            status = self.pregenerator.status()
+            state = "运行中" if status["running"] else "未运行"
+            yield event.plain_result(
+                f"预生成任务{state}\n本次进度: {status['done']}/{status['total']}，失败 {status['failed']}，"
+                f"用时 {status['elapsed']:.0f} 秒\n已保存组合: {status['stored']}"
+            )
+
     def _is_admin(self, user_id: str) -> bool:
         """检查用户是否是管理员"""
         # 这里可以根据配置文件或其他方式判断用户是否是管理员
@@ -295,7 +909,7 @@ class OracleLangPlugin(Star):
         admin_list = self.config.get("admin_users", [])
         return user_id in admin_list
 
-    def _show_help(self, event: AstrMessageEvent):
+    async def _show_help(self, event: AstrMessageEvent, command: Command):
         """显示帮助信息"""
         help_text = [
             "📚 OracleLang 算卦插件使用指南 📚",
@@ -311,13 +925,26 @@ class OracleLangPlugin(Star):
             "",
             "算卦 时间 [时间] [问题]  - 使用当前时间起卦",
             "例如：算卦 时间 明天 财运",
+            "算卦 时间表  - 查看今天十二时辰的时间起卦结果",
             "",
+            "算卦 追问 [问题]  - 针对上一卦继续提问，不计入次数",
+            "例如：算卦 追问 那我应该什么时候行动？",
             "算卦 历史  - 查看您的最近算卦记录",
+            "算卦 搜索 [关键词]  - 检索您的算卦记录，可用问题文字、卦名或吉/凶/平",
+            "例如：算卦 搜索 投资",
+            "算卦 相似 [第N条] [N爻]  - 查找与您某条记录相差不超过N爻的记录，默认最近一条、1爻",
+            "例如：算卦 相似 2 2爻",
             "算卦 我的ID  - 查询您的用户ID",
             "\n管理员命令：",
             "算卦 设置 次数 [数字]  - 设置每日算卦次数限制",
             "算卦 重置 [用户ID]  - 重置特定用户的算卦次数",
-            "算卦 统计  - 查看使用统计信息",
+            "算卦 清除 [用户ID]  - 删除特定用户的全部算卦记录（含归档）",
+            "算卦 统计  - 查看使用统计与各类请求的排队延迟",
+            "算卦 搜索 全部 [关键词] [N天]  - 检索所有用户的算卦记录",
+            "算卦 相似 全部 [第N条] [N爻]  - 在所有用户中查找相似的记录",
+            "算卦 相似 聚类 [N爻]  - 查看记录最集中的卦象",
+            "算卦 导出 [jsonl|csv] [开始日期] [结束日期] [卦]  - 导出历史记录并统计",
+            "算卦 预生成 [开始|状态|停止] [最多动爻数]  - 后台预生成各卦的通用解读",
             "\n默认每人每日可算卦 {} 次".format(self.config['limit']['daily_max'])
         ]
         
@@ -326,6 +953,23 @@ class OracleLangPlugin(Star):
     async def terminate(self):
         """插件卸载时触发"""
         try:
+            # 写入尚未落盘的群组记录
+            if self.group_pool is not None:
+                self.group_pool.flush()
+            if self.degrade is not None:
+                await self.degrade.stop()
+            self._flush_deferred()
+            if self._flush_tasks:
+                await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+            if self._sweep_task is not None:
+                self._sweep_task.cancel()
+            await self.pregenerator.stop()
+            self.pregen.close()
+            if self.capture is not None:
+                self.capture.close()
+            await self.shared.close()
+            storage.sync()
+            log.shutdown()
             logger.info("OracleLang 插件已卸载")
         except:
             # 避免在卸载过程中出现属性错误
@@ -1,10 +1,19 @@
+import re
 import random
+import secrets
 import hashlib
 import time
-from typing import Dict, List, Any, Optional
+from array import array
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Any, Optional, Tuple
 import asyncio
 
-from .data_constants import HEXAGRAM_MAP
+from .data_constants import HEXAGRAM_MAP, COIN_LINE_TABLE, YARROW_LINE_TABLE, EARTHLY_BRANCHES, XIANTIAN_TRIGRAMS
+from .lunar import solar_to_lunar
+from .log import get_logger
+
+logger = get_logger("calculator")
 
 class HexagramCalculator:
     """
@@ -13,6 +22,126 @@ class HexagramCalculator:
     
     # 从常量模块导入映射表
     HEXAGRAM_MAP = HEXAGRAM_MAP
+
+    # 随机起卦模式：(每爻随机位数, 取位查找表)
+    RANDOM_MODES = {
+        "coin": (3, COIN_LINE_TABLE),
+        "yarrow": (4, YARROW_LINE_TABLE),
+    }
+
+    # 文本起卦可选的哈希算法，摘要长度至少 3 字节
+    HASH_FUNCTIONS = {
+        "sha256": hashlib.sha256,
+        "blake2b": lambda data: hashlib.blake2b(data, digest_size=32),
+        "blake2s": hashlib.blake2s,
+    }
+
+    # 文本归一化规则
+    NORMALIZERS = {
+        "mentions": (re.compile(r'@\S+\s*'), ""),
+        "punctuation": (re.compile(r'[^\w\s]+'), ""),
+        "whitespace": (re.compile(r'\s+'), " "),
+    }
+
+    # 字节 -> 两个十六进制字符的取位结果（高半字节在前，与 hexdigest 字符顺序一致）
+    # 原卦：取每个十六进制字符的最低位
+    _ORIGINAL_BITS = tuple(((b >> 4) & 1) | ((b & 1) << 1) for b in range(256))
+    # 动爻：从末尾倒序取字符，字符值小于 5 为动爻，因此低半字节在前
+    _MOVING_BITS = tuple(int((b & 0x0F) < 5) | (int((b >> 4) < 5) << 1) for b in range(256))
+
+    # 时间起卦算法：simple 为公历奇偶法，meihua 为梅花易数年月日时起卦
+    TIME_ALGORITHMS = ("simple", "meihua")
+
+    # 设置种子时最多保留随机源的用户数，超出时淘汰最久未使用的
+    SEEDED_USERS = 1024
+
+    # 六位掩码 -> 爻列表（下爻在前）
+    _MASK_LINES = tuple(tuple((mask >> i) & 1 for i in range(6)) for mask in range(64))
+
+    # 文本起卦兼容性向量：(文本, 原卦掩码, 动爻掩码, 原卦卦序, 变卦卦序)，由 SHA256 + 不做归一化计算
+    # 修改文本起卦算法或 HEXAGRAM_MAP 时必须保证这些结果不变，否则老用户的同一问题会得到不同卦象
+    TEXT_GOLDEN_VECTORS = (
+        ("我今天的工作运势如何？", 0b100101, 0b001000, 22, 30),
+        ("近期是否适合投资股票？", 0b101110, 0b011010, 50, 53),
+        ("a", 0b101100, 0b001000, 56, 52),
+        ("OracleLang", 0b100111, 0b100000, 26, 11),
+        ("明天 财运", 0b111111, 0b101010, 1, 63),
+        ("🌙 月亮", 0b001100, 0b101101, 62, 27),
+        ("x" * 1000, 0b110100, 0b000000, 53, 53),
+    )
+
+    def __init__(self, config: Optional[Dict] = None, rng: Optional[random.Random] = None):
+        """
+        参数:
+            config: 插件配置，读取其中的 calculator 配置段
+            rng: 自定义随机源（需提供 getrandbits），优先于配置
+        """
+        calc_config = (config or {}).get("calculator", {}) or {}
+
+        self.random_mode = calc_config.get("random_mode", "coin")
+        if self.random_mode not in self.RANDOM_MODES:
+            self.random_mode = "coin"
+
+        # 随机源：默认使用 random 模块，可切换为 secrets 提供的系统随机源
+        if rng is not None:
+            self.rng = rng
+        elif calc_config.get("random_source") == "secrets":
+            self.rng = secrets.SystemRandom()
+        else:
+            self.rng = random.Random()
+
+        # 设置种子后每个用户拥有独立且可复现的随机序列
+        self.seed = None
+        self._user_rngs: "OrderedDict[str, random.Random]" = OrderedDict()
+        seed = calc_config.get("seed", "")
+        if seed not in (None, ""):
+            self.set_seed(seed)
+
+        # 文本起卦：哈希算法、归一化规则与缓存
+        self.text_hash = calc_config.get("text_hash", "sha256")
+        if self.text_hash not in self.HASH_FUNCTIONS:
+            self.text_hash = "sha256"
+        self.text_normalize = [
+            rule for rule in calc_config.get("text_normalize", []) or [] if rule in self.NORMALIZERS
+        ]
+        self.text_cache_size = max(0, int(calc_config.get("text_cache_size", 1024)))
+        self._text_cache: "OrderedDict[str, Tuple[int, int]]" = OrderedDict()
+
+        # 时间起卦：当天的卦象时间表在跨日时重建，每项为 原卦掩码 | (动爻掩码 << 6)
+        self.time_algorithm = calc_config.get("time_algorithm", "simple")
+        if self.time_algorithm not in self.TIME_ALGORITHMS:
+            self.time_algorithm = "simple"
+        self._schedule_day: Optional[Tuple[int, int, int]] = None
+        self._schedule = array("H")
+        # 当前整点的时间戳与小时，整点内的分秒由时间戳差值直接得出，免去每次 localtime
+        self._hour_start = 0.0
+        self._hour = 0
+        self._hour_day = (0, 0, 0)
+
+    def set_seed(self, seed: Optional[Any]):
+        """设置随机种子，None 表示取消种子恢复默认随机源"""
+        self.seed = None if seed is None else str(seed)
+        self._user_rngs.clear()
+
+    def _get_rng(self, user_id: Optional[str] = None):
+        """
+        获取用户对应的随机源
+
+        随机源按最近使用保留 SEEDED_USERS 个，被淘汰的用户下次从种子重新开始序列。
+        """
+        if self.seed is None:
+            return self.rng
+
+        key = str(user_id)
+        rng = self._user_rngs.get(key)
+        if rng is None:
+            rng = random.Random(f"{self.seed}:{key}")
+            self._user_rngs[key] = rng
+            if len(self._user_rngs) > self.SEEDED_USERS:
+                self._user_rngs.popitem(last=False)
+        else:
+            self._user_rngs.move_to_end(key)
+        return rng
     
     async def calculate(self, method: str, input_text: str, user_id: str) -> Dict[str, Any]:
         """
@@ -33,9 +162,9 @@ class HexagramCalculator:
                 
             # 根据方法调用对应的计算函数
             if method == "random" or not input_text:
-                result = await self._random_hexagram()
+                result = await self._random_hexagram(user_id)
             elif method == "数字":
-                result = await self._number_hexagram(input_text)
+                result = await self._number_hexagram(input_text, user_id)
             elif method == "时间":
                 result = await self._time_hexagram()
             else:  # 文本起卦
@@ -59,9 +188,10 @@ class HexagramCalculator:
             hexagram_original = self._get_hexagram_number(original)
             hexagram_changed = self._get_hexagram_number(changed) if sum(moving) > 0 else hexagram_original
             
-            # 调试输出
-            print(f"计算卦象 - 原卦: {original}, 动爻: {moving}, 变卦: {changed}")
-            print(f"卦序 - 原卦: {hexagram_original}, 变卦: {hexagram_changed}")
+            logger.debug("计算卦象", extra={
+                "original": original, "moving": moving, "changed": changed,
+                "number": hexagram_original, "changed_number": hexagram_changed
+            })
             
             return {
                 "original": original,
@@ -71,9 +201,9 @@ class HexagramCalculator:
                 "hexagram_changed": hexagram_changed
             }
         except Exception as e:
-            print(f"计算卦象时出错: {str(e)}")
+            logger.error("计算卦象时出错: %s", e)
             # 发生错误时返回一个随机卦象
-            result = await self._random_hexagram()
+            result = await self._random_hexagram(user_id)
             original = result["original"]
             moving = result["moving"]
             changed = self._calculate_changed_hexagram(original, moving)
@@ -87,7 +217,7 @@ class HexagramCalculator:
                 "error": str(e)  # 添加错误信息
             }
         
-    async def _random_hexagram(self) -> Dict[str, List[int]]:
+    async def _random_hexagram(self, user_id: Optional[str] = None) -> Dict[str, List[int]]:
         """
         随机起卦法：模拟传统的掷币方式
         
@@ -96,27 +226,21 @@ class HexagramCalculator:
         - 二阳一阴 (阳爻少爻) [1,1,0] -> 7 -> 不动爻，记为1
         - 二阴一阳 (阴爻少爻) [0,0,1] -> 8 -> 不动爻，记为0
         - 三阴爻 (阴爻老爻) [0,0,0] -> 6 -> 动爻，记为0
+
+        六爻所需的随机位通过一次 getrandbits 取得，每组随机位查表得到阴阳与动静。
+        蓍草模式下每爻取 4 位，按 6/7/8/9 = 1:5:7:3 的概率查表。
         """
+        width, table = self.RANDOM_MODES[self.random_mode]
+        bits = self._get_rng(user_id).getrandbits(width * 6)
+        mask = (1 << width) - 1
+
         original = []
         moving = []
-        
         for _ in range(6):
-            # 模拟掷三次硬币
-            coins = [random.randint(0, 1) for _ in range(3)]
-            coin_sum = sum(coins)
-            
-            if coin_sum == 3:  # 三阳爻，动爻，记为1
-                original.append(1)
-                moving.append(1)
-            elif coin_sum == 2:  # 二阳一阴，不动爻，记为1
-                original.append(1)
-                moving.append(0)
-            elif coin_sum == 1:  # 二阴一阳，不动爻，记为0
-                original.append(0)
-                moving.append(0)
-            else:  # 三阴爻，动爻，记为0
-                original.append(0)
-                moving.append(1)
+            state = table[bits & mask]
+            bits >>= width
+            original.append(state & 1)
+            moving.append(state >> 1)
                 
         return {
             "original": original,
@@ -128,37 +252,57 @@ class HexagramCalculator:
         文本起卦法：根据文本内容生成唯一的卦象
         
         实现方法:
-        1. 计算文本的哈希值
-        2. 将哈希值转换为6位二进制数作为卦象
-        3. 根据哈希值的某些位确定动爻
+        1. 按配置归一化文本，命中缓存则直接返回
+        2. 计算文本的哈希值（默认 SHA256）
+        3. 摘要前 3 个字节（即前 6 个十六进制字符）的最低位确定原卦
+        4. 摘要后 3 个字节倒序取字符，值小于 5 为动爻
         """
         if not text:
             return await self._random_hexagram()
-            
-        # 计算文本的SHA256哈希值
-        h = hashlib.sha256(text.encode('utf-8')).hexdigest()
-        
-        # 使用哈希值的前6个字符确定原卦
-        original = []
-        for i in range(6):
-            # 取哈希值的第i个字符的二进制最低位
-            char_val = int(h[i], 16)
-            original.append(char_val & 1)  # 取最低位的值(0或1)
-            
-        # 使用哈希值的后6个字符确定动爻
-        moving = []
-        for i in range(6):
-            # 取哈希的后部分，确定动爻
-            char_val = int(h[-(i+1)], 16)
-            # 概率约1/3的爻为动爻
-            moving.append(1 if char_val < 5 else 0)
-            
+
+        key = self.normalize_text(text)
+        masks = self._text_cache.get(key)
+        if masks is None:
+            masks = self._hash_text(key, self.text_hash)
+            if self.text_cache_size:
+                self._text_cache[key] = masks
+                if len(self._text_cache) > self.text_cache_size:
+                    self._text_cache.popitem(last=False)
+        else:
+            self._text_cache.move_to_end(key)
+
+        original_mask, moving_mask = masks
         return {
-            "original": original,
-            "moving": moving
+            "original": list(self._MASK_LINES[original_mask]),
+            "moving": list(self._MASK_LINES[moving_mask])
         }
+
+    def normalize_text(self, text: str) -> str:
+        """按配置的规则归一化文本，使仅有细微差别的输入得到相同卦象"""
+        for rule in self.text_normalize:
+            pattern, replacement = self.NORMALIZERS[rule]
+            text = pattern.sub(replacement, text)
+        return text.strip() if self.text_normalize else text
+
+    def _hash_text(self, text: str, algorithm: str) -> Tuple[int, int]:
+        """计算文本对应的 (原卦掩码, 动爻掩码)，直接从摘要字节取位"""
+        d = self.HASH_FUNCTIONS[algorithm](text.encode('utf-8')).digest()
+        original = self._ORIGINAL_BITS[d[0]] | (self._ORIGINAL_BITS[d[1]] << 2) | (self._ORIGINAL_BITS[d[2]] << 4)
+        moving = self._MOVING_BITS[d[-1]] | (self._MOVING_BITS[d[-2]] << 2) | (self._MOVING_BITS[d[-3]] << 4)
+        return original, moving
+
+    def verify_text_compatibility(self) -> bool:
+        """校验文本起卦算法与卦序映射与兼容性向量一致"""
+        if sorted(self.HEXAGRAM_MAP.values()) != list(range(1, 65)):
+            return False
+        for text, original, moving, original_number, changed_number in self.TEXT_GOLDEN_VECTORS:
+            if self._hash_text(text, "sha256") != (original, moving):
+                return False
+            if (self.HEXAGRAM_MAP[original], self.HEXAGRAM_MAP[original ^ moving]) != (original_number, changed_number):
+                return False
+        return True
         
-    async def _number_hexagram(self, number_str: str) -> Dict[str, List[int]]:
+    async def _number_hexagram(self, number_str: str, user_id: Optional[str] = None) -> Dict[str, List[int]]:
         """
         数字起卦法：根据用户输入的数字序列生成卦象
         
@@ -184,7 +328,7 @@ class HexagramCalculator:
                     moving.append(1 if digit in [6, 9] else 0)  # 6和9为动爻
                 else:
                     # 不足6位则剩余位使用随机值
-                    digit = random.randint(0, 1)
+                    digit = self._get_rng(user_id).getrandbits(1)
                     original.append(digit)
                     moving.append(0)  # 默认不是动爻
                     
@@ -197,39 +341,117 @@ class HexagramCalculator:
             # 转换失败，使用文本起卦
             return await self._text_hexagram(number_str)
             
-    async def _time_hexagram(self) -> Dict[str, List[int]]:
+    async def _time_hexagram(self, now: Optional[datetime] = None) -> Dict[str, List[int]]:
         """
         时间起卦法：根据当前时间生成卦象
+
+        当天所有时间点的结果在跨日时一次算好，每次起卦只需查表。
         """
-        current_time = time.localtime()
-        year, month, day = current_time.tm_year, current_time.tm_mon, current_time.tm_mday
-        hour, minute, second = current_time.tm_hour, current_time.tm_min, current_time.tm_sec
-        
-        # 生成原卦
-        original = [
-            month % 2,  # 月份奇偶
-            day % 2,    # 日期奇偶
-            (day // 10) % 2,  # 日期十位奇偶
-            hour % 2,   # 小时奇偶
-            minute % 2, # 分钟奇偶
-            second % 2  # 秒数奇偶
-        ]
-        
-        # 生成动爻
-        moving = [
-            1 if month in [1, 6, 8] else 0,  # 选定几个月份作为动爻
-            1 if day in [1, 6, 9, 15, 18, 24, 27, 30] else 0,  # 选定日期
-            1 if hour in [0, 6, 12, 18] else 0,  # 选定时辰
-            1 if minute < 10 else 0,  # 开始10分钟作为动爻
-            0,  # 静爻
-            0   # 静爻
-        ]
-        
+        if now is None:
+            elapsed = int(time.time() - self._hour_start)
+            if not 0 <= elapsed < 3600:
+                # 进入新的整点（含跨日与夏令时切换）时重新取本地时间
+                t = time.localtime()
+                self._hour_start = time.mktime(t) - t.tm_min * 60 - t.tm_sec
+                self._hour = t.tm_hour
+                self._hour_day = (t.tm_year, t.tm_mon, t.tm_mday)
+                elapsed = t.tm_min * 60 + t.tm_sec
+            hour, minute, second = self._hour, elapsed // 60, elapsed % 60
+            schedule = self._get_schedule(*self._hour_day)
+        else:
+            hour, minute, second = now.hour, now.minute, now.second
+            schedule = self._get_schedule(now.year, now.month, now.day)
+
+        if self.time_algorithm == "meihua":
+            code = schedule[self._shichen_index(hour)]
+        else:
+            # 上爻取秒数奇偶，其余各位按分钟预先算好
+            code = schedule[hour * 60 + minute] | ((second & 1) << 5)
+
         return {
-            "original": original,
-            "moving": moving
+            "original": list(self._MASK_LINES[code & 0x3F]),
+            "moving": list(self._MASK_LINES[code >> 6])
         }
-        
+
+    def time_table(self, day: Optional[datetime] = None) -> List[Tuple[str, int, int]]:
+        """
+        当天十二时辰的时间起卦结果
+
+        返回:
+            [(时辰, 原卦掩码, 动爻掩码), ...]，按子时到亥时排列。
+            simple 算法下取每个时辰起始分钟、偶数秒的结果。
+        """
+        day = day or datetime.now()
+        schedule = self._get_schedule(day.year, day.month, day.day)
+        table = []
+        for index, branch in enumerate(EARTHLY_BRANCHES):
+            if self.time_algorithm == "meihua":
+                code = schedule[index]
+            else:
+                code = schedule[((index * 2 - 1) % 24) * 60]
+            table.append((f"{branch}时", code & 0x3F, code >> 6))
+        return table
+
+    def _get_schedule(self, year: int, month: int, day: int) -> array:
+        """取当天的时间表，跨日或首次调用时重建"""
+        key = (year, month, day)
+        if key != self._schedule_day:
+            if self.time_algorithm == "meihua":
+                self._schedule = self._build_meihua_schedule(year, month, day)
+            else:
+                self._schedule = self._build_simple_schedule(month, day)
+            self._schedule_day = key
+        return self._schedule
+
+    @staticmethod
+    def _shichen_index(hour: int) -> int:
+        """小时 -> 时辰下标（子时为 0），23 点计入当日子时"""
+        return ((hour + 1) // 2) % 12
+
+    @staticmethod
+    def _build_simple_schedule(month: int, day: int) -> array:
+        """
+        公历奇偶法的当日时间表，每分钟一项（共 1440 项）
+
+        原卦由下至上取：月份、日期、日期十位、小时、分钟、秒数的奇偶，
+        其中秒数一位在查表时补上；动爻取特定的月份、日期、时辰与每小时前10分钟。
+        """
+        base = (month % 2) | ((day % 2) << 1) | (((day // 10) % 2) << 2)
+        moving_base = (int(month in (1, 6, 8))
+                       | (int(day in (1, 6, 9, 15, 18, 24, 27, 30)) << 1))
+
+        schedule = array("H", bytes(2 * 1440))
+        for hour in range(24):
+            hour_moving = moving_base | (int(hour in (0, 6, 12, 18)) << 2)
+            for minute in range(60):
+                original = base | ((hour % 2) << 3) | ((minute % 2) << 4)
+                moving = hour_moving | (int(minute < 10) << 3)
+                schedule[hour * 60 + minute] = original | (moving << 6)
+        return schedule
+
+    @staticmethod
+    def _build_meihua_schedule(year: int, month: int, day: int) -> array:
+        """
+        梅花易数年月日时起卦的当日时间表，每个时辰一项（共 12 项）
+
+        以农历计数：年取年支数（子一至亥十二），月、日取农历月日，时取时支数。
+        - (年 + 月 + 日) 除 8 取余为上卦先天数，余 0 作 8
+        - (年 + 月 + 日 + 时) 除 8 取余为下卦先天数
+        - (年 + 月 + 日 + 时) 除 6 取余为动爻，自下而上数，余 0 作 6
+        闰月按本月计；23 点之后仍按当日计子时。
+        """
+        lunar_year, lunar_month, lunar_day, _ = solar_to_lunar(year, month, day)
+        base = (lunar_year - 4) % 12 + 1 + lunar_month + lunar_day
+        upper = XIANTIAN_TRIGRAMS[base % 8 or 8]
+
+        schedule = array("H", bytes(2 * 12))
+        for index in range(12):
+            total = base + index + 1
+            lower = XIANTIAN_TRIGRAMS[total % 8 or 8]
+            moving_line = (total % 6 or 6) - 1
+            schedule[index] = lower | (upper << 3) | ((1 << moving_line) << 6)
+        return schedule
+
     def _calculate_changed_hexagram(self, original: List[int], moving: List[int]) -> List[int]:
         """计算变卦，动爻所在的爻位会变化（阴变阳，阳变阴）"""
         changed = original.copy()
@@ -259,5 +481,5 @@ class HexagramCalculator:
             return self.HEXAGRAM_MAP[binary]
         else:
             # 如果找不到映射（理论上不应该发生），则使用简单处理
-            print(f"警告：找不到卦序映射，二进制值: {bin(binary)}")
+            logger.warning("找不到卦序映射，二进制值: %s", bin(binary))
             return binary + 1
@@ -0,0 +1,152 @@
+import os
+import json
+import hashlib
+import secrets
+from typing import Any, Dict, Iterator, List, Optional
+
+from .log import get_logger
+
+logger = get_logger("capture")
+
+class TrafficCapture:
+    """
+    请求流量采集（可选），用于在本地重放线上负载
+
+    每个请求记录为 JSONL 中的一行，只保存匿名化的元数据，不保存问题原文：
+        t    到达时间（Unix 时间戳，毫秒精度）
+        u    发送者ID的加盐哈希
+        g    群ID的加盐哈希，私聊为空
+        k    命令类别（divine、history、admin 等）
+        m    起卦方法或子命令关键字
+        p    参数长度（如数字起卦的数字位数）
+        q    问题长度
+        llm  大语言模型调用耗时（毫秒），未调用为 0
+        d    处理总耗时（毫秒）
+        r    结果：ok、limit（次数用完）、busy（排队已满）、shed（过载拒绝）、error
+
+    文件超过 max_bytes 后轮转为 capture.1.jsonl、capture.2.jsonl ……，最多保留 backups 个。
+    """
+
+    FILE_NAME = "capture.jsonl"
+
+    # 每写入多少条记录刷新一次缓冲
+    FLUSH_EVERY = 64
+
+    def __init__(self, capture_dir: str, max_bytes: int = 16 * 1024 * 1024, backups: int = 3,
+                 salt: str = ""):
+        """
+        参数:
+            capture_dir: 采集文件目录
+            max_bytes: 单个文件的最大字节数
+            backups: 轮转保留的旧文件数
+            salt: 哈希用户ID时的盐，留空则每次启动随机生成（同一次运行内保持一致）
+        """
+        self.capture_dir = capture_dir
+        os.makedirs(self.capture_dir, exist_ok=True)
+        self.path = os.path.join(self.capture_dir, self.FILE_NAME)
+        self.max_bytes = max(1024, int(max_bytes))
+        self.backups = max(0, int(backups))
+        self._salt = (salt or secrets.token_hex(8)).encode("utf-8")
+        self._file = None
+        self._size = 0
+        self._unflushed = 0
+        self.records = 0
+
+    def anonymize(self, value: Optional[str]) -> str:
+        """加盐哈希，空值返回空字符串"""
+        if not value:
+            return ""
+        return hashlib.blake2b(str(value).encode("utf-8"), digest_size=6, key=self._salt[:64]).hexdigest()
+
+    def record(self, arrived: float, sender_id: str, group_id: Optional[str], trace: Dict[str, Any],
+               duration: float):
+        """
+        记录一个请求
+
+        参数:
+            arrived: 到达时间（Unix 时间戳）
+            sender_id: 发送者ID，写入前哈希
+            group_id: 群ID，写入前哈希
+            trace: 处理过程中收集的 k/m/p/q/llm/r 字段
+            duration: 处理总耗时（秒）
+        """
+        entry = {
+            "t": round(arrived, 3),
+            "u": self.anonymize(sender_id),
+            "g": self.anonymize(group_id),
+            "k": trace.get("k", ""),
+            "m": trace.get("m", ""),
+            "p": trace.get("p", 0),
+            "q": trace.get("q", 0),
+            "llm": round(trace.get("llm", 0.0) * 1000, 1),
+            "d": round(duration * 1000, 1),
+            "r": trace.get("r", "ok"),
+        }
+        line = (json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        try:
+            if self._file is None:
+                self._open()
+            elif self._size + len(line) > self.max_bytes:
+                self._rotate()
+            self._file.write(line)
+            self._size += len(line)
+            self.records += 1
+            self._unflushed += 1
+            if self._unflushed >= self.FLUSH_EVERY:
+                self.flush()
+        except Exception as e:
+            logger.error("写入流量采集失败: %s", e)
+
+    def flush(self):
+        """将缓冲的记录写入文件"""
+        if self._file is not None:
+            self._file.flush()
+        self._unflushed = 0
+
+    def close(self):
+        """关闭采集文件"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _open(self):
+        self._file = open(self.path, "ab")
+        self._size = self._file.tell()
+
+    def _rotate(self):
+        """轮转文件：capture.jsonl -> capture.1.jsonl -> capture.2.jsonl ……"""
+        self.close()
+        if self.backups:
+            for i in range(self.backups - 1, 0, -1):
+                src = self._backup_path(i)
+                if os.path.exists(src):
+                    os.replace(src, self._backup_path(i + 1))
+            os.replace(self.path, self._backup_path(1))
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _backup_path(self, index: int) -> str:
+        return os.path.join(self.capture_dir, f"capture.{index}.jsonl")
+
+def iter_capture(paths: List[str]) -> Iterator[Dict[str, Any]]:
+    """按给定顺序读取采集文件，跳过无法解析的行"""
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+def capture_files(capture_dir: str) -> List[str]:
+    """目录中的采集文件，按时间从旧到新排列"""
+    names = [name for name in os.listdir(capture_dir)
+             if name.startswith("capture.") and name.endswith(".jsonl")]
+
+    def age(name: str) -> int:
+        # capture.jsonl 最新，编号越大越旧
+        middle = name[len("capture."):-len(".jsonl")]
+        return int(middle) if middle.isdigit() else 0
+
+    return [os.path.join(capture_dir, name) for name in sorted(names, key=age, reverse=True)]
@@ -0,0 +1,528 @@
+import os
+import json
+import time
+import fcntl
+import struct
+import asyncio
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional, Tuple, Callable
+
+from .record import CompactRecord
+from .storage import FileLock
+from .log import get_logger
+
+logger = get_logger("coordinator")
+
+class LLMCache:
+    """
+    大语言模型解释的 LRU 缓存
+
+    键由原卦、变卦、动爻掩码与问题组成，同一问题得到同一卦象时直接复用解释。
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max(0, int(max_entries))
+        self._entries: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
+
+    @staticmethod
+    def make_key(original: int, changed: int, moving: List[int], question: str) -> str:
+        """生成缓存键"""
+        mask = 0
+        for i, bit in enumerate(moving):
+            mask |= (bit & 1) << i
+        return f"{original}:{changed}:{mask}:{question}"
+
+    def get(self, key: str) -> Optional[Dict[str, str]]:
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: Dict[str, str]):
+        if not self.max_entries:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+async def _run_directly(operation: Callable[[], Any], save: bool = True) -> Any:
+    """协调进程正常运行时直接执行使用次数操作"""
+    return operation()
+
+# 帧头：操作码、状态（响应）或标志（请求）、请求ID、负载长度
+HEADER = struct.Struct("!BBII")
+COUNT = struct.Struct("!I")
+KEY_LENGTH = struct.Struct("!H")
+
+# 操作码
+OP_PING = 0
+OP_CHECK = 1         # 负载: 用户ID            响应: 1 字节，1 表示未超限
+OP_REMAINING = 2     # 负载: 用户ID            响应: !I 剩余次数
+OP_USE = 3           # 负载: 用户ID            响应: 空；标志 FLAG_PERSIST 表示立即写文件
+OP_RESET = 4         # 负载: 用户ID            响应: 空
+OP_STATS = 5         # 负载: 空                响应: JSON
+OP_SAVE_LIMITS = 6   # 负载: 空                响应: 空
+OP_SAVE = 7          # 负载: JSON [[用户ID, 紧凑记录], ...]   响应: !I 保存条数
+OP_SEARCH = 8        # 负载: JSON [查询, 用户ID, 起始时间, 条数]  响应: JSON
+OP_LLM_GET = 9       # 负载: 缓存键            响应: JSON，未命中时为空
+OP_LLM_PUT = 10      # 负载: !H 键长 + 键 + JSON   响应: 空
+OP_SIMILAR = 11      # 负载: JSON [编码, 用户ID, 距离, 条数, 排除的记录]  响应: JSON
+OP_CLUSTERS = 12     # 负载: JSON [距离, 条数]     响应: JSON
+OP_CLEAR = 13        # 负载: 用户ID            响应: 1 字节，1 表示有记录被清除
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+FLAG_PERSIST = 1
+
+def encode_frame(op: int, flag: int, request_id: int, payload: bytes = b"") -> bytes:
+    """编码一帧"""
+    return HEADER.pack(op, flag, request_id, len(payload)) + payload
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[int, int, int, bytes]:
+    """读取一帧，返回 (操作码, 状态或标志, 请求ID, 负载)"""
+    header = await reader.readexactly(HEADER.size)
+    op, flag, request_id, length = HEADER.unpack(header)
+    payload = await reader.readexactly(length) if length else b""
+    return op, flag, request_id, payload
+
+def _dumps(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class CoordinatorServer:
+    """
+    协调进程的服务端
+
+    持有使用次数、历史记录写入与大语言模型缓存，按连接顺序处理请求，
+    客户端可以不等待响应连续发送多个请求（流水线）。
+    """
+
+    def __init__(self, socket_path: str, limit, history, llm_cache: LLMCache, search_index=None,
+                 guard: Optional[Callable[..., Any]] = None):
+        """
+        参数:
+            guard: 包装使用次数操作的协程函数，接管初期由 SharedState 提供，用于在文件锁内执行；
+                关键字参数 save=False 表示只读操作，执行后无需写回
+        """
+        self.socket_path = socket_path
+        self.guard = guard or _run_directly
+        self.limit = limit
+        self.history = history
+        self.llm_cache = llm_cache
+        self.search_index = search_index
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        """开始监听，先移除上一个协调进程遗留的套接字文件"""
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self._server = await asyncio.start_unix_server(self._handle_connection, path=self.socket_path)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                op, flag, request_id, payload = await read_frame(reader)
+                try:
+                    status, result = STATUS_OK, await self.dispatch(op, flag, payload)
+                except Exception as e:
+                    status, result = STATUS_ERROR, str(e).encode("utf-8")
+                writer.write(encode_frame(op, status, request_id, result))
+                # 缓冲区未满时立即返回，不影响后续请求的处理
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, op: int, flag: int, payload: bytes) -> bytes:
+        """执行一个请求，返回响应负载；历史文件的读写在工作线程中进行"""
+        if op == OP_PING:
+            return b""
+        if op == OP_CHECK:
+            allowed = await self.guard(lambda: self.limit.check_user_limit(payload.decode("utf-8")), save=False)
+            return b"\x01" if allowed else b"\x00"
+        if op == OP_REMAINING:
+            return COUNT.pack(await self.guard(lambda: self.limit.get_remaining(payload.decode("utf-8")), save=False))
+        if op == OP_USE:
+            await self.guard(lambda: self.limit.update_usage(payload.decode("utf-8"), persist=bool(flag & FLAG_PERSIST)))
+            return b""
+        if op == OP_RESET:
+            await self.guard(lambda: self.limit.reset_user(payload.decode("utf-8")))
+            return b""
+        if op == OP_STATS:
+            return _dumps(await self.guard(self.limit.get_usage_statistics, save=False))
+        if op == OP_SAVE_LIMITS:
+            await self.guard(self.limit.save)
+            return b""
+        if op == OP_SAVE:
+            entries = [(user_id, CompactRecord.from_row(row)) for user_id, row in json.loads(payload)]
+            return COUNT.pack(await asyncio.to_thread(self.history.save_compact, entries))
+        if op == OP_CLEAR:
+            cleared = await asyncio.to_thread(self.history.clear_history, payload.decode("utf-8"))
+            return b"\x01" if cleared else b"\x00"
+        if op == OP_SEARCH:
+            query, user_id, since, limit = json.loads(payload)
+            if self.search_index is None:
+                return _dumps([])
+            return _dumps(self.search_index.search(query, user_id=user_id, since=since, limit=limit))
+        if op == OP_SIMILAR:
+            code, user_id, distance, limit, skip = json.loads(payload)
+            if self.search_index is None:
+                return _dumps([])
+            return _dumps(self.search_index.similar(code, user_id=user_id, distance=distance, limit=limit, skip=skip))
+        if op == OP_CLUSTERS:
+            distance, limit = json.loads(payload)
+            if self.search_index is None:
+                return _dumps([])
+            return _dumps(self.search_index.clusters(distance=distance, limit=limit))
+        if op == OP_LLM_GET:
+            value = self.llm_cache.get(payload.decode("utf-8"))
+            return b"" if value is None else _dumps(value)
+        if op == OP_LLM_PUT:
+            (length,) = KEY_LENGTH.unpack_from(payload)
+            key = payload[KEY_LENGTH.size:KEY_LENGTH.size + length].decode("utf-8")
+            self.llm_cache.put(key, json.loads(payload[KEY_LENGTH.size + length:]))
+            return b""
+        raise ValueError(f"未知的操作码: {op}")
+
+class CoordinatorClient:
+    """
+    协调进程的客户端
+
+    所有请求共用一条连接：发送后立即返回等待对象，由读取任务按请求ID分发响应，
+    因此并发的请求会以流水线方式发送。
+    """
+
+    def __init__(self, socket_path: str, timeout: float = 2.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._read_task: Optional[asyncio.Task] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._next_id = 0
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_unix_connection(self.socket_path), self.timeout
+        )
+        self._read_task = asyncio.create_task(self._read_loop())
+
+    async def request(self, op: int, payload: bytes = b"", flag: int = 0) -> bytes:
+        """
+        发送请求并等待响应
+
+        异常:
+            ConnectionError: 连接已断开
+            asyncio.TimeoutError: 超时未收到响应
+            RuntimeError: 协调进程处理请求出错
+        """
+        if self._writer is None:
+            raise ConnectionError("未连接到协调进程")
+
+        self._next_id = (self._next_id + 1) & 0xFFFFFFFF
+        request_id = self._next_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            self._writer.write(encode_frame(op, flag, request_id, payload))
+            await self._writer.drain()
+            status, data = await asyncio.wait_for(future, self.timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+        if status != STATUS_OK:
+            raise RuntimeError(data.decode("utf-8"))
+        return data
+
+    async def _read_loop(self):
+        """读取响应并唤醒对应的请求"""
+        try:
+            while True:
+                _, status, request_id, payload = await read_frame(self._reader)
+                future = self._pending.get(request_id)
+                if future is not None and not future.done():
+                    future.set_result((status, payload))
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        finally:
+            self._writer = None
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("与协调进程的连接已断开"))
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._read_task is not None:
+            self._read_task.cancel()
+            self._read_task = None
+
+class SharedState:
+    """
+    使用次数、历史记录写入与大语言模型缓存的统一入口
+
+    三种模式：
+    - local: 直接读写本进程的 UsageLimit / HistoryManager（未启用协调模式时）
+    - server: 本进程为协调进程，本地直接调用，同时为其他进程提供服务
+    - client: 通过 Unix 套接字请求协调进程
+
+    多个进程通过锁文件选出协调进程。客户端请求失败时切换为 local 模式，
+    并在后台定期重新选举或重连；切换期间使用次数的每次读写都在文件锁内
+    重新加载并立即写回，避免多个进程各自持有的副本相互覆盖。
+    """
+
+    def __init__(self, limit, history, llm_cache: LLMCache, search_index=None,
+                 socket_path: Optional[str] = None, timeout: float = 2.0, retry_interval: float = 5.0):
+        """
+        参数:
+            limit: UsageLimit 实例
+            history: HistoryManager 实例
+            llm_cache: 本进程的大语言模型缓存（协调进程或本地模式下使用）
+            search_index: 可选的 HistoryIndex
+            socket_path: 协调进程的套接字路径，None 表示不启用协调模式
+            timeout: 单个请求的超时时间（秒）
+            retry_interval: 本地模式下重新选举的间隔（秒）
+        """
+        self.limit = limit
+        self.history = history
+        self.llm_cache = llm_cache
+        self.search_index = search_index
+        self.socket_path = socket_path
+        self.timeout = max(0.1, float(timeout))
+        self.retry_interval = max(1.0, float(retry_interval))
+
+        self.mode = "local"
+        self._server: Optional[CoordinatorServer] = None
+        self._client: Optional[CoordinatorClient] = None
+        self._lock_file = None
+        self._retry_task: Optional[asyncio.Task] = None
+        self._takeover_until = 0.0
+
+    async def start(self):
+        """启用协调模式时选出协调进程或连接到已有的协调进程"""
+        if self.socket_path is None:
+            return
+        await self._elect()
+        if self.mode == "local":
+            self._schedule_retry()
+
+    async def _elect(self):
+        """取得锁文件的进程成为协调进程，其余进程作为客户端连接"""
+        lock_path = self.socket_path + ".lock"
+        lock_file = open(lock_path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            client = CoordinatorClient(self.socket_path, self.timeout)
+            try:
+                await client.connect()
+                await client.request(OP_PING)
+            except (OSError, asyncio.TimeoutError) as e:
+                await client.close()
+                logger.warning("连接协调进程失败，使用本地模式: %s", e)
+                return
+            self._client = client
+            self.mode = "client"
+            return
+
+        self._lock_file = lock_file
+        self._server = CoordinatorServer(self.socket_path, self.limit, self.history,
+                                         self.llm_cache, self.search_index, guard=self._guard_limits)
+        try:
+            await self._server.start()
+        except OSError as e:
+            logger.warning("启动协调进程失败，使用本地模式: %s", e)
+            await self._release_server()
+            return
+        # 接管前后其他进程可能仍以本地模式写文件，直到它们下次重试时连上来；
+        # 在此期间使用次数的操作继续在文件锁内重新加载并写回
+        await self._locked_limits(lambda: None, save=False)
+        # 检索索引同样可能已被上一个协调进程或本地模式的进程更新，
+        # 以启动时加载的旧索引继续写入会在下次合并快照时丢失它们的记录
+        if self.search_index is not None:
+            await asyncio.to_thread(self.search_index.reload)
+        self._takeover_until = time.monotonic() + 2 * self.retry_interval + self.timeout
+        self.mode = "server"
+
+    async def _release_server(self):
+        if self._server is not None:
+            await self._server.close()
+            self._server = None
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _schedule_retry(self):
+        if self.socket_path is not None and (self._retry_task is None or self._retry_task.done()):
+            self._retry_task = asyncio.create_task(self._retry_loop())
+
+    async def _retry_loop(self):
+        while self.mode == "local":
+            await asyncio.sleep(self.retry_interval)
+            await self._elect()
+
+    async def _failover(self, error: Exception):
+        """协调进程不可用时切换为本地文件模式"""
+        logger.warning("协调进程不可用，切换为本地模式: %s", error)
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+        self.mode = "local"
+        self._schedule_retry()
+
+    async def _call(self, op: int, payload: bytes, local: Callable[[], Any],
+                    decode: Callable[[bytes], Any] = lambda data: None, flag: int = 0,
+                    limits: bool = True, save: bool = True, blocking: bool = False) -> Any:
+        """
+        客户端模式下请求协调进程，失败时切换为本地模式并在本地执行
+
+        参数:
+            limits: 本地执行的操作是否读写使用次数
+            save: 本地执行的使用次数操作是否修改数据，只读操作为 False，执行后不写回文件
+            blocking: 本地执行的操作是否读写历史文件（会等待文件锁），为 True 时在工作线程中执行
+        """
+        if self.mode == "client":
+            try:
+                return decode(await self._client.request(op, payload, flag))
+            except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+                await self._failover(e)
+        if limits and self.socket_path is not None:
+            return await self._guard_limits(local, save=save)
+        if blocking:
+            return await asyncio.to_thread(local)
+        return local()
+
+    async def _guard_limits(self, operation: Callable[[], Any], save: bool = True) -> Any:
+        """本地模式或刚接管协调时在文件锁内执行使用次数操作，否则直接执行"""
+        if self.mode == "local" or time.monotonic() < self._takeover_until:
+            return await self._locked_limits(operation, save=save)
+        return operation()
+
+    async def _locked_limits(self, operation: Callable[[], Any], save: bool = True) -> Any:
+        """
+        协调进程不可用期间，在文件锁内重新加载使用次数后执行操作
+
+        修改数据的操作持有写锁并在执行后写回；只读操作（save=False）持有读锁，不写文件。
+        等待文件锁时让出事件循环，取得锁后的操作只涉及内存与一次快照写入，在事件循环中完成。
+        """
+        lock = FileLock(self.limit.limit_file)
+        async with lock.async_write() if save else lock.async_read():
+            self.limit.reload()
+            result = operation()
+            if save:
+                self.limit.save()
+            return result
+
+    async def check_user_limit(self, user_id: str) -> bool:
+        return await self._call(OP_CHECK, str(user_id).encode("utf-8"),
+                                lambda: self.limit.check_user_limit(user_id),
+                                lambda data: data == b"\x01", save=False)
+
+    async def get_remaining(self, user_id: str) -> int:
+        return await self._call(OP_REMAINING, str(user_id).encode("utf-8"),
+                                lambda: self.limit.get_remaining(user_id),
+                                lambda data: COUNT.unpack(data)[0], save=False)
+
+    async def update_usage(self, user_id: str, persist: bool = True):
+        await self._call(OP_USE, str(user_id).encode("utf-8"),
+                         lambda: self.limit.update_usage(user_id, persist=persist),
+                         flag=FLAG_PERSIST if persist else 0)
+
+    async def reset_user(self, user_id: str):
+        await self._call(OP_RESET, str(user_id).encode("utf-8"), lambda: self.limit.reset_user(user_id))
+
+    async def get_usage_statistics(self) -> Dict[str, Any]:
+        return await self._call(OP_STATS, b"", self.limit.get_usage_statistics, json.loads, save=False)
+
+    async def save_limits(self):
+        await self._call(OP_SAVE_LIMITS, b"", self.limit.save)
+
+    async def save_record(self, user_id: str, question: str, hexagram_data: Dict, interpretation: Dict) -> bool:
+        """保存一条算卦记录"""
+        return await self.save_records([(user_id, question, hexagram_data, interpretation, None)]) == 1
+
+    async def save_records(self, entries: List[Tuple[str, str, Dict, Dict, Optional[int]]]) -> int:
+        """批量保存算卦记录，参数同 HistoryManager.save_records；客户端模式下以紧凑格式发送给协调进程"""
+        if self.mode != "client":
+            return await asyncio.to_thread(self.history.save_records, entries)
+
+        rows = [
+            [user_id, CompactRecord.from_reading(question, hexagram_data, interpretation, ts).to_row()]
+            for user_id, question, hexagram_data, interpretation, ts in entries
+        ]
+        return await self._call(OP_SAVE, _dumps(rows), lambda: self.history.save_records(entries),
+                                lambda data: COUNT.unpack(data)[0], limits=False, blocking=True)
+
+    async def clear_history(self, user_id: str) -> bool:
+        """清除用户的全部历史记录（含归档与检索索引），返回是否有记录被清除"""
+        return await self._call(OP_CLEAR, str(user_id).encode("utf-8"),
+                                lambda: self.history.clear_history(user_id),
+                                lambda data: data == b"\x01", limits=False, blocking=True)
+
+    async def search(self, query: str, user_id: Optional[str] = None, since: Optional[float] = None,
+                     limit: int = 10) -> List[Dict]:
+        def local():
+            if self.search_index is None:
+                return []
+            return self.search_index.search(query, user_id=user_id, since=since, limit=limit)
+        return await self._call(OP_SEARCH, _dumps([query, user_id, since, limit]), local, json.loads,
+                                limits=False)
+
+    async def similar(self, code: int, user_id: Optional[str] = None, distance: int = 1, limit: int = 10,
+                      skip: Optional[List[Any]] = None) -> List[Dict]:
+        """查询相似的起卦记录，参数同 HistoryIndex.similar"""
+        def local():
+            if self.search_index is None:
+                return []
+            return self.search_index.similar(code, user_id=user_id, distance=distance, limit=limit, skip=skip)
+        return await self._call(OP_SIMILAR, _dumps([code, user_id, distance, limit, skip]), local, json.loads,
+                                limits=False)
+
+    async def clusters(self, distance: int = 1, limit: int = 5) -> List[List[int]]:
+        """相似记录最密集的起卦编码，参数同 HistoryIndex.clusters"""
+        def local():
+            if self.search_index is None:
+                return []
+            return self.search_index.clusters(distance=distance, limit=limit)
+        return await self._call(OP_CLUSTERS, _dumps([distance, limit]), local, json.loads, limits=False)
+
+    async def get_llm(self, key: str) -> Optional[Dict[str, str]]:
+        """查询大语言模型缓存"""
+        return await self._call(OP_LLM_GET, key.encode("utf-8"), lambda: self.llm_cache.get(key),
+                                lambda data: json.loads(data) if data else None, limits=False)
+
+    async def put_llm(self, key: str, value: Dict[str, str]):
+        """写入大语言模型缓存"""
+        encoded = key.encode("utf-8")
+        await self._call(OP_LLM_PUT, KEY_LENGTH.pack(len(encoded)) + encoded + _dumps(value),
+                         lambda: self.llm_cache.put(key, value), limits=False)
+
+    async def close(self):
+        if self._retry_task is not None:
+            self._retry_task.cancel()
+            self._retry_task = None
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+        await self._release_server()
+        self.mode = "local"
@@ -4,14 +4,15 @@
 """
 
 # 八卦符号、名称和象
+# 键为三爻二进制值，下爻为第0位，与 HEXAGRAM_MAP 一致
 TRIGRAMS = {
     0b111: ("☰", "乾", "天"),
-    0b110: ("☱", "兑", "泽"),
+    0b011: ("☱", "兑", "泽"),
     0b101: ("☲", "离", "火"),
-    0b100: ("☳", "震", "雷"),
-    0b011: ("☴", "巽", "风"),
+    0b001: ("☳", "震", "雷"),
+    0b110: ("☴", "巽", "风"),
     0b010: ("☵", "坎", "水"),
-    0b001: ("☶", "艮", "山"),
+    0b100: ("☶", "艮", "山"),
     0b000: ("☷", "坤", "地"),
 }
 
@@ -23,73 +24,90 @@ UNICODE_SYMBOLS = {
 }
 
 # 易经64卦的标准映射表 - 从二进制值映射到卦序(1-64)
+# 下爻为第0位，低三位为下卦、高三位为上卦
+# 旧版映射表有 44 项错误（其中同人、随、无妄、夬、井、革、小过 7 卦无法得到），已按上下卦重新生成；
+# 修正前保存的历史记录与解释缓存中的卦序为旧映射下的结果，见 README“升级说明”。
+# 修改本表会改变文本起卦的结果，calculator.TEXT_GOLDEN_VECTORS 中固定了卦序
 HEXAGRAM_MAP = {
-    0b000000: 2,   # 坤 ䷁
-    0b000001: 24,  # 复 ䷗
-    0b000010: 7,   # 师 ䷆
-    0b000011: 19,  # 临 ䷒
-    0b000100: 15,  # 谦 ䷎
-    0b000101: 36,  # 明夷 ䷣
-    0b000110: 46,  # 升 ䷭
-    0b000111: 11,  # 泰 ䷊
-    0b001000: 16,  # 豫 ䷏
-    0b001001: 51,  # 震 ䷲
-    0b001010: 40,  # 解 ䷧
-    0b001011: 54,  # 归妹 ䷵
-    0b001100: 32,  # 恒 ䷟
-    0b001101: 55,  # 丰 ䷶
-    0b001110: 63,  # 既济 ䷾
-    0b001111: 56,  # 旅 ䷷
-    0b010000: 8,   # 比 ䷇
-    0b010001: 3,   # 屯 ䷂
-    0b010010: 29,  # 坎 ䷜
-    0b010011: 60,  # 节 ䷻
-    0b010100: 39,  # 蹇 ䷦
-    0b010101: 53,  # 艮 ䷳
-    0b010110: 64,  # 未济 ䷿
-    0b010111: 4,   # 蒙 ䷃
-    0b011000: 47,  # 困 ䷮
-    0b011001: 58,  # 巽 ䷸
-    0b011010: 6,   # 讼 ䷅
-    0b011011: 10,  # 履 ䷉
-    0b011100: 59,  # 兑 ䷹
-    0b011101: 61,  # 中孚 ䷼
-    0b011110: 41,  # 损 ䷨
-    0b011111: 38,  # 家人 ䷥
-    0b100000: 12,  # 否 ䷋
-    0b100001: 45,  # 萃 ䷬
-    0b100010: 35,  # 晋 ䷢
-    0b100011: 16,  # 豫 ䷏
-    0b100100: 20,  # 观 ䷓
-    0b100101: 8,   # 比 ䷇
-    0b100110: 23,  # 剥 ䷖
-    0b100111: 2,   # 坤 ䷁
-    0b101000: 23,  # 剥 ䷖
-    0b101001: 20,  # 观 ䷓
-    0b101010: 27,  # 颐 ䷚
-    0b101011: 42,  # 益 ䷩
-    0b101100: 52,  # 曾 ䷴
-    0b101101: 57,  # 巽 ䷸
-    0b101110: 31,  # 咸 ䷞
-    0b101111: 33,  # 遯 ䷠
-    0b110000: 44,  # 姤 ䷫
-    0b110001: 28,  # 大过 ䷛
-    0b110010: 50,  # 鼎 ䷱
-    0b110011: 32,  # 恒 ䷟
-    0b110100: 14,  # 大有 ䷍
-    0b110101: 34,  # 大壮 ䷡
-    0b110110: 5,   # 需 ䷄
-    0b110111: 9,   # 小畜 ䷈
-    0b111000: 11,  # 泰 ䷊
-    0b111001: 26,  # 大畜 ䷙
-    0b111010: 18,  # 蛊 ䷑
-    0b111011: 22,  # 贲 ䷕
-    0b111100: 37,  # 火风鼎 ䷤
-    0b111101: 30,  # 离 ䷝
-    0b111110: 21,  # 噬嗑 ䷔
-    0b111111: 1,   # 乾 ䷀
+    0b000000: 2,  # 坤 ䷁
+    0b000001: 24, # 复 ䷗
+    0b000010: 7,  # 师 ䷆
+    0b000011: 19, # 临 ䷒
+    0b000100: 15, # 谦 ䷎
+    0b000101: 36, # 明夷 ䷣
+    0b000110: 46, # 升 ䷭
+    0b000111: 11, # 泰 ䷊
+    0b001000: 16, # 豫 ䷏
+    0b001001: 51, # 震 ䷲
+    0b001010: 40, # 解 ䷧
+    0b001011: 54, # 归妹 ䷵
+    0b001100: 62, # 小过 ䷽
+    0b001101: 55, # 丰 ䷶
+    0b001110: 32, # 恒 ䷟
+    0b001111: 34, # 大壮 ䷡
+    0b010000: 8,  # 比 ䷇
+    0b010001: 3,  # 屯 ䷂
+    0b010010: 29, # 坎 ䷜
+    0b010011: 60, # 节 ䷻
+    0b010100: 39, # 蹇 ䷦
+    0b010101: 63, # 既济 ䷾
+    0b010110: 48, # 井 ䷯
+    0b010111: 5,  # 需 ䷄
+    0b011000: 45, # 萃 ䷬
+    0b011001: 17, # 随 ䷐
+    0b011010: 47, # 困 ䷮
+    0b011011: 58, # 兑 ䷹
+    0b011100: 31, # 咸 ䷞
+    0b011101: 49, # 革 ䷰
+    0b011110: 28, # 大过 ䷛
+    0b011111: 43, # 夬 ䷪
+    0b100000: 23, # 剥 ䷖
+    0b100001: 27, # 颐 ䷚
+    0b100010: 4,  # 蒙 ䷃
+    0b100011: 41, # 损 ䷨
+    0b100100: 52, # 艮 ䷳
+    0b100101: 22, # 贲 ䷕
+    0b100110: 18, # 蛊 ䷑
+    0b100111: 26, # 大畜 ䷙
+    0b101000: 35, # 晋 ䷢
+    0b101001: 21, # 噬嗑 ䷔
+    0b101010: 64, # 未济 ䷿
+    0b101011: 38, # 睽 ䷥
+    0b101100: 56, # 旅 ䷷
+    0b101101: 30, # 离 ䷝
+    0b101110: 50, # 鼎 ䷱
+    0b101111: 14, # 大有 ䷍
+    0b110000: 20, # 观 ䷓
+    0b110001: 42, # 益 ䷩
+    0b110010: 59, # 涣 ䷺
+    0b110011: 61, # 中孚 ䷼
+    0b110100: 53, # 渐 ䷴
+    0b110101: 37, # 家人 ䷤
+    0b110110: 57, # 巽 ䷸
+    0b110111: 9,  # 小畜 ䷈
+    0b111000: 12, # 否 ䷋
+    0b111001: 25, # 无妄 ䷘
+    0b111010: 6,  # 讼 ䷅
+    0b111011: 10, # 履 ䷉
+    0b111100: 33, # 遯 ䷠
+    0b111101: 13, # 同人 ䷌
+    0b111110: 44, # 姤 ䷫
+    0b111111: 1,  # 乾 ䷀
 }
 
+# 修正前的旧版映射表，下标为六爻二进制值，只用于解读修正前保存的历史记录；
+# 该表不是一一映射，不能由卦序反推六爻
+LEGACY_HEXAGRAM_MAP = (
+    2, 24, 7, 19, 15, 36, 46, 11,
+    16, 51, 40, 54, 32, 55, 63, 56,
+    8, 3, 29, 60, 39, 53, 64, 4,
+    47, 58, 6, 10, 59, 61, 41, 38,
+    12, 45, 35, 16, 20, 8, 23, 2,
+    23, 20, 27, 42, 52, 57, 31, 33,
+    44, 28, 50, 32, 14, 34, 5, 9,
+    11, 26, 18, 22, 37, 30, 21, 1,
+)
+
 # 完整的64卦Unicode字符映射
 HEXAGRAM_UNICODE = {
     0b000000: "䷁",  # 坤
@@ -104,57 +122,57 @@ HEXAGRAM_UNICODE = {
     0b001001: "䷲",  # 震
     0b001010: "䷧",  # 解
     0b001011: "䷵",  # 归妹
-    0b001100: "䷟",  # 恒
+    0b001100: "䷽",  # 小过
     0b001101: "䷶",  # 丰
-    0b001110: "䷾",  # 既济
-    0b001111: "䷷",  # 旅
+    0b001110: "䷟",  # 恒
+    0b001111: "䷡",  # 大壮
     0b010000: "䷇",  # 比
     0b010001: "䷂",  # 屯
     0b010010: "䷜",  # 坎
     0b010011: "䷻",  # 节
     0b010100: "䷦",  # 蹇
-    0b010101: "䷳",  # 艮
-    0b010110: "䷿",  # 未济
-    0b010111: "䷃",  # 蒙
-    0b011000: "䷮",  # 困
-    0b011001: "䷸",  # 巽
-    0b011010: "䷅",  # 讼
-    0b011011: "䷉",  # 履
-    0b011100: "䷹",  # 兑
-    0b011101: "䷼",  # 中孚
-    0b011110: "䷨",  # 损
-    0b011111: "䷥",  # 家人
-    0b100000: "䷋",  # 否
-    0b100001: "䷬",  # 萃
-    0b100010: "䷢",  # 晋
-    0b100011: "䷏",  # 豫
-    0b100100: "䷓",  # 观
-    0b100101: "䷇",  # 比
-    0b100110: "䷖",  # 剥
-    0b100111: "䷁",  # 坤
-    0b101000: "䷖",  # 剥
-    0b101001: "䷓",  # 观
-    0b101010: "䷚",  # 颐
-    0b101011: "䷩",  # 益
-    0b101100: "䷴",  # 曾
-    0b101101: "䷸",  # 巽
-    0b101110: "䷞",  # 咸
-    0b101111: "䷠",  # 遯
-    0b110000: "䷫",  # 姤
-    0b110001: "䷛",  # 大过
-    0b110010: "䷱",  # 鼎
-    0b110011: "䷟",  # 恒
-    0b110100: "䷍",  # 大有
-    0b110101: "䷡",  # 大壮
-    0b110110: "䷄",  # 需
+    0b010101: "䷾",  # 既济
+    0b010110: "䷯",  # 井
+    0b010111: "䷄",  # 需
+    0b011000: "䷬",  # 萃
+    0b011001: "䷐",  # 随
+    0b011010: "䷮",  # 困
+    0b011011: "䷹",  # 兑
+    0b011100: "䷞",  # 咸
+    0b011101: "䷰",  # 革
+    0b011110: "䷛",  # 大过
+    0b011111: "䷪",  # 夬
+    0b100000: "䷖",  # 剥
+    0b100001: "䷚",  # 颐
+    0b100010: "䷃",  # 蒙
+    0b100011: "䷨",  # 损
+    0b100100: "䷳",  # 艮
+    0b100101: "䷕",  # 贲
+    0b100110: "䷑",  # 蛊
+    0b100111: "䷙",  # 大畜
+    0b101000: "䷢",  # 晋
+    0b101001: "䷔",  # 噬嗑
+    0b101010: "䷿",  # 未济
+    0b101011: "䷥",  # 睽
+    0b101100: "䷷",  # 旅
+    0b101101: "䷝",  # 离
+    0b101110: "䷱",  # 鼎
+    0b101111: "䷍",  # 大有
+    0b110000: "䷓",  # 观
+    0b110001: "䷩",  # 益
+    0b110010: "䷺",  # 涣
+    0b110011: "䷼",  # 中孚
+    0b110100: "䷴",  # 渐
+    0b110101: "䷤",  # 家人
+    0b110110: "䷸",  # 巽
     0b110111: "䷈",  # 小畜
-    0b111000: "䷊",  # 泰
-    0b111001: "䷙",  # 大畜
-    0b111010: "䷑",  # 蛊
-    0b111011: "䷕",  # 贲
-    0b111100: "䷤",  # 火风鼎
-    0b111101: "䷝",  # 离
-    0b111110: "䷔",  # 噬嗑
+    0b111000: "䷋",  # 否
+    0b111001: "䷘",  # 无妄
+    0b111010: "䷅",  # 讼
+    0b111011: "䷉",  # 履
+    0b111100: "䷠",  # 遯
+    0b111101: "䷌",  # 同人
+    0b111110: "䷫",  # 姤
     0b111111: "䷀",  # 乾
 }
 
@@ -225,3 +243,70 @@ HEXAGRAM_NAMES = {
     63: "水火既济",
     64: "火水未济"
 }
+
+# 单爻四象的理论概率（6 老阴、7 少阳、8 少阴、9 老阳）
+# coin: 三枚硬币掷法；yarrow: 大衍之数蓍草揲法
+LINE_PROBABILITIES = {
+    "coin": {6: 1 / 8, 7: 3 / 8, 8: 3 / 8, 9: 1 / 8},
+    "yarrow": {6: 1 / 16, 7: 5 / 16, 8: 7 / 16, 9: 3 / 16},
+}
+
+# 四象对应的 (阴阳, 是否动爻)
+LINE_STATES = {
+    6: (0, 1),  # 老阴，动
+    7: (1, 0),  # 少阳，静
+    8: (0, 0),  # 少阴，静
+    9: (1, 1),  # 老阳，动
+}
+
+# 随机起卦的取位查找表，值为 阴阳位 | (动爻位 << 1)
+# 掷币法：每爻 3 个随机位，以正面个数决定四象
+COIN_LINE_TABLE = tuple(
+    {0: 0b10, 1: 0b00, 2: 0b01, 3: 0b11}[bin(i).count("1")] for i in range(8)
+)
+
+# 蓍草法：每爻 4 个随机位（16 种等概率结果），按 1:5:7:3 分配给 6/7/8/9
+YARROW_LINE_TABLE = (
+    (0b10,)             # 6 老阴 1/16
+    + (0b01,) * 5       # 7 少阳 5/16
+    + (0b00,) * 7       # 8 少阴 7/16
+    + (0b11,) * 3       # 9 老阳 3/16
+)
+
+# 天干，甲为第一位
+HEAVENLY_STEMS = ("甲", "乙", "丙", "丁", "戊", "己", "庚", "辛", "壬", "癸")
+
+# 地支，子为第一位
+EARTHLY_BRANCHES = ("子", "丑", "寅", "卯", "辰", "巳", "午", "未", "申", "酉", "戌", "亥")
+
+# 先天八卦数 -> 三爻二进制值（下爻为第0位，与 HEXAGRAM_MAP 一致）
+# 乾一、兑二、离三、震四、巽五、坎六、艮七、坤八
+XIANTIAN_TRIGRAMS = {
+    1: 0b111,  # 乾
+    2: 0b011,  # 兑
+    3: 0b101,  # 离
+    4: 0b001,  # 震
+    5: 0b110,  # 巽
+    6: 0b010,  # 坎
+    7: 0b100,  # 艮
+    8: 0b000,  # 坤
+}
+
+# 卦序 -> 六爻二进制值，下标为卦序，第0项不使用
+HEXAGRAM_BINARY = tuple(
+    [0] + [binary for _, binary in sorted((number, binary) for binary, number in HEXAGRAM_MAP.items())]
+)
+
+# 以下关系表均以六爻二进制值为下标，值也是六爻二进制值
+# 互卦：二三四爻为下卦，三四五爻为上卦
+NUCLEAR = tuple((b >> 1 & 0b111) | (b >> 2 & 0b111) << 3 for b in range(64))
+
+# 综卦：六爻上下颠倒
+INVERSE = tuple(int(f"{b:06b}"[::-1], 2) for b in range(64))
+
+# 错卦：六爻阴阳全变
+OPPOSITE = tuple(b ^ 0b111111 for b in range(64))
+
+# 上下卦分解，值为三爻二进制值，可查 TRIGRAMS
+LOWER_TRIGRAM = tuple(b & 0b111 for b in range(64))
+UPPER_TRIGRAM = tuple(b >> 3 for b in range(64))
@@ -0,0 +1,217 @@
+import time
+import asyncio
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .storage import atomic_write
+from .log import get_logger
+
+logger = get_logger("degrade")
+
+# 降级级别，高级别包含低级别的全部措施
+NORMAL = 0
+DEFER_WRITES = 1
+SIMPLE_RENDER = 2
+NO_LLM = 3
+SHED = 4
+
+LEVEL_NAMES = ("正常", "延迟写入历史", "简化渲染", "停用大语言模型", "拒绝非管理员请求")
+
+class DegradationController:
+    """
+    过载降级控制器
+
+    后台任务每隔 interval 秒采样一次事件循环延迟（定时唤醒的超时量），每隔 probe_every 次
+    采样在线程中原子写入一个小文件测量存储延迟，两者都取指数移动平均。
+
+    级别 n 的进入阈值为 lag_ms × 2^(n-1) 与 io_ms × 2^(n-1)，任一指标连续 up_samples 次
+    超过下一级阈值时升一级；两项指标都低于当前级别阈值的 recover_ratio 倍并持续
+    recover_seconds 秒后降一级。每次只移动一级，避免在阈值附近反复切换。
+
+    存储探测只在 active() 为真（有请求正在处理）或已处于降级状态时进行，空闲时不写磁盘。
+    """
+
+    # 指数移动平均的权重
+    ALPHA = 0.3
+
+    def __init__(self, probe_path: str, interval: float = 0.5, lag_ms: float = 100, io_ms: float = 200,
+                 up_samples: int = 2, recover_ratio: float = 0.5, recover_seconds: float = 10,
+                 probe_every: int = 4, max_level: int = SHED,
+                 active: Optional[Callable[[], bool]] = None):
+        """
+        参数:
+            probe_path: 测量存储延迟时写入的文件
+            interval: 采样间隔(秒)
+            lag_ms: 进入第 1 级的事件循环延迟阈值(毫秒)，每升一级翻倍
+            io_ms: 进入第 1 级的存储延迟阈值(毫秒)，每升一级翻倍
+            up_samples: 连续多少次超过阈值后升级
+            recover_ratio: 指标低于当前级别阈值的该倍数时开始计算恢复时间
+            recover_seconds: 持续低于恢复阈值多久后降一级
+            probe_every: 每多少次采样测量一次存储延迟
+            max_level: 最高降级级别
+            active: 返回当前是否有请求正在处理，为 None 时总是探测
+        """
+        self.probe_path = probe_path
+        self.interval = max(0.05, float(interval))
+        self.lag_ms = max(1.0, float(lag_ms))
+        self.io_ms = max(1.0, float(io_ms))
+        self.up_samples = max(1, int(up_samples))
+        self.recover_ratio = min(1.0, max(0.0, float(recover_ratio)))
+        self.recover_seconds = max(0.0, float(recover_seconds))
+        self.probe_every = max(1, int(probe_every))
+        self.max_level = min(SHED, max(NORMAL, int(max_level)))
+        self.active = active
+
+        self.level = NORMAL
+        self.lag = 0.0
+        self.io = 0.0
+        self._above = 0
+        self._calm_since: Optional[float] = None
+        self._changed_at = time.monotonic()
+
+        # (原级别, 新级别) -> 次数；各级别累计停留时间(秒)
+        self.transitions: Dict[Tuple[int, int], int] = {}
+        self.time_in_level: List[float] = [0.0] * (SHED + 1)
+        self._listeners: List[Callable[[int, int], None]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def on_change(self, listener: Callable[[int, int], None]):
+        """注册级别变化回调，参数为 (原级别, 新级别)"""
+        self._listeners.append(listener)
+
+    def at_least(self, level: int) -> bool:
+        return self.level >= level
+
+    def start(self):
+        """启动后台采样任务"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def threshold(self, level: int) -> Tuple[float, float]:
+        """进入指定级别的 (事件循环延迟, 存储延迟) 阈值（毫秒）"""
+        scale = 2 ** (level - 1)
+        return self.lag_ms * scale, self.io_ms * scale
+
+    def observe(self, lag_ms: Optional[float] = None, io_ms: Optional[float] = None,
+                now: Optional[float] = None) -> int:
+        """
+        加入一次采样并按需调整级别
+
+        参数:
+            lag_ms: 事件循环延迟(毫秒)，None 表示本次未采样
+            io_ms: 存储写入延迟(毫秒)，None 表示本次未采样
+            now: 当前时间（time.monotonic），默认取当前值
+
+        返回:
+            调整后的级别
+        """
+        now = time.monotonic() if now is None else now
+        if lag_ms is not None:
+            self.lag += self.ALPHA * (lag_ms - self.lag)
+        if io_ms is not None:
+            self.io += self.ALPHA * (io_ms - self.io)
+
+        if self.level < self.max_level:
+            lag_up, io_up = self.threshold(self.level + 1)
+            if self.lag >= lag_up or self.io >= io_up:
+                self._above += 1
+                if self._above >= self.up_samples:
+                    self._set_level(self.level + 1, now)
+                return self.level
+        self._above = 0
+
+        if self.level > NORMAL:
+            lag_down, io_down = self.threshold(self.level)
+            if self.lag < lag_down * self.recover_ratio and self.io < io_down * self.recover_ratio:
+                if self._calm_since is None:
+                    self._calm_since = now
+                elif now - self._calm_since >= self.recover_seconds:
+                    self._set_level(self.level - 1, now)
+            else:
+                self._calm_since = None
+        return self.level
+
+    def _set_level(self, level: int, now: float):
+        previous = self.level
+        self.time_in_level[previous] += now - self._changed_at
+        self._changed_at = now
+        self.level = level
+        # 每次切换后重新计算升级次数与恢复时间
+        self._above = 0
+        self._calm_since = None
+        key = (previous, level)
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+
+        log = logger.warning if level > previous else logger.info
+        log("降级级别变化", extra={
+            "from_level": LEVEL_NAMES[previous], "to_level": LEVEL_NAMES[level],
+            "loop_lag_ms": round(self.lag, 1), "io_ms": round(self.io, 1)
+        })
+        for listener in self._listeners:
+            try:
+                listener(previous, level)
+            except Exception as e:
+                logger.error("降级回调出错: %s", e)
+
+    def _should_probe(self) -> bool:
+        """空闲且未降级时不探测；已降级时继续探测，以便在指标回落后恢复"""
+        return self.level > NORMAL or self.active is None or self.active()
+
+    def _probe(self) -> float:
+        """原子写入一个小文件，返回耗时（毫秒）"""
+        started = time.perf_counter()
+        atomic_write(self.probe_path, b"%d" % time.time_ns())
+        return (time.perf_counter() - started) * 1000
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        samples = 0
+        probe: Optional[asyncio.Future] = None
+        probe_started = 0.0
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected) * 1000
+
+            # 存储探测在线程中进行，结果在之后的采样中取回，不阻塞事件循环
+            io = None
+            if probe is not None and probe.done():
+                try:
+                    io = probe.result()
+                except Exception as e:
+                    logger.error("存储延迟探测失败: %s", e)
+                probe = None
+            samples += 1
+            if probe is None and samples % self.probe_every == 0 and self._should_probe():
+                probe = loop.run_in_executor(None, self._probe)
+                probe_started = time.perf_counter()
+            elif probe is not None and not probe.done():
+                # 探测仍未完成，写入至少已经耗时这么久
+                io = (time.perf_counter() - probe_started) * 1000
+
+            self.observe(lag, io)
+
+    def report(self) -> List[str]:
+        """当前级别、指标与切换次数"""
+        now = time.monotonic()
+        time_in_level = list(self.time_in_level)
+        time_in_level[self.level] += now - self._changed_at
+        lines = [
+            f"降级级别: {self.level} {LEVEL_NAMES[self.level]}（事件循环延迟 {self.lag:.1f}ms，"
+            f"存储延迟 {self.io:.1f}ms）"
+        ]
+        ups = sum(count for (a, b), count in self.transitions.items() if b > a)
+        downs = sum(count for (a, b), count in self.transitions.items() if b < a)
+        if ups or downs:
+            spent = "，".join(
+                f"{LEVEL_NAMES[level]} {seconds:.0f}s" for level, seconds in enumerate(time_in_level) if seconds >= 1
+            )
+            lines.append(f"切换: 升级 {ups} 次，恢复 {downs} 次" + (f"；停留时间: {spent}" if spent else ""))
+        return lines
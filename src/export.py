@@ -0,0 +1,126 @@
+import os
+import csv
+import json
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Any, Optional, Iterator, Tuple
+
+class StreamingAggregates:
+    """
+    单次遍历的流式统计
+
+    逐条接收记录，统计每卦出现次数、吉凶分布与每日活跃用户数。
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.hexagrams: Counter = Counter()
+        self.fortunes: Counter = Counter()
+        self._daily_users: Dict[str, set] = {}
+
+    def update(self, user_id: str, record: Dict):
+        """统计一条记录"""
+        self.total += 1
+        self.hexagrams[record.get("hexagram_original", 0)] += 1
+        self.fortunes[record.get("fortune", "平")] += 1
+
+        day = str(record.get("timestamp", ""))[:10]
+        self._daily_users.setdefault(day, set()).add(user_id)
+
+    def result(self) -> Dict[str, Any]:
+        """返回统计结果"""
+        return {
+            "total": self.total,
+            "hexagrams": dict(self.hexagrams),
+            "fortunes": dict(self.fortunes),
+            "active_users": {day: len(users) for day, users in sorted(self._daily_users.items())}
+        }
+
+class HistoryExporter:
+    """
+    历史记录导出器
+
+    通过 HistoryManager.iter_records 逐个文件读取，过滤后逐条写出，
+    内存占用与单个用户的历史大小相关，而与总记录数无关。
+    """
+
+    FORMATS = ("jsonl", "csv")
+
+    # CSV 导出的列
+    CSV_FIELDS = [
+        "user_id", "timestamp", "question", "hexagram_original", "hexagram_changed",
+        "moving", "fortune", "result_summary"
+    ]
+
+    def __init__(self, history, export_dir: str):
+        """
+        参数:
+            history: HistoryManager 实例
+            export_dir: 导出文件目录
+        """
+        self.history = history
+        self.export_dir = export_dir
+        os.makedirs(self.export_dir, exist_ok=True)
+
+    def iter_records(self, start: Optional[str] = None, end: Optional[str] = None,
+                     hexagram: Optional[int] = None) -> Iterator[Tuple[str, Dict]]:
+        """
+        按条件惰性遍历历史记录
+
+        参数:
+            start: 起始日期（YYYY-MM-DD，包含）
+            end: 结束日期（YYYY-MM-DD，包含）
+            hexagram: 原卦或变卦为该卦序的记录
+
+        返回:
+            (用户ID, 记录) 的生成器
+        """
+        for user_id, record in self.history.iter_records():
+            # 时间格式为 YYYY-MM-DD HH:MM:SS，可直接按字符串比较日期
+            day = str(record.get("timestamp", ""))[:10]
+            if start and day < start:
+                continue
+            if end and day > end:
+                continue
+            if hexagram is not None and hexagram not in (
+                record.get("hexagram_original"), record.get("hexagram_changed")
+            ):
+                continue
+            yield user_id, record
+
+    def export(self, fmt: str = "jsonl", start: Optional[str] = None, end: Optional[str] = None,
+               hexagram: Optional[int] = None) -> Tuple[str, Dict[str, Any]]:
+        """
+        导出历史记录并同时计算统计
+
+        参数:
+            fmt: 导出格式，jsonl 或 csv
+            start: 起始日期
+            end: 结束日期
+            hexagram: 卦序过滤
+
+        返回:
+            (导出文件路径, 统计结果)
+        """
+        if fmt not in self.FORMATS:
+            raise ValueError(f"不支持的导出格式: {fmt}")
+
+        filename = f"history_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+        path = os.path.join(self.export_dir, filename)
+        aggregates = StreamingAggregates()
+
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            if fmt == "csv":
+                writer = csv.DictWriter(f, fieldnames=self.CSV_FIELDS, extrasaction="ignore")
+                writer.writeheader()
+
+            for user_id, record in self.iter_records(start, end, hexagram):
+                aggregates.update(user_id, record)
+                row = dict(record, user_id=user_id)
+                if fmt == "csv":
+                    row["moving"] = "".join(str(bit) for bit in record.get("moving", []))
+                    writer.writerow(row)
+                else:
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+        return path, aggregates.result()
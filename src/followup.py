@@ -0,0 +1,106 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+class FollowUpCache:
+    """
+    追问上下文缓存
+
+    每个用户保留最近一次起卦的上下文：一条卦象摘要（user）、一条解读（assistant），
+    以及之后的追问与回答。追问时这些消息作为 contexts 传给大语言模型，提示词只包含
+    新的问题。按最近使用淘汰，超过 ttl 秒未使用即失效，每次起卦最多追问 max_turns 次。
+
+    缓存只在本进程内，多进程部署时追问需由同一进程处理，否则提示用户重新起卦。
+    """
+
+    def __init__(self, max_users: int = 1024, ttl: float = 1800, max_turns: int = 3):
+        """
+        参数:
+            max_users: 最多保留上下文的用户数
+            ttl: 上下文的有效时间(秒)，每次追问后重新计时
+            max_turns: 每次起卦后最多追问的次数
+        """
+        self.max_users = max(1, int(max_users))
+        self.ttl = max(1.0, float(ttl))
+        self.max_turns = max(1, int(max_turns))
+        # 用户ID -> {"messages", "label", "turns", "expires"}
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0}
+
+    def put(self, user_id: str, summary: str, reply: str, label: str):
+        """
+        保存一次起卦的上下文，替换该用户之前的上下文
+
+        参数:
+            summary: 卦象摘要，作为第一条 user 消息
+            reply: 解读，作为第一条 assistant 消息
+            label: 显示给用户的卦象名称，如 乾为天变天风姤
+        """
+        self._entries[user_id] = {
+            "messages": [
+                {"role": "user", "content": summary},
+                {"role": "assistant", "content": reply},
+            ],
+            "label": label,
+            "turns": 0,
+            "expires": time.monotonic() + self.ttl,
+        }
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+
+    def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """取得用户的上下文，不存在或已过期时返回 None"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        if time.monotonic() >= entry["expires"]:
+            del self._entries[user_id]
+            self.stats["expired"] += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.stats["hits"] += 1
+        return entry
+
+    def reserve(self, entry: Dict[str, Any]) -> bool:
+        """
+        在调用大语言模型之前占用一次追问，次数已用完时返回 False
+
+        同时发出的多个追问依次占用，不会超过 max_turns；调用失败时用 cancel 退还。
+        """
+        if entry["turns"] >= self.max_turns:
+            return False
+        entry["turns"] += 1
+        return True
+
+    def cancel(self, entry: Dict[str, Any]):
+        """退还 reserve 占用的次数"""
+        entry["turns"] = max(0, entry["turns"] - 1)
+
+    def append(self, entry: Dict[str, Any], question: str, answer: str):
+        """
+        记录一次已占用次数的追问与回答，并重新计算有效期
+
+        参数:
+            entry: get 返回的上下文；等待回答期间用户重新起卦时，新上下文不受影响
+        """
+        entry["messages"].extend((
+            {"role": "user", "content": question},
+            {"role": "assistant", "content": answer},
+        ))
+        entry["expires"] = time.monotonic() + self.ttl
+
+    def remaining(self, entry: Dict[str, Any]) -> int:
+        """该上下文还可追问的次数"""
+        return max(0, self.max_turns - entry["turns"])
+
+    def discard(self, user_id: str):
+        self._entries.pop(user_id, None)
+
+    def messages(self, entry: Dict[str, Any]) -> List[Dict[str, str]]:
+        """作为 contexts 传给大语言模型的消息副本"""
+        return [dict(message) for message in entry["messages"]]
+
+    def __len__(self) -> int:
+        return len(self._entries)
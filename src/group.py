@@ -0,0 +1,134 @@
+import time
+import asyncio
+from typing import Dict, List, Any, Optional, Tuple, Callable, Awaitable
+
+from .log import get_logger
+
+logger = get_logger("group")
+
+class _Abandoned(Exception):
+    """共享计算失败或被取消，等待的请求需要重新计算"""
+
+class GroupReadingPool:
+    """
+    群组共享起卦池
+
+    同一群内、同一时间窗口中对同一（归一化后）问题的算卦只计算一次，
+    结果分发给所有提问的用户；各用户的历史记录与使用次数收集后批量写入。
+    """
+
+    def __init__(self, window: int = 60, flush_delay: float = 2.0, max_entries: int = 256):
+        """
+        参数:
+            window: 共享窗口长度（秒）
+            flush_delay: 收集历史记录后延迟写入的时间（秒）
+            max_entries: 最多保留的共享结果数
+        """
+        self.window = max(1, int(window))
+        self.flush_delay = max(0.0, float(flush_delay))
+        self.max_entries = max(1, int(max_entries))
+
+        # 键 -> (过期时间, 结果 Future)
+        self._readings: Dict[Tuple, Tuple[float, asyncio.Future]] = {}
+
+        # 待写入的 (用户ID, 问题, 卦象数据, 卦象解释, 起卦时间戳)
+        self._pending: List[Tuple[str, str, Dict, Dict, int]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._writer: Optional[Callable[[List[Tuple[str, str, Dict, Dict, int]]], None]] = None
+
+        # 统计：计算次数与共享命中次数
+        self.computed = 0
+        self.shared = 0
+
+    def set_writer(self, writer: Callable[[List[Tuple[str, str, Dict, Dict, int]]], None]):
+        """设置批量写入函数，参数为待写入的记录列表"""
+        self._writer = writer
+
+    def make_key(self, group_id: str, question: str, now: Optional[float] = None) -> Tuple:
+        """生成共享键：(群ID, 归一化问题, 时间窗口编号)"""
+        now = time.time() if now is None else now
+        return (group_id, question, int(now // self.window))
+
+    async def get_or_compute(self, key: Tuple, compute: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """
+        获取共享结果，不存在时调用 compute 计算
+
+        并发请求同一个键时只有第一个请求执行计算，其余请求等待同一结果。
+        失败不会共享：计算出错或被取消时移除该键，错误只抛给计算的请求，
+        等待中的请求各自重新计算（其中第一个计算，其余继续等待它的结果）。
+        """
+        while True:
+            now = time.monotonic()
+            self._prune(now)
+
+            entry = self._readings.get(key)
+            if entry is None:
+                break
+            try:
+                result = await asyncio.shield(entry[1])
+            except _Abandoned:
+                continue
+            self.shared += 1
+            return result
+
+        future = asyncio.get_running_loop().create_future()
+        self._readings[key] = (now + self.window, future)
+        self.computed += 1
+        try:
+            result = await compute()
+        except BaseException:
+            # 包括 CancelledError：不解除等待的话，其余请求会一直阻塞
+            if self._readings.get(key, (None, None))[1] is future:
+                del self._readings[key]
+            future.set_exception(_Abandoned())
+            # 避免无人等待时出现未获取异常的警告
+            future.exception()
+            raise
+
+        future.set_result(result)
+        return result
+
+    def record(self, user_id: str, question: str, hexagram_data: Dict, interpretation: Dict,
+               ts: Optional[int] = None):
+        """
+        登记一条待写入的用户记录，稍后与同批记录一起写入
+
+        ts 为起卦时间戳，默认取登记时的时间，写入时不再重新取时间。
+        """
+        ts = int(time.time()) if ts is None else ts
+        self._pending.append((user_id, question, hexagram_data, interpretation, ts))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        """等待 flush_delay 后批量写入"""
+        await asyncio.sleep(self.flush_delay)
+        self.flush()
+
+    def flush(self) -> int:
+        """立即写入所有待写入的记录，返回写入条数"""
+        batch, self._pending = self._pending, []
+        if batch and self._writer is not None:
+            try:
+                self._writer(batch)
+            except Exception as e:
+                logger.error("批量写入群组算卦记录失败: %s", e)
+        return len(batch)
+
+    def get_statistics(self) -> Dict[str, int]:
+        """获取共享统计"""
+        return {
+            "computed": self.computed,
+            "shared": self.shared,
+            "pending": len(self._pending)
+        }
+
+    def _prune(self, now: float):
+        """清理过期结果，并保证数量不超过上限"""
+        expired = [key for key, (expires, _) in self._readings.items() if expires <= now]
+        for key in expired:
+            del self._readings[key]
+
+        # 字典按插入顺序保存，超出上限时丢弃最早的结果
+        while len(self._readings) > self.max_entries:
+            del self._readings[next(iter(self._readings))]
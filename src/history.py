@@ -1,16 +1,45 @@
 import os
-import json
-import time
-import fcntl
-from datetime import datetime
-from typing import Dict, List, Any, Optional
+import zlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional, Set, Tuple
+
+from .record import CompactRecord
+from .storage import FileLock, LockTimeout, atomic_write_json, read_json
+from .log import get_logger
+
+logger = get_logger("history")
 
 class HistoryManager:
     """
     用户历史记录管理类，用于保存和读取用户的算卦历史
+
+    历史文件通过原子替换写入，读取无需加锁；追加记录的“读取-修改-写回”
+    在按用户ID分片的文件锁内进行，避免多个进程同时追加时丢失记录。
+
+    最近访问用户的记录缓存在内存 LRU 中，写入时同步更新；启动时扫描一次目录，
+    记下有历史文件的用户，没有历史的用户查询时不访问磁盘。多进程部署时其他
+    进程也会写入，此时缓存项用一次 stat 校验文件是否变化，不使用用户集合。
+
+    历史清理在工作线程中进行，缓存与用户集合的修改由 _cache_lock 保护；读取文件期间
+    若有写入发生，读到的内容不放入缓存，避免旧内容覆盖刚写入的记录。
     """
+
+    # 文件锁分片数
+    LOCK_STRIPES = 64
     
-    def __init__(self, history_dir: str = None):
+    def __init__(self, history_dir: str = None, index=None, max_records: int = 20, archive=None,
+                 text_store=None, cache_size: int = 256, validate_cache: bool = False):
+        """
+        参数:
+            history_dir: 历史记录目录
+            index: 可选的 HistoryIndex，保存记录时同步更新
+            max_records: 每个用户最多保留的记录数
+            archive: 可选的 HistoryArchive，冷用户的记录从中取回
+            text_store: 可选的 TextStore，大语言模型文本去重保存，记录中只存ID
+            cache_size: 内存中缓存记录的用户数，0 表示不缓存
+            validate_cache: 是否在使用缓存前校验文件，多进程共用目录时开启
+        """
         if history_dir is None:
             base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
             self.history_dir = os.path.join(base_dir, "data/history")
@@ -18,6 +47,76 @@ class HistoryManager:
             self.history_dir = history_dir
             
         os.makedirs(self.history_dir, exist_ok=True)
+        self.index = index
+        self.max_records = max(1, int(max_records))
+        self.archive = archive
+        self.text_store = text_store
+        self._locks = [
+            FileLock(os.path.join(self.history_dir, f".stripe{i}")) for i in range(self.LOCK_STRIPES)
+        ]
+
+        # 用户ID -> (文件版本, 原始记录)，文件版本仅在校验模式下使用
+        self.cache_size = max(0, int(cache_size))
+        self.validate_cache = validate_cache
+        self._cache: "OrderedDict[str, Tuple[Any, List[Any]]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # 写入与删除的次数，用于判断读取文件期间缓存是否已被更新
+        self._writes = 0
+        self.cache_stats = {"hits": 0, "misses": 0, "absent": 0}
+        # 有历史文件的用户
+        self._known: Set[str] = set() if validate_cache else self._scan_users()
+
+    def _scan_users(self) -> Set[str]:
+        """扫描历史目录，返回有历史文件的用户ID集合"""
+        with os.scandir(self.history_dir) as entries:
+            return {
+                entry.name[:-len(".json")] for entry in entries
+                if entry.name.endswith(".json") and entry.is_file()
+            }
+
+    def _file_version(self, history_file: str) -> Optional[Tuple[int, int]]:
+        """历史文件的 (inode, 修改时间)，文件不存在时返回 None"""
+        try:
+            st = os.stat(history_file)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    def _remember(self, user_id: str, version: Any, rows: List[Any]):
+        """将用户记录放入缓存，超出容量时淘汰最久未访问的用户"""
+        if not self.cache_size:
+            return
+        with self._cache_lock:
+            self._store(user_id, version, rows)
+
+    def _store(self, user_id: str, version: Any, rows: List[Any]):
+        """持有 _cache_lock 时放入缓存"""
+        self._cache[user_id] = (version, list(rows))
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def forget(self, user_id: str):
+        """用户历史文件被删除后调用，移除缓存与用户集合中的记录"""
+        with self._cache_lock:
+            self._writes += 1
+            self._cache.pop(user_id, None)
+            self._known.discard(user_id)
+
+    def cache_info(self) -> Dict[str, Any]:
+        """缓存命中统计"""
+        lookups = sum(self.cache_stats.values())
+        return dict(
+            self.cache_stats,
+            hit_rate=(self.cache_stats["hits"] + self.cache_stats["absent"]) / lookups if lookups else 0.0,
+            cached=len(self._cache),
+            capacity=self.cache_size,
+            known=len(self._known),
+        )
+
+    def lock(self, user_id: str) -> FileLock:
+        """用户历史文件对应的文件锁"""
+        return self._locks[zlib.crc32(user_id.encode("utf-8")) % self.LOCK_STRIPES]
         
     def save_record(self, user_id: str, question: str, hexagram_data: Dict, interpretation: Dict) -> bool:
         """
@@ -33,63 +132,187 @@ class HistoryManager:
             保存是否成功
         """
         try:
-            # 准备记录数据
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            
-            # 生成结果摘要
-            original_name = interpretation["original"]["name"]
-            changed_name = interpretation["changed"]["name"]
-            has_moving = sum(hexagram_data["moving"]) > 0
-            
-            if has_moving:
-                result_summary = f"{original_name}变{changed_name}，{interpretation.get('fortune', '平')}。{interpretation.get('advice', '')}"
-            else:
-                result_summary = f"{original_name}，{interpretation.get('fortune', '平')}。{interpretation.get('advice', '')}"
-                
-            # 创建记录
-            record = {
-                "timestamp": timestamp,
-                "question": question,
-                "hexagram_original": hexagram_data["hexagram_original"],
-                "hexagram_changed": hexagram_data["hexagram_changed"],
-                "moving": hexagram_data["moving"],
-                "result_summary": result_summary,
-                "interpretation_summary": interpretation.get("overall_meaning", "")
-            }
-            
-            # 读取现有历史数据
-            history_file = os.path.join(self.history_dir, f"{user_id}.json")
-            history = []
-            
-            if os.path.exists(history_file):
-                try:
-                    with open(history_file, "r", encoding="utf-8") as f:
-                        # 获取读取锁
-                        fcntl.flock(f, fcntl.LOCK_SH)
-                        history = json.load(f)
-                        fcntl.flock(f, fcntl.LOCK_UN)
-                except:
-                    history = []
+            record = self._build_record(question, hexagram_data, interpretation)
+            return self._append_records(user_id, [record])
+        except Exception as e:
+            logger.error("保存历史记录失败: %s", e)
+            return False
+
+    def save_records(self, entries: List[Tuple[str, str, Dict, Dict, Optional[int]]]) -> int:
+        """
+        批量保存算卦记录，同一用户的多条记录只读写一次文件
+        
+        参数:
+            entries: (用户ID, 问题, 卦象数据, 卦象解释, 起卦时间戳) 列表，时间戳为 None 时取当前时间
             
+        返回:
+            成功保存的记录数
+        """
+        records: List[Tuple[str, CompactRecord]] = []
+        for user_id, question, hexagram_data, interpretation, ts in entries:
+            try:
+                records.append((user_id, self._build_record(question, hexagram_data, interpretation, ts)))
+            except Exception as e:
+                logger.error("保存历史记录失败: %s", e)
+        return self.save_compact(records)
+
+    def save_compact(self, entries: List[Tuple[str, CompactRecord]]) -> int:
+        """
+        批量保存已生成的紧凑记录，同一用户的多条记录只读写一次文件
+
+        参数:
+            entries: (用户ID, 紧凑记录) 列表
+
+        返回:
+            成功保存的记录数
+        """
+        grouped: Dict[str, List[CompactRecord]] = {}
+        for user_id, record in entries:
+            grouped.setdefault(user_id, []).append(record)
+
+        saved = 0
+        for user_id, records in grouped.items():
+            if self._append_records(user_id, records):
+                saved += len(records)
+        return saved
+
+    def _build_record(self, question: str, hexagram_data: Dict, interpretation: Dict,
+                      ts: Optional[int] = None) -> CompactRecord:
+        """根据卦象数据与解释生成一条紧凑记录"""
+        return CompactRecord.from_reading(question, hexagram_data, interpretation, ts)
+
+    def _append_records(self, user_id: str, records: List[CompactRecord]) -> bool:
+        """将记录追加到用户历史文件"""
+        try:
+            with self.lock(user_id).write():
+                return self._append_locked(user_id, records)
+        except LockTimeout as e:
+            logger.error("保存历史记录失败: %s", e)
+            return False
+
+    def _append_locked(self, user_id: str, records: List[CompactRecord]) -> bool:
+        """持有文件锁时追加记录"""
+        try:
+            # 读取现有历史数据，冷用户从归档中取回
+            history = self.load_rows(user_id)
+            if not history and self.archive is not None and user_id in self.archive:
+                history = self.archive.restore(user_id)
+
+            # 旧版字典记录在写回时转换为紧凑格式
+            history = [row if isinstance(row, list) else CompactRecord.from_dict(row).to_row() for row in history]
+
+            # 大语言模型文本存入文本存储，记录中只保留ID
+            expanded = [record.to_dict() for record in records]
+            if self.text_store is not None:
+                for record in records:
+                    if isinstance(record.llm, list):
+                        record.llm = self.text_store.put(record.llm)
+
             # 添加新记录
-            history.append(record)
+            existing = len(history)
+            history.extend(record.to_row() for record in records)
             
-            # 如果记录过多，只保留最近的20条
-            if len(history) > 20:
-                history = history[-20:]
+            # 如果记录过多，只保留最近的记录
+            trimmed = []
+            if len(history) > self.max_records:
+                trimmed = history[:-self.max_records]
+                self.release_rows(trimmed)
+                history = history[-self.max_records:]
                 
             # 保存回文件
-            with open(history_file, "w", encoding="utf-8") as f:
-                # 获取写入锁
-                fcntl.flock(f, fcntl.LOCK_EX)
-                json.dump(history, f, ensure_ascii=False, indent=2)
-                fcntl.flock(f, fcntl.LOCK_UN)
+            if not self.write_rows(user_id, history):
+                return False
+
+            # 同步更新检索索引：移除被裁剪的旧记录，新记录中被裁剪的不再加入
+            if self.index is not None:
+                self.unindex_rows(user_id, trimmed[:existing])
+                for record in expanded[max(0, len(trimmed) - existing):]:
+                    self.index.add(user_id, record)
                 
             return True
             
         except Exception as e:
-            print(f"保存历史记录失败: {str(e)}")
+            logger.error("保存历史记录失败: %s", e)
             return False
+
+    def release_rows(self, rows: List[Any]):
+        """释放被删除记录对文本存储的引用"""
+        if self.text_store is None:
+            return
+        for row in rows:
+            if isinstance(row, list) and len(row) > 6 and isinstance(row[6], str):
+                self.text_store.release(row[6])
+
+    def unindex_rows(self, user_id: str, rows: List[Any]):
+        """从检索索引中移除被删除的记录"""
+        if self.index is not None and rows:
+            self.index.remove(user_id, [CompactRecord.from_row(row).ts for row in rows])
+
+    def expand(self, row: Any) -> Dict:
+        """将文件中的一项记录展开为字典，文本引用在此解析"""
+        resolve = self.text_store.get if self.text_store is not None else None
+        return CompactRecord.from_row(row).to_dict(resolve)
+
+    def load_rows(self, user_id: str) -> List[Any]:
+        """读取用户历史文件中的原始记录，文件不存在或损坏时返回空列表"""
+        if not self.validate_cache and user_id not in self._known:
+            self.cache_stats["absent"] += 1
+            return []
+
+        history_file = os.path.join(self.history_dir, f"{user_id}.json")
+        version = None
+        if self.validate_cache:
+            version = self._file_version(history_file)
+            if version is None:
+                with self._cache_lock:
+                    self._cache.pop(user_id, None)
+                self.cache_stats["absent"] += 1
+                return []
+
+        with self._cache_lock:
+            cached = self._cache.get(user_id)
+            if cached is not None and cached[0] == version:
+                self._cache.move_to_end(user_id)
+                self.cache_stats["hits"] += 1
+                return list(cached[1])
+            writes = self._writes
+
+        self.cache_stats["misses"] += 1
+        try:
+            rows = read_json(history_file, [])
+        except Exception as e:
+            logger.error("读取历史记录失败: %s", e)
+            return []
+        if not rows and not self.validate_cache and not os.path.exists(history_file):
+            # 文件已被外部删除
+            self.forget(user_id)
+            return []
+        if self.cache_size:
+            with self._cache_lock:
+                if self._writes == writes:
+                    self._store(user_id, version, rows)
+        return rows
+
+    def write_rows(self, user_id: str, rows: List[Any]) -> bool:
+        """将原始记录写回用户历史文件"""
+        history_file = os.path.join(self.history_dir, f"{user_id}.json")
+        try:
+            atomic_write_json(history_file, rows)
+        except Exception as e:
+            with self._cache_lock:
+                self._writes += 1
+                self._cache.pop(user_id, None)
+            logger.error("保存历史记录失败: %s", e)
+            return False
+        # 写入时同步更新缓存
+        version = self._file_version(history_file) if self.validate_cache else None
+        with self._cache_lock:
+            self._writes += 1
+            if not self.validate_cache:
+                self._known.add(user_id)
+            if self.cache_size:
+                self._store(user_id, version, rows)
+        return True
             
     def get_recent_records(self, user_id: str, limit: int = 5) -> List[Dict]:
         """
@@ -102,25 +325,39 @@ class HistoryManager:
         返回:
             记录列表，从新到旧排序
         """
-        history_file = os.path.join(self.history_dir, f"{user_id}.json")
-        
-        if not os.path.exists(history_file):
-            return []
-            
-        try:
-            with open(history_file, "r", encoding="utf-8") as f:
-                # 获取读取锁
-                fcntl.flock(f, fcntl.LOCK_SH)
-                history = json.load(f)
-                fcntl.flock(f, fcntl.LOCK_UN)
-                
-            # 返回最近的n条记录
-            return history[-limit:][::-1]
-            
-        except Exception as e:
-            print(f"读取历史记录失败: {str(e)}")
-            return []
+        history = self.load_rows(user_id)
+        if not history and self.archive is not None and user_id in self.archive:
+            history = self.archive.load(user_id)
+
+        # 返回最近的n条记录，只展开需要返回的记录
+        return [self.expand(row) for row in history[-limit:][::-1]]
             
+    def iter_records(self):
+        """
+        逐个用户遍历全部历史记录，每次只读取一个文件
+        
+        返回:
+            (用户ID, 记录) 的生成器，同一用户的记录从旧到新
+        """
+        with os.scandir(self.history_dir) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.endswith(".json"):
+                    continue
+                user_id = entry.name[:-len(".json")]
+                try:
+                    history = read_json(entry.path, [])
+                except Exception as e:
+                    logger.error("读取历史记录失败: %s", e)
+                    continue
+                for row in history:
+                    yield user_id, self.expand(row)
+
+        # 冷归档中的用户
+        if self.archive is not None:
+            for user_id, rows in self.archive.iter_users():
+                for row in rows:
+                    yield user_id, self.expand(row)
+
     def get_record_by_index(self, user_id: str, index: int) -> Optional[Dict]:
         """
         根据索引获取特定的历史记录
@@ -132,7 +369,7 @@ class HistoryManager:
         返回:
             记录数据，如果不存在则返回None
         """
-        records = self.get_recent_records(user_id, limit=20)
+        records = self.get_recent_records(user_id, limit=self.max_records)
         
         if not records or index <= 0 or index > len(records):
             return None
@@ -150,12 +387,26 @@ class HistoryManager:
             操作是否成功
         """
         history_file = os.path.join(self.history_dir, f"{user_id}.json")
-        
-        if os.path.exists(history_file):
-            try:
-                os.remove(history_file)
-                return True
-            except Exception as e:
-                print(f"清除历史记录失败: {str(e)}")
+        cleared = False
+
+        try:
+            # 与追加写入、保留期清理互斥
+            with self.lock(user_id).write():
+                # 同时移除冷归档中的记录
+                if self.archive is not None and user_id in self.archive:
+                    self.release_rows(self.archive.restore(user_id))
+                    cleared = True
+
+                if os.path.exists(history_file):
+                    self.release_rows(self.load_rows(user_id))
+                    os.remove(history_file)
+                    self.forget(user_id)
+                    cleared = True
+        except Exception as e:
+            logger.error("清除历史记录失败: %s", e)
+
+        # 检索与相似查询不再返回该用户的记录
+        if cleared and self.index is not None:
+            self.index.remove_user(user_id)
                 
-        return False
+        return cleared
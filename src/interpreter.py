@@ -1,20 +1,41 @@
 import os
-import json
-import fcntl
+import time
 import asyncio
-from typing import Dict, List, Any, Optional
-from astrbot.api import logger
+from typing import Dict, List, Any, Optional, Tuple
+
+from .record import static_advice
+from .coordinator import LLMCache
+from .scheduler import SchedulerBusy
+from .rules import moving_mask, governing_refs, rule_name, resolve
+from .data_constants import (
+    HEXAGRAM_MAP, HEXAGRAM_NAMES, HEXAGRAM_BINARY, TRIGRAMS,
+    NUCLEAR, INVERSE, OPPOSITE, LOWER_TRIGRAM, UPPER_TRIGRAM
+)
+from .storage import atomic_write_json, read_json
+from .log import get_logger
+
+logger = get_logger("interpreter")
 
 class HexagramInterpreter:
     """
     卦象解释器，负责提供卦象的名称、爻辞、解释等内容
     """
+
+    SYSTEM_PROMPT = "你是一个专业、知识丰富的算命先生，擅长提供深入且简洁的解析。"
     
     def __init__(self, config: Dict, base_dir=None):
         self.config = config
         self.base_dir = base_dir if base_dir else os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
         self.hexagrams_data = {}  # 卦象静态数据
         self.data_loaded = False
+        # 大语言模型解释缓存，需提供异步的 get_llm(key) / put_llm(key, value)，如 SharedState
+        self.llm_cache = None
+        # 大语言模型请求调度器，需提供异步的 run(user_id, job)，如 RequestScheduler
+        self.scheduler = None
+        # 预生成的通用解释表（PregenStore），无问题时直接使用，繁忙时作为后备
+        self.pregen = None
+        # 是否在解释与提示词中加入上下卦、互卦、综卦、错卦
+        self.show_relations = (config.get("display", {}) or {}).get("relations", True)
     
     async def load_data(self):
         """加载卦象静态数据"""
@@ -30,16 +51,10 @@ class HexagramInterpreter:
             
         # 加载数据
         try:
-            with open(data_file, "r", encoding="utf-8") as f:
-                # 获取文件锁
-                fcntl.flock(f, fcntl.LOCK_SH)
-                self.hexagrams_data = json.load(f)
-                # 释放文件锁
-                fcntl.flock(f, fcntl.LOCK_UN)
-                
+            self.hexagrams_data = read_json(data_file, {})
             self.data_loaded = True
         except Exception as e:
-            print(f"加载卦象数据失败: {str(e)}")
+            logger.error("加载卦象数据失败: %s", e)
             self.hexagrams_data = {}
             
     async def _create_default_data(self, file_path: str):
@@ -78,15 +93,11 @@ class HexagramInterpreter:
         }
         
         # 写入文件
-        with open(file_path, "w", encoding="utf-8") as f:
-            # 获取文件锁
-            fcntl.flock(f, fcntl.LOCK_EX)
-            json.dump(default_data, f, ensure_ascii=False, indent=2)
-            # 释放文件锁
-            fcntl.flock(f, fcntl.LOCK_UN)
+        atomic_write_json(file_path, default_data, indent=2)
             
     async def interpret(self, hexagram_original: int, hexagram_changed: int, 
-                       moving: List[int], question: str, use_llm: bool, context) -> Dict[str, Any]:
+                       moving: List[int], question: str, use_llm: bool, context,
+                       user_id: str = "", cached_only: bool = False) -> Dict[str, Any]:
         """
         解释卦象
         
@@ -96,6 +107,8 @@ class HexagramInterpreter:
             moving: 动爻列表
             question: 用户原始问题
             use_llm: 是否使用大语言模型
+            user_id: 提问用户，调用大语言模型时用于公平排队
+            cached_only: 只使用缓存或预生成的解释，不调用大语言模型（过载降级时）
             
         返回:
             卦象解释信息的字典
@@ -125,44 +138,166 @@ class HexagramInterpreter:
         })
         
         # 获取动爻的爻辞
-        moving_lines_meaning = []
-        has_moving = False
-        for i in range(6):
-            if moving[i] == 1:
-                has_moving = True
-                # 爻辞从下往上排列，第一爻为初爻
-                line_index = i
-                if line_index < len(original_data["lines"]):
-                    moving_lines_meaning.append(original_data["lines"][line_index])
-                else:
-                    moving_lines_meaning.append("无爻辞。")
-            else:
-                moving_lines_meaning.append("")
+        moving_lines_meaning = self._moving_texts(original_data, moving)
+        has_moving = any(moving_lines_meaning)
                 
+        # 按动爻数查表确定占断依据
+        mask = moving_mask(moving)
+        governing = [
+            resolve(ref, original_data, changed_data if has_moving else None)
+            for ref in governing_refs(hexagram_original, mask)
+        ]
+
+        relations = self.relations(hexagram_original) if self.show_relations else None
+
         # 生成综合解释
         overall_meaning = self._generate_overall_meaning(original_data, changed_data if has_moving else None)
         
         # 如果配置了使用大语言模型，则调用API获取更详细的解释
         llm_interpretation = {}
+        pregenerated = None
+        llm_seconds = 0.0
 
         if use_llm and question:
-            llm_interpretation = await self._get_llm_interpretation(context,
-                question, original_data["name"], changed_data["name"] if has_moving else None, 
-                moving_lines_meaning
-            )
+            cache_key = LLMCache.make_key(hexagram_original, hexagram_changed, moving, question)
+            if self.llm_cache is not None:
+                llm_interpretation = await self.llm_cache.get_llm(cache_key) or {}
+
+            # 工作池繁忙或过载降级时优先使用预生成的通用解释，不再排队
+            if not llm_interpretation and (cached_only or self.scheduler is not None and self.scheduler.saturated()):
+                pregenerated = self._pregenerated(hexagram_original, mask)
+
+            if not llm_interpretation and not pregenerated and not cached_only:
+                # 只有真正调用大语言模型时才进入工作池排队，缓存命中直接返回
+                async def fetch():
+                    nonlocal llm_seconds
+                    started = time.monotonic()
+                    try:
+                        return await self._get_llm_interpretation(context,
+                            question, original_data["name"], changed_data["name"] if has_moving else None, 
+                            moving_lines_meaning, governing, relations
+                        )
+                    finally:
+                        llm_seconds = time.monotonic() - started
+                try:
+                    if self.scheduler is not None:
+                        llm_interpretation = await self.scheduler.run(user_id, fetch)
+                    else:
+                        llm_interpretation = await fetch()
+                except SchedulerBusy:
+                    pregenerated = self._pregenerated(hexagram_original, mask)
+                    if not pregenerated:
+                        raise
+                if llm_interpretation and self.llm_cache is not None:
+                    await self.llm_cache.put_llm(cache_key, llm_interpretation)
+                elif not llm_interpretation:
+                    # 调用失败时退回预生成的通用解释
+                    pregenerated = self._pregenerated(hexagram_original, mask)
+        else:
+            # 无问题或未启用大语言模型时使用预生成的通用解释
+            pregenerated = self._pregenerated(hexagram_original, mask)
+
+        if pregenerated:
+            llm_interpretation = pregenerated
             
         # 组合解释
         result = {
             "original": original_data,
             "changed": changed_data if has_moving else original_data,
             "moving_lines_meaning": moving_lines_meaning,
+            "governing": governing,
+            "rule": rule_name(hexagram_original, mask),
+            "relations": relations,
             "overall_meaning": llm_interpretation.get("overall_meaning", overall_meaning),
             "fortune": llm_interpretation.get("fortune", self._determine_fortune(original_data, changed_data if has_moving else None)),
-            "advice": llm_interpretation.get("advice", self._generate_advice(original_data, changed_data if has_moving else None))
+            "advice": llm_interpretation.get("advice", self._generate_advice(original_data, changed_data if has_moving else None)),
+            "llm_generated": bool(llm_interpretation),
+            "pregenerated": bool(pregenerated),
+            "llm_seconds": llm_seconds
         }
         
         return result
     
+    def _moving_texts(self, original_data: Dict, moving: List[int]) -> List[str]:
+        """动爻的爻辞，静爻位置为空字符串"""
+        lines = original_data["lines"]
+        texts = []
+        for i in range(6):
+            if moving[i] == 1:
+                # 爻辞从下往上排列，第一爻为初爻
+                texts.append(lines[i] if i < len(lines) else "无爻辞。")
+            else:
+                texts.append("")
+        return texts
+
+    def _pregenerated(self, number: int, mask: int) -> Optional[Dict[str, str]]:
+        """查询预生成的通用解释"""
+        if self.pregen is None:
+            return None
+        return self.pregen.get(number, mask)
+
+    async def generate_generic(self, number: int, mask: int, context) -> Dict[str, str]:
+        """
+        调用大语言模型生成不针对具体问题的通用解释，供预生成任务使用
+
+        参数:
+            number: 本卦卦序(1-64)
+            mask: 动爻掩码
+
+        返回:
+            与问题解读相同格式的字典，失败时为空字典
+        """
+        if not self.data_loaded:
+            await self.load_data()
+        original_data = self.hexagrams_data.get(str(number))
+        if original_data is None:
+            return {}
+        moving = [mask >> i & 1 for i in range(6)]
+        changed_data = None
+        if mask:
+            changed_number = HEXAGRAM_MAP[HEXAGRAM_BINARY[number] ^ mask]
+            changed_data = self.hexagrams_data.get(str(changed_number))
+        governing = [resolve(ref, original_data, changed_data) for ref in governing_refs(number, mask)]
+        relations = self.relations(number) if self.show_relations else None
+        return await self._get_llm_interpretation(
+            context, "", original_data["name"], changed_data["name"] if changed_data else None,
+            self._moving_texts(original_data, moving), governing, relations
+        )
+
+    @staticmethod
+    def relations(number: int) -> Optional[Dict[str, Any]]:
+        """
+        卦的上下卦与互卦、综卦、错卦，全部查表得到
+
+        参数:
+            number: 卦序(1-64)
+
+        返回:
+            {"upper", "lower"}: 上下卦的 (符号, 卦名, 象)；
+            {"nuclear", "inverse", "opposite"}: 对应卦序；卦序无效时返回 None
+        """
+        if not 1 <= number <= 64:
+            return None
+        binary = HEXAGRAM_BINARY[number]
+        return {
+            "upper": TRIGRAMS[UPPER_TRIGRAM[binary]],
+            "lower": TRIGRAMS[LOWER_TRIGRAM[binary]],
+            "nuclear": HEXAGRAM_MAP[NUCLEAR[binary]],
+            "inverse": HEXAGRAM_MAP[INVERSE[binary]],
+            "opposite": HEXAGRAM_MAP[OPPOSITE[binary]],
+        }
+
+    @staticmethod
+    def describe_relations(relations: Dict[str, Any]) -> List[str]:
+        """上下卦与互、综、错卦的文字说明，每项一行"""
+        upper, lower = relations["upper"], relations["lower"]
+        return [
+            f"上卦{upper[1]}（{upper[2]}），下卦{lower[1]}（{lower[2]}）",
+            f"互卦: {HEXAGRAM_NAMES[relations['nuclear']]}",
+            f"综卦: {HEXAGRAM_NAMES[relations['inverse']]}",
+            f"错卦: {HEXAGRAM_NAMES[relations['opposite']]}",
+        ]
+
     def _generate_overall_meaning(self, original_data: Dict, changed_data: Optional[Dict]) -> str:
         """生成综合解释文字"""
         if not changed_data:
@@ -187,27 +322,26 @@ class HexagramInterpreter:
     def _generate_advice(self, original_data: Dict, changed_data: Optional[Dict]) -> str:
         """生成建议"""
         # 简单实现，实际可能需要更复杂的规则
-        if not changed_data:
-            return f"请参考{original_data['name']}卦的卦辞进行决策。"
-        else:
-            return f"正处于从{original_data['name']}到{changed_data['name']}的变化过程中，建议关注变化的动向，顺势而为。"
+        return static_advice(original_data['name'], changed_data['name'] if changed_data else None)
             
     async def _get_llm_interpretation(self, context, question: str, original_name: str,
-                                    changed_name: Optional[str], moving_lines: List[str]) -> Dict[str, str]:
+                                    changed_name: Optional[str], moving_lines: List[str],
+                                    governing: Optional[List[str]] = None,
+                                    relations: Optional[Dict[str, Any]] = None) -> Dict[str, str]:
         """
         使用大语言模型生成更个性化的卦象解释
         """
         try:
             # 构建提示词
             logger.info("正在使用大语言模型生成卦象解释...")
-            prompt = self._build_llm_prompt(question, original_name, changed_name, moving_lines)
+            prompt = self._build_llm_prompt(question, original_name, changed_name, moving_lines, governing, relations)
             
             llm_response = await context.get_using_provider().text_chat(
                 prompt=prompt,
                 session_id=None,
                 contexts=[],
                 image_urls=[],
-                system_prompt="你是一个专业、知识丰富的算命先生，擅长提供深入且简洁的解析。"
+                system_prompt=self.SYSTEM_PROMPT
             )
             logger.info("大语言模型生成卦象解释完成。")
 
@@ -305,31 +439,99 @@ class HexagramInterpreter:
             }
                 
         except Exception as e:
-            print(f"调用大语言模型API出错: {str(e)}")
-            import traceback
-            print(traceback.format_exc())
+            logger.exception("调用大语言模型API出错: %s", e)
             return {}
 
+    @staticmethod
+    def followup_context(question: str, interpretation: Dict[str, Any]) -> Tuple[str, str]:
+        """
+        由一次解卦结果生成追问所需的上下文
+
+        返回:
+            (卦象摘要, 解读)，分别作为追问时 contexts 中的 user 与 assistant 消息；
+            只保留卦名与占断依据，不含动爻全文与输出格式要求
+        """
+        original = interpretation["original"]["name"]
+        changed = interpretation["changed"]["name"]
+        summary = [
+            f"问题「{question}」" if question else "随缘一卦",
+            f"原卦: {original}" + (f"，变卦: {changed}" if changed != original else ""),
+        ]
+        governing = interpretation.get("governing") or []
+        if governing:
+            summary.append(f"占断依据（{interpretation.get('rule', '')}）:")
+            summary.extend(f"- {text}" for text in governing)
+        reply = "\n\n".join((
+            f"整体意义：{interpretation.get('overall_meaning', '')}",
+            f"吉凶：{interpretation.get('fortune', '平')}",
+            f"建议：{interpretation.get('advice', '')}",
+        ))
+        return "\n".join(summary), reply
+
+    async def follow_up(self, context, messages: List[Dict[str, str]], question: str,
+                        user_id: str = "") -> str:
+        """
+        针对上一次解卦追问，之前的卦象与问答作为 contexts 传入，提示词只包含新问题
+
+        参数:
+            messages: 追问上下文（FollowUpCache.messages）
+            question: 追问内容
+            user_id: 提问用户，用于公平排队
+
+        返回:
+            回答文本，失败时为空字符串；工作池排队已满时抛出 SchedulerBusy
+        """
+        prompt = f"追问：{question}\n请结合上面的卦象与解读直接回答（150字以内），不必重复卦象内容。"
+
+        async def fetch():
+            try:
+                llm_response = await context.get_using_provider().text_chat(
+                    prompt=prompt,
+                    session_id=None,
+                    contexts=messages,
+                    image_urls=[],
+                    system_prompt=self.SYSTEM_PROMPT
+                )
+                return llm_response.completion_text.strip()
+            except Exception as e:
+                logger.exception("追问调用大语言模型出错: %s", e)
+                return ""
+
+        if self.scheduler is not None:
+            return await self.scheduler.run(user_id, fetch, name="followup")
+        return await fetch()
+
     def _build_llm_prompt(self, question: str, original_name: str, 
-                         changed_name: Optional[str], moving_lines: List[str]) -> str:
+                         changed_name: Optional[str], moving_lines: List[str],
+                         governing: Optional[List[str]] = None,
+                         relations: Optional[Dict[str, Any]] = None) -> str:
         """构建提示词"""
         prompt = [
-            f"请基于以下易经卦象信息，对问题「{question}」进行解读:",
+            f"请基于以下易经卦象信息，对问题「{question}」进行解读:" if question
+            else "请基于以下易经卦象信息，给出不针对具体问题、适用于各类占问的通用解读:",
             f"原卦: {original_name}"
         ]
         
         if changed_name:
             prompt.append(f"变卦: {changed_name}")
+
+        if relations:
+            prompt.extend(self.describe_relations(relations))
             
         moving_text = [line for line in moving_lines if line]
         if moving_text:
             prompt.append("动爻:")
             for line in moving_text:
                 prompt.append(f"- {line}")
+
+        if governing:
+            prompt.append("占断依据（按朱熹《易学启蒙》的动爻规则，以第一条为主）:")
+            for text in governing:
+                prompt.append(f"- {text}")
                 
         prompt.append("\n请提供:")
         prompt.append("1. 整体意义解读（200字以内）")
         prompt.append("2. 吉凶判断（必须在如下三个选项之中：吉/凶/平）")
-        prompt.append("3. 针对问题的具体建议（100字以内）")
+        prompt.append("3. 针对问题的具体建议（100字以内）" if question else "3. 通用的行事建议（100字以内）")
         
         return "\n".join(prompt)
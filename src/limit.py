@@ -1,254 +1,316 @@
 import os
-import json
+import sys
 import time
-import fcntl
+import struct
+from array import array
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
+
+from .storage import atomic_write, read_json
+from .log import get_logger
+
+logger = get_logger("limit")
 
 class UsageLimit:
     """
     用户使用限制类，管理每日算卦次数限制
+
+    用户ID驻留为连续的整数槽位，当日次数与最后使用时间分别存放在
+    array('H') 与 array('I')（Unix 秒）中，每个用户约占一百余字节（主要是ID字典）。
+    数据以二进制快照 daily_usage.bin 保存：
+
+        头部   魔数 "OLU1"、重置日期 YYYYMMDD (uint32)、用户数 n (uint32)
+        次数   n × uint16
+        时间   n × uint32
+        ID长度 n × uint16
+        ID     UTF-8 编码依次拼接
+
+    ID 的编码在驻留时追加到缓冲区，保存时无需重新序列化。
+    旧版的 daily_usage.json 在首次加载时转换。
     """
-    
+
+    MAGIC = b"OLU1"
+    HEADER = struct.Struct("<4sII")
+
+    # uint16 次数上限
+    MAX_COUNT = 0xFFFF
+
     def __init__(self, config: Dict, limit_dir: str = None):
         self.config = config
-        
+
         if limit_dir is None:
             base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
             self.limit_dir = os.path.join(base_dir, "data/limits")
         else:
             self.limit_dir = limit_dir
-            
-        self.limit_file = os.path.join(self.limit_dir, "daily_usage.json")
-        
+
+        self.limit_file = os.path.join(self.limit_dir, "daily_usage.bin")
+        self.legacy_file = os.path.join(self.limit_dir, "daily_usage.json")
+
         # 确保目录存在
         os.makedirs(self.limit_dir, exist_ok=True)
-        
+
         # 加载使用数据
-        self.usage_data = self._load_usage_data()
-        
+        self._clear(self._get_current_date())
+        self._version = None
+        self.reload()
+
         # 检查是否需要重置
         self._check_reset()
-        
-        # 文件锁，用于确保多进程安全
-        self.file_lock = None
-    
-    def _load_usage_data(self) -> Dict:
-        """加载使用数据文件，并确保用户 ID 的唯一性"""
-        if os.path.exists(self.limit_file):
-            try:
-                with open(self.limit_file, "r", encoding="utf-8") as f:
-                    # 获取文件锁
-                    fcntl.flock(f, fcntl.LOCK_SH)
-                    # 读取数据
-                    data = json.load(f)
-                    # 释放文件锁
-                    fcntl.flock(f, fcntl.LOCK_UN)
-                    
-                    # 确保 users 字典存在
-                    if "users" not in data:
-                        data["users"] = {}
-                    
-                    # 去重处理，确保用户 ID 唯一且为字符串类型
-                    unique_users = {}
-                    for user_id, user_data in data["users"].items():
-                        unique_users[str(user_id)] = user_data
-                    
-                    data["users"] = unique_users
-                    return data
-            except Exception as e:
-                print(f"加载使用数据失败: {str(e)}")
-                return {"last_reset": self._get_current_date(), "users": {}}
-        else:
-            return {"last_reset": self._get_current_date(), "users": {}}
-            
+
+    def _clear(self, last_reset: str):
+        """清空全部用户数据"""
+        self.last_reset = last_reset
+        # 用户ID -> 槽位，以及槽位 -> 用户ID
+        self.slots: Dict[str, int] = {}
+        self.user_ids: List[str] = []
+        self.counts = array("H")
+        self.last_usage = array("I")
+        self._id_lengths = array("H")
+        self._id_blob = bytearray()
+        self._total = 0
+        # 下次需要检查日期的时间，置 0 表示下次调用时立即检查
+        self._reset_at = 0.0
+
+    def _slot(self, user_id: str) -> int:
+        """获取用户槽位，不存在时分配新槽位"""
+        slot = self.slots.get(user_id)
+        if slot is None:
+            user_id = sys.intern(user_id)
+            encoded = user_id.encode("utf-8")
+            slot = len(self.user_ids)
+            self.slots[user_id] = slot
+            self.user_ids.append(user_id)
+            self.counts.append(0)
+            self.last_usage.append(0)
+            self._id_lengths.append(len(encoded))
+            self._id_blob += encoded
+        return slot
+
+    def _count(self, user_id: str) -> int:
+        slot = self.slots.get(user_id)
+        return 0 if slot is None else self.counts[slot]
+
+    def reload(self):
+        """快照文件有变化时重新加载（其他进程写入后调用）"""
+        version = self._stat()
+        if version is not None and version == self._version:
+            return
+        try:
+            if version is not None:
+                with open(self.limit_file, "rb") as f:
+                    self._load_snapshot(f.read())
+            else:
+                self._load_legacy()
+            self._version = version
+        except Exception as e:
+            logger.error("加载使用数据失败: %s", e)
+
+    def _stat(self) -> Optional[Tuple[int, int, int]]:
+        """快照文件的 (inode, 修改时间, 大小)，每次原子替换都会变化"""
+        try:
+            st = os.stat(self.limit_file)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _load_snapshot(self, data: bytes):
+        """解析二进制快照"""
+        magic, reset_date, n = self.HEADER.unpack_from(data)
+        if magic != self.MAGIC:
+            raise ValueError("使用数据文件格式不正确")
+        last_reset = f"{reset_date // 10000:04d}-{reset_date // 100 % 100:02d}-{reset_date % 100:02d}"
+        self._clear(last_reset)
+
+        pos = self.HEADER.size
+        self.counts.frombytes(data[pos:pos + 2 * n])
+        pos += 2 * n
+        self.last_usage.frombytes(data[pos:pos + 4 * n])
+        pos += 4 * n
+        self._id_lengths.frombytes(data[pos:pos + 2 * n])
+        pos += 2 * n
+        self._id_blob = bytearray(data[pos:])
+
+        blob = self._id_blob
+        user_ids = self.user_ids
+        start = 0
+        for length in self._id_lengths:
+            user_ids.append(sys.intern(blob[start:start + length].decode("utf-8")))
+            start += length
+        self.slots = {user_id: slot for slot, user_id in enumerate(user_ids)}
+        self._total = sum(self.counts)
+
+    def _load_legacy(self):
+        """读取旧版 JSON 格式的使用数据"""
+        data = read_json(self.legacy_file)
+        if data is None:
+            return
+        self._clear(data.get("last_reset", self._get_current_date()))
+        for user_id, user_data in (data.get("users") or {}).items():
+            slot = self._slot(str(user_id))
+            count = min(self.MAX_COUNT, int(user_data.get("count", 0)))
+            self.counts[slot] = count
+            self._total += count
+            last_usage = user_data.get("last_usage")
+            if last_usage:
+                try:
+                    self.last_usage[slot] = int(datetime.strptime(last_usage, "%Y-%m-%d %H:%M:%S").timestamp())
+                except ValueError:
+                    pass
+
+    def _snapshot(self) -> bytes:
+        """生成二进制快照"""
+        reset_date = int(self.last_reset.replace("-", ""))
+        return b"".join((
+            self.HEADER.pack(self.MAGIC, reset_date, len(self.user_ids)),
+            self.counts.tobytes(),
+            self.last_usage.tobytes(),
+            self._id_lengths.tobytes(),
+            self._id_blob,
+        ))
+
     def _save_usage_data(self):
         """保存使用数据到文件"""
         try:
-            # 在保存之前去重，确保用户 ID 唯一
-            unique_users = {}
-            for user_id, user_data in self.usage_data["users"].items():
-                # 确保用户ID始终是字符串类型
-                user_id_str = str(user_id)
-                unique_users[user_id_str] = user_data
-            
-            self.usage_data["users"] = unique_users
-
-            # 使用文件锁确保文件写入的原子性
-            with open(self.limit_file, "w", encoding="utf-8") as f:
-                # 获取文件锁
-                fcntl.flock(f, fcntl.LOCK_EX)
-                # 写入数据
-                json.dump(self.usage_data, f, ensure_ascii=False, indent=2)
-                # 释放文件锁
-                fcntl.flock(f, fcntl.LOCK_UN)
-                
+            # 原子替换，其他进程不会读到写了一半的文件
+            atomic_write(self.limit_file, self._snapshot())
+            self._version = self._stat()
+            # 转换完成后移除旧版文件
+            if os.path.exists(self.legacy_file):
+                os.remove(self.legacy_file)
+
         except Exception as e:
-            print(f"保存使用数据失败: {str(e)}")
-            
+            logger.error("保存使用数据失败: %s", e)
+
     def _get_current_date(self) -> str:
         """获取当前日期字符串（东八区时间）"""
         # 使用UTC+8时间
         now = datetime.utcnow() + timedelta(hours=8)
         return now.strftime("%Y-%m-%d")
-        
+
+    def _next_reset_timestamp(self) -> float:
+        """下一个东八区0点的 Unix 时间戳"""
+        return (time.time() + 8 * 3600) // 86400 * 86400 + 86400 - 8 * 3600
+
     def _check_reset(self):
         """检查是否需要重置使用次数（每天0点）"""
+        # 未到下一个0点时无需格式化日期
+        if time.time() < self._reset_at:
+            return
         current_date = self._get_current_date()
-        last_reset = self.usage_data.get("last_reset", "")
-        
-        if current_date != last_reset:
+        if current_date != self.last_reset:
             # 重置所有用户的使用次数
-            self.usage_data["users"] = {}
-            self.usage_data["last_reset"] = current_date
+            self._clear(current_date)
             self._save_usage_data()
-            
+        self._reset_at = self._next_reset_timestamp()
+
     def check_user_limit(self, user_id: str) -> bool:
         """
         检查用户是否超过当日使用限制
-        
+
         参数:
             user_id: 用户ID
-            
+
         返回:
             True: 未超过限制，可以使用
             False: 已超过限制，不可使用
         """
         # 检查是否需要重置
         self._check_reset()
-        
-        # 确保用户ID是字符串类型
-        user_id_str = str(user_id)
-        
-        # 获取用户的使用情况
-        user_data = self.usage_data.get("users", {}).get(user_id_str, {"count": 0})
-        count = user_data.get("count", 0)
-        
+
         # 检查是否超过限制
         max_count = self.config.get("limit", {}).get("daily_max", 3)
-        return count < max_count
-        
-    def update_usage(self, user_id: str):
+        return self._count(str(user_id)) < max_count
+
+    def update_usage(self, user_id: str, persist: bool = True):
         """
         更新用户的使用次数
-        
+
         参数:
             user_id: 用户ID
+            persist: 是否立即写入文件；为 False 时需稍后调用 save 批量写入
         """
         # 检查是否需要重置
         self._check_reset()
-        
-        # 确保用户ID是字符串类型
-        user_id_str = str(user_id)
-        
-        # 确保users字典存在
-        if "users" not in self.usage_data:
-            self.usage_data["users"] = {}
-            
-        # 获取用户数据
-        user_data = self.usage_data["users"].get(user_id_str, {"count": 0})
-        
+
         # 增加使用次数
-        user_data["count"] = user_data.get("count", 0) + 1
-        user_data["last_usage"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        # 更新用户数据
-        self.usage_data["users"][user_id_str] = user_data
-        
+        slot = self._slot(str(user_id))
+        if self.counts[slot] < self.MAX_COUNT:
+            self.counts[slot] += 1
+            self._total += 1
+        self.last_usage[slot] = int(time.time())
+
         # 保存数据
+        if persist:
+            self._save_usage_data()
+
+    def save(self):
+        """将内存中的使用数据写入文件"""
         self._save_usage_data()
-        
+
     def get_remaining(self, user_id: str) -> int:
         """
         获取用户当日剩余使用次数
-        
+
         参数:
             user_id: 用户ID
-            
+
         返回:
             剩余次数
         """
         # 检查是否需要重置
         self._check_reset()
-        
-        # 确保用户ID是字符串类型
-        user_id_str = str(user_id)
-        
-        # 获取用户的使用情况
-        user_data = self.usage_data.get("users", {}).get(user_id_str, {"count": 0})
-        count = user_data.get("count", 0)
-        
+
         # 计算剩余次数
         max_count = self.config.get("limit", {}).get("daily_max", 3)
-        return max(0, max_count - count)
-        
+        return max(0, max_count - self._count(str(user_id)))
+
     def reset_user(self, user_id: str):
         """
         重置指定用户的使用次数（将 count 设为 0，更新时间为当前）
-        
+
         参数:
             user_id: 用户 ID
         """
         # 检查是否需要重置
         self._check_reset()
-        
-        # 确保用户ID是字符串类型
-        user_id_str = str(user_id)
-        
-        # 确保users字典存在
-        if "users" not in self.usage_data:
-            self.usage_data["users"] = {}
-        
-        # 先完全删除这个用户的记录，避免重复
-        if user_id_str in self.usage_data["users"]:
-            del self.usage_data["users"][user_id_str]
-            
-        # 创建新的用户数据记录
-        user_data = {
-            "count": 0,
-            "last_usage": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
-        
-        # 更新用户数据
-        self.usage_data["users"][user_id_str] = user_data
-        
+
+        slot = self._slot(str(user_id))
+        self._total -= self.counts[slot]
+        self.counts[slot] = 0
+        self.last_usage[slot] = int(time.time())
+
         # 保存数据
         self._save_usage_data()
-        
+
     def get_usage_statistics(self) -> Dict[str, Any]:
         """
         获取使用统计信息
-        
+
         返回:
             统计数据字典
         """
         # 检查是否需要重置
         self._check_reset()
-        
-        users = self.usage_data.get("users", {})
-        
-        # 计算总用户数和总使用次数
-        total_users = len(users)
-        total_usage = sum(user.get("count", 0) for user in users.values())
-        
+
         return {
-            "total_users": total_users,
-            "total_usage": total_usage,
-            "last_reset": self.usage_data.get("last_reset", "未知")
+            "total_users": len(self.user_ids),
+            "total_usage": self._total,
+            "last_reset": self.last_reset
         }
-        
+
     def get_reset_time(self) -> str:
         """
         获取下次重置时间
-        
+
         返回:
             下次重置时间的字符串
         """
         # 使用UTC+8时间
         now = datetime.utcnow() + timedelta(hours=8)
-        
+
         # 计算下一个0点
         next_day = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
-        
+
         # 格式化时间
         return next_day.strftime("%Y-%m-%d %H:%M:%S")
@@ -0,0 +1,188 @@
+"""
+结构化日志
+
+各模块通过 get_logger(模块名) 取得 oracle_lang.<模块名> 日志器。调用方线程只做级别判断、
+限流与采样，再把日志记录放入队列；格式化与输出由后台线程完成，不阻塞事件循环。
+
+- 输出格式: 时间 级别 模块 消息 key=value ……，extra 中的字段按 key=value 附加在消息之后
+- 按模块设置级别，如 {"calculator": "DEBUG"}
+- 限流: 同一模块同一消息模板的 WARNING 及以上日志，每个窗口内最多输出 burst 条，
+  其余计数后在下一条输出中以 suppressed=N 注明
+- 采样: DEBUG 日志按消息模板每 sample_every 条输出一条，并以 sampled=N 注明
+
+消息参数在后台线程中格式化，调用方不应在记录日志后修改作为参数传入的对象。
+"""
+import sys
+import time
+import queue
+import logging
+import threading
+import logging.handlers
+from typing import Any, Dict, Optional, Tuple
+
+ROOT = "oracle_lang"
+
+LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+# LogRecord 自带的属性，其余属性视为 extra 传入的结构化字段
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+def get_logger(name: str) -> logging.Logger:
+    """取得模块日志器"""
+    return logging.getLogger(f"{ROOT}.{name}")
+
+class StructuredFormatter(logging.Formatter):
+    """时间 级别 模块 消息 key=value ……"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        module = record.name[len(ROOT) + 1:] if record.name.startswith(ROOT + ".") else record.name
+        parts = [
+            f"{self.formatTime(record, '%Y-%m-%d %H:%M:%S')}.{int(record.msecs):03d}",
+            record.levelname,
+            module,
+            record.getMessage(),
+        ]
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED:
+                parts.append(f"{key}={value!r}" if isinstance(value, str) else f"{key}={value}")
+        text = " ".join(parts)
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+class RateLimitFilter(logging.Filter):
+    """同一消息模板的 WARNING 及以上日志按窗口限流，DEBUG 日志按模板采样"""
+
+    def __init__(self, window: float = 60.0, burst: int = 5, sample_every: int = 1):
+        super().__init__()
+        self.window = max(0.0, float(window))
+        self.burst = max(0, int(burst))
+        self.sample_every = max(1, int(sample_every))
+        # (日志器, 模板) -> [窗口开始时间, 窗口内条数, 被抑制条数]
+        self._windows: Dict[Tuple[str, Any], list] = {}
+        # (日志器, 模板) -> 已见条数
+        self._samples: Dict[Tuple[str, Any], int] = {}
+        self._lock = threading.Lock()
+        self.suppressed = 0
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.name, record.msg)
+        if record.levelno >= logging.WARNING:
+            if not self.burst or not self.window:
+                return True
+            now = time.monotonic()
+            with self._lock:
+                state = self._windows.get(key)
+                if state is None or now - state[0] >= self.window:
+                    suppressed = state[2] if state is not None else 0
+                    self._windows[key] = [now, 1, 0]
+                    if suppressed:
+                        record.suppressed = suppressed
+                    return True
+                if state[1] < self.burst:
+                    state[1] += 1
+                    return True
+                state[2] += 1
+                self.suppressed += 1
+                return False
+        if record.levelno <= logging.DEBUG and self.sample_every > 1:
+            with self._lock:
+                seen = self._samples.get(key, 0)
+                self._samples[key] = seen + 1
+            if seen % self.sample_every:
+                self.dropped += 1
+                return False
+            record.sampled = self.sample_every
+        return True
+
+class ForwardHandler(logging.Handler):
+    """将格式化后的日志转交给另一个日志器（如 AstrBot 的日志器）"""
+
+    def __init__(self, target: logging.Logger):
+        super().__init__()
+        self.target = target
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.target.log(record.levelno, self.format(record))
+        except Exception:
+            self.handleError(record)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """直接入队原始记录，格式化留给后台线程"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_handler: Optional[_QueueHandler] = None
+_filter: Optional[RateLimitFilter] = None
+
+def configure(level: str = "INFO", module_levels: Optional[Dict[str, str]] = None,
+              sink: Optional[logging.Logger] = None, window: float = 60.0, burst: int = 5,
+              sample_every: int = 1):
+    """
+    配置日志管道，可重复调用（如插件重载），旧的后台线程会先停止
+
+    参数:
+        level: 默认级别
+        module_levels: 按模块覆盖的级别，如 {"calculator": "DEBUG"}
+        sink: 输出目标日志器，为 None 时输出到标准错误
+        window: 限流窗口(秒)，0 表示不限流
+        burst: 每个窗口内同一消息最多输出的条数
+        sample_every: DEBUG 日志每多少条输出一条
+    """
+    global _listener, _handler, _filter
+    shutdown()
+
+    output: logging.Handler = ForwardHandler(sink) if sink is not None else logging.StreamHandler(sys.stderr)
+    output.setFormatter(StructuredFormatter())
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    _filter = RateLimitFilter(window, burst, sample_every)
+    _handler = _QueueHandler(log_queue)
+    _handler.addFilter(_filter)
+    _listener = logging.handlers.QueueListener(log_queue, output)
+    _listener.start()
+
+    root = logging.getLogger(ROOT)
+    root.handlers[:] = [_handler]
+    root.propagate = False
+    root.setLevel(_level(level, logging.INFO))
+
+    # 先清除上次配置的模块级别
+    for name, existing in list(logging.Logger.manager.loggerDict.items()):
+        if name.startswith(ROOT + ".") and isinstance(existing, logging.Logger):
+            existing.setLevel(logging.NOTSET)
+    for module, module_level in (module_levels or {}).items():
+        get_logger(module).setLevel(_level(module_level, logging.INFO))
+
+def parse_module_levels(items) -> Dict[str, str]:
+    """解析 ["calculator=DEBUG", ...] 形式的模块级别配置，格式不正确的项忽略"""
+    levels = {}
+    for item in items or []:
+        module, sep, module_level = str(item).partition("=")
+        if sep and module.strip():
+            levels[module.strip()] = module_level.strip().upper()
+    return levels
+
+def stats() -> Dict[str, int]:
+    """限流与采样丢弃的日志条数"""
+    if _filter is None:
+        return {"suppressed": 0, "sampled_out": 0}
+    return {"suppressed": _filter.suppressed, "sampled_out": _filter.dropped}
+
+def shutdown():
+    """停止后台线程，队列中剩余的日志全部输出后返回"""
+    global _listener, _handler
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    if _handler is not None:
+        logging.getLogger(ROOT).removeHandler(_handler)
+        _handler = None
+
+def _level(name: Any, default: int) -> int:
+    name = str(name).upper()
+    return getattr(logging, name) if name in LEVELS else default
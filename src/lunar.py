@@ -0,0 +1,209 @@
+"""
+农历与干支计算
+
+使用 1900-2100 年的农历数据表，每年一个整数：
+- 第 0-3 位：闰月月份，0 表示无闰月
+- 第 4-15 位：正月到十二月的大小，第 15 位为正月，1 表示大月（30 天）
+- 第 16 位：闰月大小，1 表示 30 天
+以 1900-01-31（农历 1900 年正月初一）为起点。
+
+导入时由数据表展开两张累计天数表（共约 6KB），之后的公历转农历只需
+一次年表比较与一次月表比较，不再逐年逐月累加。
+"""
+from array import array
+from datetime import date
+from typing import Tuple
+
+from .data_constants import HEAVENLY_STEMS, EARTHLY_BRANCHES
+
+LUNAR_INFO = array("I", (
+    0x04bd8, 0x04ae0, 0x0a570, 0x054d5, 0x0d260, 0x0d950, 0x16554, 0x056a0, 0x09ad0, 0x055d2,  # 1900-1909
+    0x04ae0, 0x0a5b6, 0x0a4d0, 0x0d250, 0x1d255, 0x0b540, 0x0d6a0, 0x0ada2, 0x095b0, 0x14977,  # 1910-1919
+    0x04970, 0x0a4b0, 0x0b4b5, 0x06a50, 0x06d40, 0x1ab54, 0x02b60, 0x09570, 0x052f2, 0x04970,  # 1920-1929
+    0x06566, 0x0d4a0, 0x0ea50, 0x06e95, 0x05ad0, 0x02b60, 0x186e3, 0x092e0, 0x1c8d7, 0x0c950,  # 1930-1939
+    0x0d4a0, 0x1d8a6, 0x0b550, 0x056a0, 0x1a5b4, 0x025d0, 0x092d0, 0x0d2b2, 0x0a950, 0x0b557,  # 1940-1949
+    0x06ca0, 0x0b550, 0x15355, 0x04da0, 0x0a5d0, 0x14573, 0x052b0, 0x0a9a8, 0x0e950, 0x06aa0,  # 1950-1959
+    0x0aea6, 0x0ab50, 0x04b60, 0x0aae4, 0x0a570, 0x05260, 0x0f263, 0x0d950, 0x05b57, 0x056a0,  # 1960-1969
+    0x096d0, 0x04dd5, 0x04ad0, 0x0a4d0, 0x0d4d4, 0x0d250, 0x0d558, 0x0b540, 0x0b5a0, 0x195a6,  # 1970-1979
+    0x095b0, 0x049b0, 0x0a974, 0x0a4b0, 0x0b27a, 0x06a50, 0x06d40, 0x0af46, 0x0ab60, 0x09570,  # 1980-1989
+    0x04af5, 0x04970, 0x064b0, 0x074a3, 0x0ea50, 0x06b58, 0x05ac0, 0x0ab60, 0x096d5, 0x092e0,  # 1990-1999
+    0x0c960, 0x0d954, 0x0d4a0, 0x0da50, 0x07552, 0x056a0, 0x0abb7, 0x025d0, 0x092d0, 0x0cab5,  # 2000-2009
+    0x0a950, 0x0b4a0, 0x0baa4, 0x0ad50, 0x055d9, 0x04ba0, 0x0a5b0, 0x15176, 0x052b0, 0x0a930,  # 2010-2019
+    0x07954, 0x06aa0, 0x0ad50, 0x05b52, 0x04b60, 0x0a6e6, 0x0a4e0, 0x0d260, 0x0ea65, 0x0d530,  # 2020-2029
+    0x05aa0, 0x076a3, 0x096d0, 0x04afb, 0x04ad0, 0x0a4d0, 0x1d0b6, 0x0d250, 0x0d520, 0x0dd45,  # 2030-2039
+    0x0b5a0, 0x056d0, 0x055b2, 0x049b0, 0x0a577, 0x0a4b0, 0x0aa50, 0x1b255, 0x06d20, 0x0ada0,  # 2040-2049
+    0x14b63, 0x09370, 0x049f8, 0x04970, 0x064b0, 0x168a6, 0x0ea50, 0x06aa0, 0x1a6c4, 0x0aae0,  # 2050-2059
+    0x092e0, 0x0d2e3, 0x0c960, 0x0d557, 0x0d4a0, 0x0da50, 0x05d55, 0x056a0, 0x0a6d0, 0x055d4,  # 2060-2069
+    0x052d0, 0x0a9b8, 0x0a950, 0x0b4a0, 0x0b6a6, 0x0ad50, 0x055a0, 0x0aba4, 0x0a5b0, 0x052b0,  # 2070-2079
+    0x0b273, 0x06930, 0x07337, 0x06aa0, 0x0ad50, 0x14b55, 0x04b60, 0x0a570, 0x054e4, 0x0d160,  # 2080-2089
+    0x0e968, 0x0d520, 0x0daa0, 0x16aa6, 0x056d0, 0x04ae0, 0x0a9d4, 0x0a2d0, 0x0d150, 0x0f252,  # 2090-2099
+    0x0d520,                                                                                    # 2100
+))
+
+MIN_YEAR = 1900
+MAX_YEAR = MIN_YEAR + len(LUNAR_INFO) - 1
+
+# 农历 1900 年正月初一对应的公历日期
+BASE_DATE = date(1900, 1, 31)
+BASE_ORDINAL = BASE_DATE.toordinal()
+
+# 1900-01-31 为甲辰日，在六十甲子中的序号
+BASE_DAY_CYCLE = 40
+
+# 每年的月份槽位数：十二个月加一个闰月槽，无闰月的年份闰月槽长度为 0
+MONTH_SLOTS = 13
+
+def leap_month(year: int) -> int:
+    """农历年的闰月月份，0 表示无闰月"""
+    return LUNAR_INFO[year - MIN_YEAR] & 0xF
+
+def month_days(year: int, month: int, leap: bool = False) -> int:
+    """农历某月的天数"""
+    info = LUNAR_INFO[year - MIN_YEAR]
+    if leap:
+        return 30 if info & 0x10000 else 29
+    return 30 if info & (0x10000 >> month) else 29
+
+def year_days(year: int) -> int:
+    """农历年的总天数"""
+    index = year - MIN_YEAR
+    return MONTH_STARTS[(index + 1) * (MONTH_SLOTS + 1) - 1]
+
+def _build_tables() -> Tuple[array, array]:
+    """
+    展开累计天数表
+
+    YEAR_STARTS[i]: 农历 MIN_YEAR + i 年正月初一距 BASE_DATE 的天数（多一项作为结束）
+    MONTH_STARTS[i * 14 + k]: 该年第 k 个月份槽距正月初一的天数，k = 13 为全年天数；
+    月份槽按年内实际顺序排列，闰月紧跟在同名月之后。
+    """
+    year_starts = array("I", [0])
+    month_starts = array("H")
+    for year in range(MIN_YEAR, MAX_YEAR + 1):
+        leap = leap_month(year)
+        offset = 0
+        month_starts.append(0)
+        for month in range(1, 13):
+            offset += month_days(year, month)
+            month_starts.append(offset)
+            if month == leap:
+                offset += month_days(year, month, leap=True)
+                month_starts.append(offset)
+        if not leap:
+            # 无闰月时补一个长度为 0 的槽，使每年固定占 14 项
+            month_starts.append(offset)
+        year_starts.append(year_starts[-1] + offset)
+    return year_starts, month_starts
+
+YEAR_STARTS, MONTH_STARTS = _build_tables()
+
+def solar_to_lunar(year: int, month: int, day: int) -> Tuple[int, int, int, bool]:
+    """
+    公历转农历
+
+    参数:
+        year, month, day: 公历日期
+
+    返回:
+        (农历年, 农历月, 农历日, 是否闰月)
+    """
+    return _lunar_from_offset(date(year, month, day).toordinal() - BASE_ORDINAL, year)
+
+def _lunar_from_offset(offset: int, year: int) -> Tuple[int, int, int, bool]:
+    """距 BASE_DATE 的天数 -> 农历日期，year 为对应的公历年"""
+    # 农历年与公历年相同，或在春节前属于上一年
+    lunar_year = year if year <= MAX_YEAR else MAX_YEAR
+    index = lunar_year - MIN_YEAR
+    if index >= 0 and offset < YEAR_STARTS[index]:
+        index -= 1
+    if index < 0 or offset >= YEAR_STARTS[index + 1]:
+        raise ValueError(f"超出农历数据范围: {date.fromordinal(BASE_ORDINAL + offset)}")
+
+    offset -= YEAR_STARTS[index]
+    # 每月 29 或 30 天，第 k 个月份槽起点在 [29k, 30k] 之间，
+    # 因此所在槽只可能是 offset // 30 或其下一个，比较一次即可
+    base = index * (MONTH_SLOTS + 1)
+    slot = offset // 30
+    if MONTH_STARTS[base + slot + 1] <= offset:
+        slot += 1
+
+    leap = LUNAR_INFO[index] & 0xF
+    if leap and slot >= leap:
+        lunar_month, is_leap = slot, slot == leap
+    else:
+        lunar_month, is_leap = slot + 1, False
+    return MIN_YEAR + index, lunar_month, offset - MONTH_STARTS[base + slot] + 1, is_leap
+
+def lunar_to_solar(year: int, month: int, day: int, leap: bool = False) -> date:
+    """
+    农历转公历
+
+    参数:
+        year, month, day: 农历年月日
+        leap: 是否闰月
+
+    返回:
+        公历日期
+    """
+    if not MIN_YEAR <= year <= MAX_YEAR or not 1 <= month <= 12:
+        raise ValueError(f"超出农历数据范围: {year}-{month}-{day}")
+    if leap and leap_month(year) != month:
+        raise ValueError(f"农历 {year} 年没有闰{month}月")
+
+    index = year - MIN_YEAR
+    slot = month - 1
+    if leap_month(year) and (month > leap_month(year) or leap):
+        slot += 1
+    start = MONTH_STARTS[index * (MONTH_SLOTS + 1) + slot]
+    if not 1 <= day <= month_days(year, month, leap):
+        raise ValueError(f"日期无效: 农历 {year}-{month}-{day}")
+    return date.fromordinal(BASE_ORDINAL + YEAR_STARTS[index] + start + day - 1)
+
+# 农历月名与日名
+MONTH_NAMES = ("正", "二", "三", "四", "五", "六", "七", "八", "九", "十", "冬", "腊")
+DAY_NAMES = tuple(
+    prefix + digit
+    for prefix, digits in (("初", "一二三四五六七八九十"), ("十", "一二三四五六七八九"),
+                           ("二", "十"), ("廿", "一二三四五六七八九"), ("三", "十"))
+    for digit in digits
+)
+
+def format_lunar(month: int, day: int, leap: bool = False) -> str:
+    """农历月日的中文写法，如 (1, 1) -> 正月初一"""
+    return f"{'闰' if leap else ''}{MONTH_NAMES[month - 1]}月{DAY_NAMES[day - 1]}"
+
+def cycle_name(index: int) -> str:
+    """六十甲子序号 -> 干支名称，如 0 -> 甲子"""
+    return HEAVENLY_STEMS[index % 10] + EARTHLY_BRANCHES[index % 12]
+
+def ganzhi(year: int, month: int, day: int, hour: int = 0) -> Tuple[int, int, int, int]:
+    """
+    公历日期时间的年、月、日、时干支
+
+    - 年柱以农历正月初一为界
+    - 月柱按农历月份排（正月建寅，闰月同本月），年上起月：甲己之年丙作首
+    - 日柱按距 1900-01-31（甲辰日）的天数推算
+    - 时柱按时辰排，23 点计入当日子时，日上起时：甲己还加甲
+
+    返回:
+        四柱在六十甲子中的序号 (年, 月, 日, 时)，可用 cycle_name 转为名称
+    """
+    offset = date(year, month, day).toordinal() - BASE_ORDINAL
+    lunar_year, lunar_month, _, _ = _lunar_from_offset(offset, year)
+    year_cycle = (lunar_year - 4) % 60
+
+    month_stem = (year_cycle % 5 * 2 + 2 + lunar_month - 1) % 10
+    month_branch = (lunar_month + 1) % 12
+    month_cycle = _cycle_index(month_stem, month_branch)
+
+    day_cycle = (offset + BASE_DAY_CYCLE) % 60
+
+    hour_branch = ((hour + 1) // 2) % 12
+    hour_stem = (day_cycle % 5 * 2 + hour_branch) % 10
+    hour_cycle = _cycle_index(hour_stem, hour_branch)
+
+    return year_cycle, month_cycle, day_cycle, hour_cycle
+
+def _cycle_index(stem: int, branch: int) -> int:
+    """天干序号与地支序号 -> 六十甲子序号（两者奇偶必须相同）"""
+    return (6 * stem - 5 * branch) % 60
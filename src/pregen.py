@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import asyncio
+import threading
+from array import array
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .storage import FileLock, atomic_write
+from .log import get_logger
+
+logger = get_logger("pregen")
+
+# 64 卦 × 64 种动爻组合
+SLOTS = 64 * 64
+
+def slot(number: int, mask: int) -> int:
+    """(卦序, 动爻掩码) -> 表中位置，与 rules.RULES 的下标一致"""
+    return (number - 1) << 6 | mask
+
+def combinations(max_moving: int = 1) -> List[Tuple[int, int]]:
+    """
+    需要预生成的组合：64 卦 × 不超过 max_moving 个动爻的全部掩码
+
+    掷币法下无动爻与一爻动约占 53%，加上二爻动约占 83%。
+    """
+    masks = [mask for mask in range(64) if bin(mask).count("1") <= max_moving]
+    return [(number, mask) for number in range(1, 65) for mask in masks]
+
+class PregenStore:
+    """
+    预生成解释的磁盘表
+
+    正文以 JSON 追加写入 pregen.dat；pregen.idx 为 4096 项的 (偏移, 长度) 数组，
+    每写入一条即原子替换，中断后已完成的组合不会丢失。查询只需一次数组下标
+    与一次按偏移读取。
+
+    put 在工作线程中执行，index 与 _version 的读写由 _state_lock 保护。
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.data_file = os.path.join(self.store_dir, "pregen.dat")
+        self.index_file = os.path.join(self.store_dir, "pregen.idx")
+        self._lock = FileLock(self.index_file)
+
+        # 第 2k 项为偏移，第 2k+1 项为长度，长度为 0 表示尚未生成
+        self.index = array("I", bytes(8 * SLOTS))
+        self._version = None
+        self._state_lock = threading.Lock()
+        # 数据文件只追加不替换，保持打开以便按偏移直接读取
+        self._fd: Optional[int] = None
+        self.refresh()
+
+    def get(self, number: int, mask: int) -> Optional[Dict[str, str]]:
+        """读取预生成的解释，不存在时返回 None"""
+        if not 1 <= number <= 64:
+            return None
+        k = slot(number, mask)
+        offset, length = self._slot(k)
+        if not length:
+            # 可能由其他进程写入，索引文件有变化时重新加载
+            self.refresh()
+            offset, length = self._slot(k)
+            if not length:
+                return None
+        try:
+            if self._fd is None:
+                self._fd = os.open(self.data_file, os.O_RDONLY)
+            return json.loads(os.pread(self._fd, length, offset).decode("utf-8"))
+        except Exception as e:
+            logger.error("读取预生成解释失败: %s", e)
+            return None
+
+    def put(self, number: int, mask: int, value: Dict[str, str]):
+        """追加保存一条解释，并原子更新索引"""
+        payload = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        k = slot(number, mask)
+        with self._lock.write():
+            with self._state_lock:
+                self._refresh_locked()
+                # 在副本上修改，写入索引文件后再替换，读取方不会看到只更新了一半的项
+                index = array("I", self.index)
+            with open(self.data_file, "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(payload)
+            index[2 * k] = offset
+            index[2 * k + 1] = len(payload)
+            atomic_write(self.index_file, index.tobytes())
+            with self._state_lock:
+                self.index = index
+                self._version = self._stat()
+
+    def close(self):
+        """关闭数据文件"""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _slot(self, k: int) -> Tuple[int, int]:
+        """第 k 项的 (偏移, 长度)"""
+        with self._state_lock:
+            return self.index[2 * k], self.index[2 * k + 1]
+
+    def __contains__(self, key: Tuple[int, int]) -> bool:
+        return bool(self._slot(slot(*key))[1])
+
+    def __len__(self) -> int:
+        index = self.index
+        return sum(1 for k in range(SLOTS) if index[2 * k + 1])
+
+    def _stat(self) -> Optional[Tuple[int, int]]:
+        """索引文件的 (inode, 修改时间)，每次原子替换都会变化"""
+        try:
+            st = os.stat(self.index_file)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    def refresh(self):
+        """索引文件有变化时重新读取"""
+        with self._state_lock:
+            self._refresh_locked()
+
+    def _refresh_locked(self):
+        """持有 _state_lock 时按需重新读取索引"""
+        version = self._stat()
+        if version is None or version == self._version:
+            return
+        try:
+            with open(self.index_file, "rb") as f:
+                data = f.read()
+            if len(data) != 8 * SLOTS:
+                raise ValueError(f"索引长度异常: {len(data)}")
+            self.index = array("I", data)
+            self._version = version
+        except Exception as e:
+            logger.error("加载预生成索引失败: %s", e)
+
+class Pregenerator:
+    """
+    预生成任务
+
+    遍历尚未生成的组合，以 concurrency 个并发调用 generate，结果逐条写入 PregenStore。
+    已写入的组合在重新启动时跳过，因此任务可随时停止、中断后继续。
+    """
+
+    def __init__(self, store: PregenStore, generate: Callable[[int, int], Awaitable[Dict[str, str]]],
+                 concurrency: int = 2):
+        """
+        参数:
+            store: 预生成表
+            generate: 生成单个组合解释的协程函数，参数为 (卦序, 动爻掩码)，失败时返回空字典
+            concurrency: 同时进行的生成请求数
+        """
+        self.store = store
+        self.generate = generate
+        self.concurrency = max(1, int(concurrency))
+        self._task: Optional[asyncio.Task] = None
+
+        # 本次任务的进度
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.started_at = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, combos: Iterable[Tuple[int, int]]) -> bool:
+        """在后台启动任务，已在运行时返回 False"""
+        if self.running:
+            return False
+        self.store.refresh()
+        pending = [combo for combo in combos if combo not in self.store]
+        self.total, self.done, self.failed = len(pending), 0, 0
+        self.started_at = time.monotonic()
+        self._task = asyncio.create_task(self._run(pending))
+        return True
+
+    async def stop(self):
+        """停止任务，已写入的结果保留"""
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self, pending: List[Tuple[int, int]]):
+        queue = iter(pending)
+
+        async def worker():
+            for number, mask in queue:
+                try:
+                    value = await self.generate(number, mask)
+                    if value:
+                        await asyncio.to_thread(self.store.put, number, mask, value)
+                        self.done += 1
+                        continue
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error("预生成解释失败: %s", e)
+                self.failed += 1
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+    def status(self) -> Dict[str, Any]:
+        """任务进度"""
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+        return {
+            "running": self.running,
+            "total": self.total,
+            "done": self.done,
+            "failed": self.failed,
+            "elapsed": elapsed,
+            "stored": len(self.store),
+        }
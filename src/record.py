@@ -0,0 +1,163 @@
+import time
+from datetime import datetime
+from typing import Dict, List, Any, Optional, Tuple, Callable
+
+from .data_constants import HEXAGRAM_NAMES
+
+def static_advice(original_name: str, changed_name: Optional[str]) -> str:
+    """未使用大语言模型时的默认建议"""
+    if not changed_name:
+        return f"请参考{original_name}卦的卦辞进行决策。"
+    return f"正处于从{original_name}到{changed_name}的变化过程中，建议关注变化的动向，顺势而为。"
+
+class CompactRecord:
+    """
+    紧凑的历史记录
+
+    以数组形式保存：[时间戳, 问题, 原卦, 变卦, 动爻掩码, 吉凶代码(, 大语言模型文本或文本ID(, 本卦六爻))]
+    时间字符串、动爻列表和结果摘要等可由卦序推导的内容在读取时重新生成。
+    本卦六爻在卦序映射表修正后才开始保存，之前的记录没有这一项。
+    """
+
+    __slots__ = ("ts", "question", "original", "changed", "moving", "fortune", "llm", "lines")
+
+    # 吉凶代码
+    FORTUNES = ("平", "吉", "凶")
+
+    def __init__(self, ts: int, question: str, original: int, changed: int, moving: int,
+                 fortune: int = 0, llm: Optional[Any] = None, lines: Optional[int] = None):
+        """
+        参数:
+            ts: 时间戳（秒）
+            question: 用户问题
+            original: 原卦卦序
+            changed: 变卦卦序
+            moving: 动爻掩码，下爻为第0位
+            fortune: 吉凶代码，对应 FORTUNES 的下标
+            llm: 大语言模型生成的 [解释, 建议]，或其在文本存储中的ID；未使用时为 None
+            lines: 本卦六爻的二进制值，下爻为第0位；旧记录为 None
+        """
+        self.ts = ts
+        self.question = question
+        self.original = original
+        self.changed = changed
+        self.moving = moving
+        self.fortune = fortune
+        self.llm = llm
+        self.lines = lines
+
+    @classmethod
+    def from_reading(cls, question: str, hexagram_data: Dict, interpretation: Dict,
+                     ts: Optional[int] = None) -> "CompactRecord":
+        """由一次算卦的卦象数据与解释生成记录"""
+        moving = 0
+        for i, bit in enumerate(hexagram_data["moving"]):
+            moving |= (bit & 1) << i
+        lines = 0
+        for i, bit in enumerate(hexagram_data["original"]):
+            lines |= (bit & 1) << i
+
+        fortune = interpretation.get("fortune", "平")
+        llm = None
+        if interpretation.get("llm_generated"):
+            llm = [interpretation.get("overall_meaning", ""), interpretation.get("advice", "")]
+
+        return cls(
+            int(time.time()) if ts is None else ts,
+            question,
+            hexagram_data["hexagram_original"],
+            hexagram_data["hexagram_changed"],
+            moving,
+            cls.FORTUNES.index(fortune) if fortune in cls.FORTUNES else 0,
+            llm,
+            lines
+        )
+
+    @classmethod
+    def from_row(cls, row: Any) -> "CompactRecord":
+        """从文件中的一项解析记录，兼容旧版字典格式"""
+        if isinstance(row, dict):
+            return cls.from_dict(row)
+        return cls(*row)
+
+    @classmethod
+    def from_dict(cls, record: Dict) -> "CompactRecord":
+        """从旧版字典格式的记录转换"""
+        try:
+            ts = int(datetime.strptime(record.get("timestamp", ""), "%Y-%m-%d %H:%M:%S").timestamp())
+        except ValueError:
+            ts = 0
+
+        moving = 0
+        for i, bit in enumerate(record.get("moving", [])):
+            moving |= (bit & 1) << i
+
+        fortune = record.get("fortune")
+        if fortune is None:
+            # 旧记录没有单独的吉凶字段，从摘要中提取
+            summary = record.get("result_summary", "")
+            fortune = next((f for f in ("吉", "凶") if f"，{f}。" in summary), "平")
+
+        # 旧记录保留原有的解释文字
+        return cls(
+            ts,
+            record.get("question", ""),
+            record.get("hexagram_original", 0),
+            record.get("hexagram_changed", 0),
+            moving,
+            cls.FORTUNES.index(fortune) if fortune in cls.FORTUNES else 0,
+            [record.get("interpretation_summary", ""), cls._advice_from_summary(record)]
+        )
+
+    def to_row(self) -> List[Any]:
+        """转换为写入文件的数组"""
+        row = [self.ts, self.question, self.original, self.changed, self.moving, self.fortune]
+        if self.llm is not None or self.lines is not None:
+            row.append(self.llm)
+        if self.lines is not None:
+            row.append(self.lines)
+        return row
+
+    def to_dict(self, resolve: Optional[Callable[[str], Optional[Any]]] = None) -> Dict[str, Any]:
+        """
+        展开为完整的记录字典，推导出的字段在此重新生成
+
+        参数:
+            resolve: 根据文本ID取回大语言模型文本的函数
+        """
+        original_name = HEXAGRAM_NAMES.get(self.original, f"未知卦象({self.original})")
+        changed_name = HEXAGRAM_NAMES.get(self.changed, f"未知卦象({self.changed})")
+        moving = [(self.moving >> i) & 1 for i in range(6)]
+        fortune = self.FORTUNES[self.fortune] if 0 <= self.fortune < len(self.FORTUNES) else "平"
+
+        llm = self.llm
+        if isinstance(llm, str):
+            llm = resolve(llm) if resolve is not None else None
+        overall, advice = llm if llm is not None else ("", None)
+        if advice is None:
+            advice = static_advice(original_name, changed_name if self.moving else None)
+
+        if self.moving:
+            result_summary = f"{original_name}变{changed_name}，{fortune}。{advice}"
+        else:
+            result_summary = f"{original_name}，{fortune}。{advice}"
+
+        record = {
+            "timestamp": datetime.fromtimestamp(self.ts).strftime("%Y-%m-%d %H:%M:%S"),
+            "question": self.question,
+            "hexagram_original": self.original,
+            "hexagram_changed": self.changed,
+            "moving": moving,
+            "fortune": fortune,
+            "result_summary": result_summary,
+            "interpretation_summary": overall
+        }
+        if self.lines is not None:
+            record["original"] = [(self.lines >> i) & 1 for i in range(6)]
+        return record
+
+    @staticmethod
+    def _advice_from_summary(record: Dict) -> str:
+        """从旧版结果摘要中取出建议部分"""
+        summary = record.get("result_summary", "")
+        return summary.split("。", 1)[1] if "。" in summary else ""
@@ -0,0 +1,296 @@
+"""
+流量重放工具
+
+读取 TrafficCapture 采集的请求元数据，按原始或缩放后的时间间隔重新驱动插件的
+oracle 处理函数，大语言模型以按采集耗时休眠的桩代替，数据写入临时目录。
+可同时重放两个版本的插件，对比各类请求的延迟分位数与吞吐量。
+
+需要在安装了 AstrBot 的环境中运行（插件本身依赖 astrbot.api）：
+
+    python -m src.replay data/capture --build . --build ../oracle_lang_old --speed 10
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import tempfile
+import importlib
+import importlib.util
+import contextvars
+from typing import Any, Dict, List, Optional, Tuple
+
+from .capture import iter_capture, capture_files
+
+# 当前请求的大语言模型耗时（秒），由桩提供方读取
+_llm_latency: contextvars.ContextVar = contextvars.ContextVar("llm_latency", default=0.0)
+
+# 合成问题文本使用的字符
+QUESTION_CHARS = "我今天的工作运势如何近期是否适合投资股票感情考试出行搬家合作财运健康家庭"
+
+# 桩提供方的固定回复，段落结构与真实回复一致
+STUB_COMPLETION = "整体意义：此卦提示稳中求进。\n\n吉凶：平\n\n建议：量力而行，守正待时。"
+
+class StubProvider:
+    """大语言模型提供方的桩：按采集到的耗时休眠后返回固定回复"""
+
+    def __init__(self, scale: float = 1.0):
+        self.scale = scale
+        self.calls = 0
+
+    async def text_chat(self, prompt: str, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(_llm_latency.get() * self.scale)
+        return type("Completion", (), {"completion_text": STUB_COMPLETION})()
+
+class StubContext:
+    """插件上下文的桩，只提供 get_using_provider"""
+
+    def __init__(self, provider: StubProvider):
+        self.provider = provider
+
+    def get_using_provider(self):
+        return self.provider
+
+class ReplayConfig(dict):
+    """插件配置，save_config 不写文件"""
+
+    def save_config(self):
+        pass
+
+class ReplayEvent:
+    """消息事件的桩，结果直接返回而不发送"""
+
+    def __init__(self, message: str, sender_id: str, group_id: str):
+        self.message_str = message
+        self._sender_id = sender_id
+        self._group_id = group_id
+
+    def get_sender_id(self) -> str:
+        return self._sender_id
+
+    def get_group_id(self) -> str:
+        return self._group_id
+
+    def get_self_id(self) -> str:
+        return "replay"
+
+    def plain_result(self, text: str):
+        return text
+
+    def chain_result(self, chain):
+        return chain
+
+def synthesize_message(record: Dict[str, Any], rng: random.Random, prefix: str = "算卦") -> str:
+    """按采集的类别与长度合成一条消息，问题文本随机生成但长度一致"""
+    question = "".join(rng.choice(QUESTION_CHARS) for _ in range(record.get("q", 0)))
+    params = "".join(rng.choice("0123456789") for _ in range(record.get("p", 0)))
+    method = record.get("m", "")
+    if record.get("k") == "divine" and method == "text":
+        parts = [question]
+    elif record.get("k") == "divine":
+        parts = [method, params, question]
+    else:
+        # 子命令的问题部分即关键字之后的参数
+        parts = [method, question if question else params]
+    return " ".join([prefix] + [part for part in parts if part])
+
+def default_config(schema_path: str, admins: List[str]) -> ReplayConfig:
+    """由 _conf_schema.json 的默认值生成配置，并关闭次数限制、协调与采集"""
+    with open(schema_path, "r", encoding="utf-8") as f:
+        schema = json.load(f)
+
+    def defaults(items: Dict[str, Any]) -> Dict[str, Any]:
+        config = {}
+        for key, item in items.items():
+            if item.get("type") == "object":
+                config[key] = defaults(item.get("items", {}))
+            else:
+                config[key] = item.get("default")
+        return config
+
+    config = ReplayConfig(defaults(schema))
+    config["admin_users"] = list(admins)
+    config.setdefault("llm", {})["enabled"] = True
+    config.setdefault("limit", {})["daily_max"] = 10 ** 9
+    config.setdefault("coordinator", {})["enabled"] = False
+    config.setdefault("capture", {})["enabled"] = False
+    config.setdefault("storage", {})["fsync"] = "never"
+    return config
+
+def load_build(build_dir: str, name: str) -> Tuple[type, str]:
+    """
+    将插件目录复制到临时目录并作为独立的包导入
+
+    返回:
+        (插件类, 临时目录)；data 目录只保留 static，历史与计数从空开始
+    """
+    work_dir = os.path.join(tempfile.mkdtemp(prefix="oracle_replay_"), name)
+    shutil.copytree(
+        build_dir, work_dir,
+        ignore=lambda directory, names: [
+            n for n in names
+            if n in ("__pycache__", ".git") or (os.path.basename(directory) == "data" and n != "static")
+        ]
+    )
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(work_dir, "__init__.py"), submodule_search_locations=[work_dir]
+    )
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[name] = package
+    spec.loader.exec_module(package)
+    module = importlib.import_module(f"{name}.main")
+    return module.OracleLangPlugin, work_dir
+
+async def replay(plugin_cls, work_dir: str, records: List[Dict[str, Any]], speed: float = 1.0,
+                 llm_scale: float = 1.0, seed: int = 0) -> Dict[str, Any]:
+    """
+    重放一组请求
+
+    参数:
+        speed: 时间缩放倍数，10 表示以 10 倍速重放，0 表示不等待、全部立即到达
+        llm_scale: 桩提供方耗时的缩放倍数
+
+    返回:
+        {"samples": [(类别, 延迟秒, 结果)], "wall": 总耗时, "llm_calls": 桩调用次数}
+    """
+    admins = sorted({r["u"] for r in records if r.get("k") in ("admin", "export", "pregen")})
+    config = default_config(os.path.join(work_dir, "_conf_schema.json"), admins)
+    provider = StubProvider(llm_scale)
+
+    before = asyncio.all_tasks()
+    plugin = plugin_cls(StubContext(provider), config)
+    # 等待插件的初始化任务完成
+    await asyncio.gather(*(asyncio.all_tasks() - before - {asyncio.current_task()}))
+
+    rng = random.Random(seed)
+    messages = [synthesize_message(r, rng, plugin.CMD_PREFIX) for r in records]
+    samples: List[Tuple[str, float, str]] = []
+
+    async def run_one(record: Dict[str, Any], message: str):
+        _llm_latency.set(record.get("llm", 0.0) / 1000)
+        event = ReplayEvent(message, record.get("u", ""), record.get("g", ""))
+        started = time.monotonic()
+        outcome = "ok"
+        try:
+            async for _ in plugin.oracle(event):
+                pass
+        except Exception:
+            outcome = "error"
+        samples.append((record.get("k", ""), time.monotonic() - started, outcome))
+
+    start = time.monotonic()
+    origin = records[0]["t"] if records else 0.0
+    tasks = []
+    for record, message in zip(records, messages):
+        if speed > 0:
+            delay = (record["t"] - origin) / speed - (time.monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(run_one(record, message)))
+    await asyncio.gather(*tasks)
+    wall = time.monotonic() - start
+
+    await plugin.terminate()
+    return {"samples": samples, "wall": wall, "llm_calls": provider.calls}
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def summarize(result: Dict[str, Any]) -> Dict[str, Dict[str, float]]:
+    """按类别汇总延迟分位数（毫秒），"*" 为全部请求"""
+    groups: Dict[str, List[float]] = {"*": []}
+    errors = 0
+    for kind, latency, outcome in result["samples"]:
+        groups.setdefault(kind, []).append(latency)
+        groups["*"].append(latency)
+        errors += outcome == "error"
+
+    summary = {}
+    for kind, values in groups.items():
+        summary[kind] = {
+            "count": len(values),
+            "p50": percentile(values, 0.50) * 1000,
+            "p95": percentile(values, 0.95) * 1000,
+            "p99": percentile(values, 0.99) * 1000,
+            "mean": sum(values) / len(values) * 1000 if values else 0.0,
+        }
+    summary["*"]["throughput"] = len(result["samples"]) / result["wall"] if result["wall"] else 0.0
+    summary["*"]["errors"] = errors
+    return summary
+
+def format_report(names: List[str], summaries: List[Dict[str, Dict[str, float]]]) -> str:
+    """生成对比报告，第二个及以后的版本显示相对第一个版本的变化"""
+    lines = []
+    kinds = sorted({kind for summary in summaries for kind in summary}, key=lambda k: (k != "*", k))
+    base = summaries[0]
+    for kind in kinds:
+        lines.append(f"[{'全部' if kind == '*' else kind}]")
+        for name, summary in zip(names, summaries):
+            s = summary.get(kind)
+            if s is None:
+                continue
+            text = (f"  {name:<12} n={s['count']:<6} p50 {s['p50']:8.2f}ms  p95 {s['p95']:8.2f}ms  "
+                    f"p99 {s['p99']:8.2f}ms  mean {s['mean']:8.2f}ms")
+            if kind == "*":
+                text += f"  {s['throughput']:.1f} req/s  errors {s['errors']}"
+            if summary is not base and kind in base:
+                b = base[kind]
+                deltas = [
+                    f"{label} {(s[key] - b[key]) / b[key] * 100:+.1f}%"
+                    for label, key in (("p50", "p50"), ("p95", "p95"), ("p99", "p99"))
+                    if b[key] > 0
+                ]
+                text += "  (" + ", ".join(deltas) + ")" if deltas else ""
+            lines.append(text)
+    return "\n".join(lines)
+
+def load_records(source: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """读取采集目录或单个采集文件，按到达时间排序"""
+    paths = capture_files(source) if os.path.isdir(source) else [source]
+    records = [r for r in iter_capture(paths) if "t" in r]
+    records.sort(key=lambda r: r["t"])
+    return records[:limit] if limit else records
+
+async def main(args) -> int:
+    records = load_records(args.capture, args.limit)
+    if not records:
+        print("采集文件中没有记录")
+        return 1
+
+    names, summaries = [], []
+    for i, build in enumerate(args.build):
+        name = f"oracle_replay_{i}"
+        try:
+            plugin_cls, work_dir = load_build(os.path.abspath(build), name)
+        except ImportError as e:
+            print(f"无法加载插件 {build}（需要安装 AstrBot）: {str(e)}")
+            return 1
+        try:
+            result = await replay(plugin_cls, work_dir, records, args.speed, args.llm_scale, args.seed)
+        finally:
+            shutil.rmtree(os.path.dirname(work_dir), ignore_errors=True)
+        names.append(os.path.basename(os.path.abspath(build)) or build)
+        summaries.append(summarize(result))
+        print(f"{names[-1]}: {len(records)} 个请求，用时 {result['wall']:.2f} 秒，桩调用 {result['llm_calls']} 次")
+
+    print(format_report(names, summaries))
+    return 0
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="重放采集的请求并对比插件版本的延迟与吞吐")
+    parser.add_argument("capture", help="采集目录（data/capture）或单个采集文件")
+    parser.add_argument("--build", action="append", required=True,
+                        help="插件目录，可指定多次，第一个为对比基准")
+    parser.add_argument("--speed", type=float, default=1.0, help="时间缩放倍数，0 表示全部立即到达")
+    parser.add_argument("--llm-scale", type=float, default=1.0, help="大语言模型桩耗时的缩放倍数")
+    parser.add_argument("--limit", type=int, default=None, help="最多重放的请求数")
+    parser.add_argument("--seed", type=int, default=0, help="合成问题文本的随机种子")
+    sys.exit(asyncio.run(main(parser.parse_args())))
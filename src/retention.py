@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import asyncio
+import zipfile
+import threading
+from typing import Dict, List, Any, Optional, Iterator, Tuple
+
+from .storage import FileLock, atomic_write_json, read_json
+from .log import get_logger
+
+logger = get_logger("retention")
+
+class HistoryArchive:
+    """
+    冷数据归档
+
+    长期不活跃用户的历史文件按月打包进 archive/YYYY-MM.zip（LZMA 压缩），
+    manifest.json 记录每个用户所在的归档文件与成员名，便于按需取回。
+    清单可能同时被清理线程与事件循环修改，修改与保存在 _manifest_lock 内进行。
+    """
+
+    def __init__(self, archive_dir: str):
+        self.archive_dir = archive_dir
+        os.makedirs(self.archive_dir, exist_ok=True)
+        self.manifest_file = os.path.join(self.archive_dir, "manifest.json")
+        # 用户ID -> [归档文件名, 成员名]
+        self.manifest: Dict[str, List[str]] = self._load_manifest()
+        self._manifest_lock = threading.Lock()
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self.manifest
+
+    def __len__(self) -> int:
+        return len(self.manifest)
+
+    def store(self, user_id: str, rows: List[Any], month: str):
+        """
+        将用户记录写入指定月份的归档
+
+        参数:
+            user_id: 用户ID
+            rows: 紧凑格式的历史记录
+            month: 归档月份，格式 YYYY-MM
+        """
+        archive_name = f"{month}.zip"
+        member = f"{user_id}-{int(time.time())}.json"
+        archive_path = os.path.join(self.archive_dir, archive_name)
+        # 压缩包追加写入不是原子操作，用文件锁避免多个进程同时追加
+        with FileLock(archive_path).write():
+            with zipfile.ZipFile(archive_path, "a", compression=zipfile.ZIP_LZMA) as zf:
+                zf.writestr(member, json.dumps(rows, ensure_ascii=False, separators=(",", ":")))
+        with self._manifest_lock:
+            self.manifest[user_id] = [archive_name, member]
+            self._save_manifest()
+
+    def load(self, user_id: str) -> List[Any]:
+        """读取用户的归档记录，不存在时返回空列表"""
+        entry = self.manifest.get(user_id)
+        if entry is None:
+            return []
+        try:
+            with zipfile.ZipFile(os.path.join(self.archive_dir, entry[0]), "r") as zf:
+                return json.loads(zf.read(entry[1]).decode("utf-8"))
+        except Exception as e:
+            logger.error("读取归档记录失败: %s", e)
+            return []
+
+    def restore(self, user_id: str) -> List[Any]:
+        """取回用户的归档记录并从清单中移除，用户重新活跃时调用"""
+        rows = self.load(user_id)
+        with self._manifest_lock:
+            if self.manifest.pop(user_id, None) is not None:
+                self._save_manifest()
+        return rows
+
+    def iter_users(self) -> Iterator[Tuple[str, List[Any]]]:
+        """逐个遍历归档中的用户记录"""
+        for user_id in list(self.manifest):
+            yield user_id, self.load(user_id)
+
+    def _load_manifest(self) -> Dict[str, List[str]]:
+        try:
+            return read_json(self.manifest_file, {})
+        except Exception as e:
+            logger.error("加载归档清单失败: %s", e)
+            return {}
+
+    def _save_manifest(self):
+        try:
+            atomic_write_json(self.manifest_file, self.manifest)
+        except Exception as e:
+            logger.error("保存归档清单失败: %s", e)
+
+class RetentionSweeper:
+    """
+    历史记录保留策略的后台清理器
+
+    每次 tick 只处理有限数量的用户文件，遍历位置在多次 tick 之间保持，
+    一轮结束后从头开始。处理内容：
+    - 删除超过 expire_days 的记录
+    - 将超过 archive_after_days 未活跃的用户移入冷归档
+    - 每轮结束后按需压缩大语言模型文本存储，每次 tick 最多复制 COMPACT_BUDGET 字节
+
+    文件读写、归档压缩与文本存储压缩在 sweep 中进行，检索索引的更新收集起来由 apply
+    在本批结束后一并完成。run 在工作线程中执行整个 tick，等待文件锁时不阻塞事件循环。
+    """
+
+    # 文本存储中无引用文本的占比超过该值时，在一轮清理结束后压缩
+    COMPACT_RATIO = 0.5
+
+    # 每次 tick 压缩文本存储时最多复制的字节数
+    COMPACT_BUDGET = 4 * 1024 * 1024
+
+    def __init__(self, history, archive: HistoryArchive, expire_days: int = 0,
+                 archive_after_days: int = 30, batch: int = 50):
+        """
+        参数:
+            history: HistoryManager 实例
+            archive: 冷数据归档
+            expire_days: 记录保留天数，0 表示永久保留
+            archive_after_days: 用户多少天未活跃后归档，0 表示不归档
+            batch: 每次 tick 最多处理的文件数
+        """
+        self.history = history
+        self.archive = archive
+        self.expire_days = max(0, int(expire_days))
+        self.archive_after_days = max(0, int(archive_after_days))
+        self.batch = max(1, int(batch))
+
+        self._iterator: Optional[Iterator] = None
+        self._compact_due = False
+        # 待从检索索引中移除的 (用户ID, 记录)
+        self._unindex: List[Tuple[str, List[Any]]] = []
+        self.stats = {"scanned": 0, "archived": 0, "expired": 0, "rounds": 0}
+
+    def tick(self) -> int:
+        """处理下一批用户文件并更新检索索引，返回本次处理的文件数"""
+        processed = self.sweep()
+        self.apply()
+        return processed
+
+    async def run(self) -> int:
+        """在工作线程中处理下一批用户文件并更新检索索引"""
+        return await asyncio.to_thread(self.tick)
+
+    def apply(self):
+        """从检索索引中移除本批过期的记录"""
+        pending, self._unindex = self._unindex, []
+        for user_id, rows in pending:
+            self.history.unindex_rows(user_id, rows)
+
+    def sweep(self) -> int:
+        """处理下一批用户文件，并继续未完成的文本存储压缩，返回处理的文件数"""
+        self._compact_text_store()
+        now = time.time()
+        processed = 0
+        while processed < self.batch:
+            entry = self._next_entry()
+            if entry is None:
+                break
+            processed += 1
+            try:
+                self._process(entry, now)
+            except Exception as e:
+                logger.error("清理历史记录失败: %s", e)
+        self.stats["scanned"] += processed
+        return processed
+
+    def _next_entry(self) -> Optional[os.DirEntry]:
+        """从持久的目录迭代器取下一个用户文件，一轮结束后返回 None"""
+        if self._iterator is None:
+            self._iterator = os.scandir(self.history.history_dir)
+        for entry in self._iterator:
+            if entry.is_file() and entry.name.endswith(".json"):
+                return entry
+        self._iterator.close()
+        self._iterator = None
+        self.stats["rounds"] += 1
+
+        text_store = self.history.text_store
+        if text_store is not None and text_store.garbage_ratio() > self.COMPACT_RATIO:
+            self._compact_due = True
+        return None
+
+    def _compact_text_store(self):
+        """按预算继续压缩文本存储"""
+        text_store = self.history.text_store
+        if text_store is None or not (self._compact_due or text_store.compacting):
+            return
+        self._compact_due = False
+        reclaimed = text_store.compact_step(self.COMPACT_BUDGET)
+        if reclaimed is not None:
+            logger.info("文本存储压缩完成，回收 %d 字节", reclaimed)
+
+    def _process(self, entry: os.DirEntry, now: float):
+        """处理单个用户文件"""
+        user_id = entry.name[:-len(".json")]
+        with self.history.lock(user_id).write():
+            self._process_locked(entry, user_id, now)
+
+    def _process_locked(self, entry: os.DirEntry, user_id: str, now: float):
+        """持有用户文件锁时处理"""
+        mtime = entry.stat().st_mtime
+
+        rows = self.history.load_rows(user_id)
+        kept = rows
+        if self.expire_days:
+            cutoff = now - self.expire_days * 86400
+            kept = [row for row in rows if self._row_time(row) >= cutoff]
+            if len(kept) != len(rows):
+                expired = [row for row in rows if self._row_time(row) < cutoff]
+                self.history.release_rows(expired)
+                self._unindex.append((user_id, expired))
+            self.stats["expired"] += len(rows) - len(kept)
+
+        if self.archive_after_days and now - mtime > self.archive_after_days * 86400:
+            if kept:
+                month = time.strftime("%Y-%m", time.localtime(mtime))
+                self.archive.store(user_id, kept, month)
+            os.remove(entry.path)
+            self.history.forget(user_id)
+            self.stats["archived"] += 1
+        elif len(kept) != len(rows):
+            if kept:
+                self.history.write_rows(user_id, kept)
+            else:
+                os.remove(entry.path)
+                self.history.forget(user_id)
+
+    @staticmethod
+    def _row_time(row: Any) -> float:
+        """记录的时间戳，兼容旧版字典格式"""
+        if isinstance(row, list):
+            return row[0]
+        try:
+            return time.mktime(time.strptime(row.get("timestamp", ""), "%Y-%m-%d %H:%M:%S"))
+        except ValueError:
+            return 0
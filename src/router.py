@@ -0,0 +1,100 @@
+import re
+from typing import Dict, NamedTuple, Optional, Tuple
+
+class Command(NamedTuple):
+    """
+    解析后的命令对象
+
+    kind: 命令类别，如 'help', 'history', 'admin', 'divine'
+    method: 起卦方法（divine）或子命令关键字
+    params: 方法参数，如数字起卦的数字
+    question: 用户问题
+    args: 去掉命令前缀后按空白切分的全部参数
+    """
+    kind: str
+    method: str
+    params: Optional[str]
+    question: str
+    args: Tuple[str, ...]
+
+class Route(NamedTuple):
+    """子命令路由项"""
+    kind: str
+    exact: bool   # 是否要求整条参数与关键字完全一致
+    admin: bool   # 是否仅管理员可用
+
+class CommandRouter:
+    """
+    命令路由器，将消息一次性解析为 Command
+
+    子命令按首个词查表匹配，新增子命令只需调用 register 注册关键字与类别。
+    """
+
+    # 预编译的 @ 提及匹配
+    MENTION_PATTERN = re.compile(r'@\S+\s*')
+
+    def __init__(self, prefix: str = "算卦"):
+        self.prefix = prefix
+        self._routes: Dict[str, Route] = {}
+
+        # 内置子命令
+        self.register("帮助", "help", exact=True)
+        self.register("我的ID", "my_id", exact=True)
+        self.register("历史", "history")
+        self.register("数字", "divine")
+        self.register("时间", "divine")
+        for keyword in ("设置", "重置", "清除", "统计"):
+            self.register(keyword, "admin", admin=True)
+
+    def register(self, keyword: str, kind: str, exact: bool = False, admin: bool = False):
+        """
+        注册子命令
+
+        参数:
+            keyword: 紧跟命令前缀的关键字
+            kind: 命令类别，由插件据此分发处理函数
+            exact: 为 True 时仅当参数恰好等于关键字才匹配
+            admin: 为 True 时仅管理员匹配，其他用户按普通问题处理
+        """
+        self._routes[keyword] = Route(kind, exact, admin)
+
+    def parse(self, message: str, is_admin: bool = False) -> Optional[Command]:
+        """
+        解析消息
+
+        参数:
+            message: 原始消息文本
+            is_admin: 发送者是否为管理员
+
+        返回:
+            Command 对象；消息不是本插件命令时返回 None
+        """
+        # 清理文本，移除@信息（不含 @ 的消息跳过正则）
+        if "@" in message:
+            message = self.MENTION_PATTERN.sub('', message)
+        cleaned = message.strip()
+        if not cleaned.startswith(self.prefix):
+            return None
+
+        cmd_args = cleaned[len(self.prefix):].strip()
+        parts = cmd_args.split(maxsplit=2)
+        keyword = parts[0] if parts else ""
+
+        route = self._routes.get(keyword)
+        if route is not None and (route.exact and cmd_args != keyword or route.admin and not is_admin):
+            route = None
+
+        if route is None:
+            # 默认为文本起卦，整条参数作为问题
+            return Command("divine", "text", None, cmd_args, tuple(parts))
+
+        if route.kind == "divine":
+            params = parts[1] if len(parts) >= 2 else None
+            # 仅有方法名时沿用原有行为：整条参数作为问题
+            question = (parts[2] if len(parts) >= 3 else "") if params else cmd_args
+            return Command("divine", keyword, params, question, tuple(parts))
+
+        # 其他子命令保留完整的参数列表
+        args = tuple(cmd_args.split()) if len(parts) == 3 else tuple(parts)
+        rest = cmd_args[len(keyword):].strip()
+        return Command(route.kind, keyword, args[1] if len(args) >= 2 else None, rest, args)
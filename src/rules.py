@@ -0,0 +1,125 @@
+"""
+动爻占断规则
+
+按朱熹《易学启蒙·考变占》确定以哪段文字为占断依据：
+- 无动爻：占本卦卦辞
+- 一爻动：占本卦该爻爻辞
+- 二爻动：占本卦两动爻爻辞，以上爻为主
+- 三爻动：占本卦与之卦卦辞，以本卦为主
+- 四爻动：占之卦两静爻爻辞，以下爻为主
+- 五爻动：占之卦静爻爻辞
+- 六爻皆动：乾占用九，坤占用六，其余占之卦卦辞
+
+导入时对 64 卦 × 64 种动爻组合共 4096 种情况预先计算，每种情况压缩为一个
+16 位整数（主、次两个文字引用），解卦时只需一次查表。
+"""
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+# 文字引用：第 3 位为 1 表示之卦，低 3 位 0-5 为爻辞（初爻到上爻），6 为用九/用六，7 为卦辞
+CHANGED = 0b1000
+YONG = 6
+GUA_CI = 7
+
+# 编码时引用加 1，0 表示无
+REF_BITS = 5
+REF_MASK = (1 << REF_BITS) - 1
+
+# 乾、坤的卦序
+QIAN = 1
+KUN = 2
+
+# 各动爻数对应的规则说明
+RULE_NAMES = (
+    "无动爻，占本卦卦辞",
+    "一爻动，占本卦动爻爻辞",
+    "二爻动，占本卦两动爻爻辞，以上爻为主",
+    "三爻动，占本卦与之卦卦辞，以本卦为主",
+    "四爻动，占之卦两静爻爻辞，以下爻为主",
+    "五爻动，占之卦静爻爻辞",
+    "六爻皆动，占之卦卦辞",
+)
+
+YONG_RULE = "六爻皆动，乾坤占用九、用六"
+
+def _select(number: int, mask: int) -> Tuple[int, ...]:
+    """按规则选出占断依据，主依据在前"""
+    moving = [i for i in range(6) if mask >> i & 1]
+    static = [i for i in range(6) if not mask >> i & 1]
+    count = len(moving)
+    if count == 0:
+        return (GUA_CI,)
+    if count == 1:
+        return (moving[0],)
+    if count == 2:
+        return (moving[1], moving[0])
+    if count == 3:
+        return (GUA_CI, CHANGED | GUA_CI)
+    if count == 4:
+        return (CHANGED | static[0], CHANGED | static[1])
+    if count == 5:
+        return (CHANGED | static[0],)
+    if number in (QIAN, KUN):
+        return (YONG,)
+    return (CHANGED | GUA_CI,)
+
+def _build_table() -> array:
+    """RULES[(卦序 - 1) << 6 | 动爻掩码] = 主引用 + 1 | (次引用 + 1) << 5"""
+    table = array("H", bytes(2 * 64 * 64))
+    for number in range(1, 65):
+        for mask in range(64):
+            entry = 0
+            for k, ref in enumerate(_select(number, mask)):
+                entry |= (ref + 1) << (k * REF_BITS)
+            table[(number - 1) << 6 | mask] = entry
+    return table
+
+RULES = _build_table()
+
+def moving_mask(moving: List[int]) -> int:
+    """动爻列表 -> 掩码，第 i 位为第 i 爻（自下而上）"""
+    mask = 0
+    for i, bit in enumerate(moving[:6]):
+        mask |= (bit & 1) << i
+    return mask
+
+def governing_refs(number: int, mask: int) -> Tuple[int, ...]:
+    """
+    查表得到占断依据
+
+    参数:
+        number: 本卦卦序(1-64)
+        mask: 动爻掩码
+
+    返回:
+        文字引用元组，主依据在前
+    """
+    entry = RULES[(number - 1) << 6 | mask]
+    refs = []
+    while entry:
+        refs.append((entry & REF_MASK) - 1)
+        entry >>= REF_BITS
+    return tuple(refs)
+
+def rule_name(number: int, mask: int) -> str:
+    """占断规则说明"""
+    count = bin(mask).count("1")
+    if count == 6 and number in (QIAN, KUN):
+        return YONG_RULE
+    return RULE_NAMES[count]
+
+def resolve(ref: int, original_data: Dict, changed_data: Optional[Dict]) -> str:
+    """
+    将文字引用解析为卦辞或爻辞
+
+    参数:
+        ref: 文字引用
+        original_data: 本卦数据
+        changed_data: 之卦数据，无动爻时可为 None
+    """
+    data = changed_data if ref & CHANGED and changed_data else original_data
+    index = ref & 0b111
+    if index == GUA_CI:
+        return f"{data.get('name', '')}：{data.get('gua_ci', '无卦辞。')}"
+    lines = data.get("lines", [])
+    return lines[index] if index < len(lines) else "无爻辞。"
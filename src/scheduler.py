@@ -0,0 +1,189 @@
+import time
+import asyncio
+from array import array
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List
+
+class SchedulerBusy(Exception):
+    """用户排队中的请求已达上限"""
+
+class LatencyStats:
+    """
+    单个优先级类别的延迟统计
+
+    记录请求数、排队等待与处理耗时的累计值与最大值，
+    并在环形缓冲区中保留最近若干次等待时间用于计算分位数。
+    """
+
+    def __init__(self, window: int = 512):
+        self.count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.service_total = 0.0
+        self._recent = array("d", bytes(8 * max(1, window)))
+        self._next = 0
+
+    def add(self, wait: float, service: float):
+        """记录一次请求的排队等待与处理耗时（秒）"""
+        self.count += 1
+        self.wait_total += wait
+        self.service_total += service
+        if wait > self.wait_max:
+            self.wait_max = wait
+        self._recent[self._next] = wait
+        self._next = (self._next + 1) % len(self._recent)
+
+    def percentile(self, q: float) -> float:
+        """最近若干次等待时间的分位数（秒）"""
+        samples = sorted(self._recent[:min(self.count, len(self._recent))])
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def summary(self) -> Dict[str, float]:
+        """统计摘要，时间单位为毫秒"""
+        count = max(1, self.count)
+        return {
+            "count": self.count,
+            "wait_avg_ms": self.wait_total / count * 1000,
+            "wait_p95_ms": self.percentile(0.95) * 1000,
+            "wait_max_ms": self.wait_max * 1000,
+            "service_avg_ms": self.service_total / count * 1000,
+        }
+
+class RequestScheduler:
+    """
+    请求调度器
+
+    - 快速通道：帮助、ID、历史、管理等廉价命令与无需调用大语言模型的起卦直接执行，
+      只记录耗时，不受慢请求影响
+    - 工作池：大语言模型解卦最多同时执行 workers 个，其余按用户排队，
+      各用户之间轮转取请求，同一用户连续提问不会挤占其他用户
+
+    各类别的排队等待与处理耗时记录在 stats 中。
+    """
+
+    # 内置优先级类别
+    CLASSES = ("fast", "reading", "llm")
+
+    def __init__(self, workers: int = 4, max_pending: int = 3):
+        """
+        参数:
+            workers: 同时执行的大语言模型请求数
+            max_pending: 每个用户最多排队的请求数，超出时抛出 SchedulerBusy
+        """
+        self.workers = max(1, int(workers))
+        self.max_pending = max(1, int(max_pending))
+        self.stats: Dict[str, LatencyStats] = {name: LatencyStats() for name in self.CLASSES}
+
+        self._active = 0
+        # 用户ID -> 等待中的请求；_order 为有请求排队的用户，按轮转顺序排列
+        self._queues: Dict[str, Deque[asyncio.Future]] = {}
+        self._order: Deque[str] = deque()
+
+    def record(self, name: str, wait: float, service: float):
+        """记录一次请求的耗时（秒），未知类别自动创建"""
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = LatencyStats()
+        stats.add(wait, service)
+
+    def pending(self, user_id: str = None) -> int:
+        """排队中的请求数，指定用户ID时只统计该用户"""
+        if user_id is not None:
+            return len(self._queues.get(user_id, ()))
+        return sum(len(queue) for queue in self._queues.values())
+
+    def saturated(self) -> bool:
+        """工作池已满且排队数不少于工作数，新请求预计至少要等一轮"""
+        return self._active >= self.workers and self.pending() >= self.workers
+
+    @property
+    def active(self) -> int:
+        """正在执行的工作池请求数"""
+        return self._active
+
+    async def run(self, user_id: str, job: Callable[[], Awaitable[Any]], name: str = "llm") -> Any:
+        """
+        在工作池中执行请求
+
+        参数:
+            user_id: 请求所属用户，用于公平排队
+            job: 返回协程的函数，取得执行名额后才调用
+            name: 统计类别
+
+        返回:
+            job 的结果
+        """
+        arrived = time.monotonic()
+        if self._active < self.workers and not self._order:
+            self._active += 1
+        else:
+            await self._wait_turn(user_id)
+
+        started = time.monotonic()
+        try:
+            return await job()
+        finally:
+            self.record(name, started - arrived, time.monotonic() - started)
+            self._release()
+
+    async def _wait_turn(self, user_id: str):
+        """排队等待执行名额，名额由 _release 直接转交"""
+        queue = self._queues.get(user_id)
+        if queue is None:
+            queue = self._queues[user_id] = deque()
+            self._order.append(user_id)
+        elif len(queue) >= self.max_pending:
+            raise SchedulerBusy(f"用户 {user_id} 已有 {len(queue)} 个请求在排队")
+
+        future = asyncio.get_running_loop().create_future()
+        queue.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 名额已转交但请求被取消时归还名额，仍在排队的从队列中移除
+            if future.done() and not future.cancelled():
+                self._release()
+            else:
+                self._discard(user_id, future)
+            raise
+
+    def _discard(self, user_id: str, future: asyncio.Future):
+        """从队列中移除被取消的请求"""
+        queue = self._queues.get(user_id)
+        if queue is None or future not in queue:
+            return
+        queue.remove(future)
+        if not queue:
+            del self._queues[user_id]
+            self._order.remove(user_id)
+
+    def _release(self):
+        """释放一个执行名额，按用户轮转转交给下一个排队的请求"""
+        while self._order:
+            user_id = self._order.popleft()
+            queue = self._queues[user_id]
+            future = queue.popleft()
+            if queue:
+                self._order.append(user_id)
+            else:
+                del self._queues[user_id]
+            if not future.done():
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    def report(self) -> List[str]:
+        """各类别的延迟统计，每类一行"""
+        lines = [f"工作池: 执行中 {self._active}/{self.workers}，排队 {self.pending()}"]
+        for name, stats in self.stats.items():
+            if not stats.count:
+                continue
+            s = stats.summary()
+            lines.append(
+                f"{name}: {s['count']} 次，排队平均 {s['wait_avg_ms']:.1f}ms / "
+                f"P95 {s['wait_p95_ms']:.1f}ms / 最大 {s['wait_max_ms']:.1f}ms，"
+                f"处理平均 {s['service_avg_ms']:.1f}ms"
+            )
+        return lines
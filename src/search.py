@@ -0,0 +1,617 @@
+import os
+import re
+import json
+import time
+import heapq
+import threading
+from array import array
+from datetime import datetime
+from typing import Dict, List, Any, Optional, Iterable, Sequence, Set, Tuple
+
+from .data_constants import HEXAGRAM_NAMES
+from .storage import FileLock, atomic_write, read_json
+from .similar import CODES, POPCOUNT, stored_code, neighbour_masks
+from .log import get_logger
+
+logger = get_logger("search")
+
+def _build_hexagram_lookup() -> Dict[str, int]:
+    """卦名全称与简称（如 水雷屯 / 屯、乾为天 / 乾）到卦序的映射"""
+    lookup = {}
+    for number, name in HEXAGRAM_NAMES.items():
+        lookup[name] = number
+        lookup[name[0] if name[1] == "为" else name[2:]] = number
+    return lookup
+
+class HistoryIndex:
+    """
+    算卦历史的倒排索引
+
+    问题文本按单字与相邻两字（n-gram）建立索引，卦序、吉凶与用户ID作为特殊词项，
+    查询时只需对少量倒排列表求交集，无需逐个读取历史文件。
+
+    每条文档另按 12 位的 (本卦, 动爻) 编码分入 4096 个桶，查询相似的起卦时
+    只需访问与目标编码汉明距离不超过 k 的桶（见 similar.py）。
+
+    删除的文档先记为墓碑，检索时跳过，合并快照时去掉并重新编号。
+
+    持久化由两部分组成：
+    - index.json: 快照，文档以数组保存，倒排列表使用差值编码
+    - index.log: 快照之后新增的文档（数组）、删除的记录（{"d": [用户ID, 时间戳]}）与清除的用户
+      （{"u": 用户ID}），每行一条，启动时重放
+
+    多个进程可能共用同一份索引（协调模式切换期间各自以本地模式写入），因此每次写日志与
+    合并快照前都在日志锁内先重放其他进程追加的日志；日志文件已被其他进程的 compact 替换时
+    （设备与 inode 变化）从快照重新加载，避免以过期的内存索引覆盖快照。
+
+    历史记录在工作线程中写入，查询在事件循环中进行，内存索引由线程锁保护。
+    与 TextStore 相同，先取日志锁再取线程锁，查询不会因等待文件锁而阻塞。
+    """
+
+    # 日志超过该条数时合并进快照
+    COMPACT_THRESHOLD = 1000
+
+    # 检索前去掉的标点与空白
+    STRIP_PATTERN = re.compile(r'[\W_]+')
+
+    # 卦名（全称与简称） -> 卦序
+    HEXAGRAM_LOOKUP = _build_hexagram_lookup()
+
+    FORTUNES = ("吉", "凶", "平")
+
+    # 无效卦序的文档的编码
+    NO_CODE = 0xFFFF
+
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        os.makedirs(self.index_dir, exist_ok=True)
+        self.snapshot_file = os.path.join(self.index_dir, "index.json")
+        self.log_file = os.path.join(self.index_dir, "index.log")
+        self._log_lock = FileLock(self.log_file)
+        self._mutex = threading.RLock()
+
+        # 文档: [用户ID, 时间戳, 问题, 原卦, 变卦, 吉凶, 起卦编码]，编码无法确定时为 None
+        self.docs: List[List[Any]] = []
+        self.postings: Dict[str, List[int]] = {}
+        # 文档编号 -> 起卦编码；编码 -> 文档编号列表
+        self.codes = array("H")
+        self.buckets: List[List[int]] = [[] for _ in range(CODES)]
+        # 已删除的文档编号；含有已删除文档、尚未清理的编码桶
+        self.deleted: Set[int] = set()
+        self._stale_buckets: Set[int] = set()
+        # 已重放的日志条数、字节位置与日志文件的 (设备, inode)
+        self._log_count = 0
+        self._log_pos = 0
+        self._log_marker: Optional[Tuple[int, int]] = None
+        self._loaded = False
+        # 加载了旧版本的文档（没有起卦编码），需由历史记录重建
+        self.outdated = False
+
+        self._load()
+
+    def add(self, user_id: str, record: Dict) -> int:
+        """
+        添加一条历史记录到索引
+
+        参数:
+            user_id: 用户ID
+            record: HistoryManager 生成的记录
+
+        返回:
+            文档编号
+        """
+        doc = self._make_doc(user_id, record)
+        self._commit([doc])
+        return len(self.docs) - 1
+
+    def remove(self, user_id: str, timestamps: Iterable[int]) -> int:
+        """
+        删除用户指定时间戳的记录，历史记录被裁剪或过期时调用
+
+        参数:
+            user_id: 用户ID
+            timestamps: 记录的时间戳（秒）
+
+        返回:
+            删除的文档数
+        """
+        user_id = str(user_id)
+        return self._commit([{"d": [user_id, int(ts)]} for ts in timestamps])
+
+    def remove_user(self, user_id: str) -> int:
+        """
+        删除用户的全部记录，用户清除历史时调用
+
+        返回:
+            删除的文档数
+        """
+        return self._commit([{"u": str(user_id)}])
+
+    def _delete_user(self, user_id: str) -> int:
+        """将用户的全部文档记为删除，并移除其用户词项"""
+        removed = 0
+        for doc_id in self.postings.pop(f"#u{user_id}", ()):
+            if doc_id not in self.deleted:
+                self._tombstone(doc_id)
+                removed += 1
+        return removed
+
+    def _delete_doc(self, entry: List[Any]) -> bool:
+        """将用户在该时间戳的一条文档记为删除，返回是否找到"""
+        user_id, ts = entry
+        for doc_id in self.postings.get(f"#u{user_id}", ()):
+            if doc_id not in self.deleted and self.docs[doc_id][1] == ts:
+                self._tombstone(doc_id)
+                return True
+        return False
+
+    def _tombstone(self, doc_id: int):
+        """标记文档已删除，其所在的编码桶在下次相似查询前清理"""
+        self.deleted.add(doc_id)
+        code = self.codes[doc_id]
+        if code != self.NO_CODE:
+            self.codes[doc_id] = self.NO_CODE
+            self._stale_buckets.add(code)
+
+    def _prune_buckets(self):
+        """从编码桶中移除已删除的文档"""
+        deleted = self.deleted
+        for code in self._stale_buckets:
+            self.buckets[code] = [doc_id for doc_id in self.buckets[code] if doc_id not in deleted]
+        self._stale_buckets.clear()
+
+    def _apply(self, entry: Any) -> int:
+        """将一条日志项应用到内存索引，返回新增或删除的文档数"""
+        if isinstance(entry, dict) and "u" in entry:
+            return self._delete_user(entry["u"])
+        if isinstance(entry, dict):
+            return int(self._delete_doc(entry["d"]))
+        self._index_doc(entry)
+        return 1
+
+    def _commit(self, entries: List[Any]) -> int:
+        """
+        在日志锁内先补上其他进程的日志，再应用并追加生效的日志项，超过阈值时合并进快照
+
+        返回:
+            新增或删除的文档数
+        """
+        changed = 0
+        applied = None
+        try:
+            with self._log_lock.write(), open(self.log_file, "a+b") as f, self._mutex:
+                self._follow_log(f)
+                applied = []
+                for entry in entries:
+                    count = self._apply(entry)
+                    if count:
+                        changed += count
+                        applied.append(entry)
+                if applied:
+                    data = "".join(
+                        json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n" for entry in applied
+                    ).encode("utf-8")
+                    f.write(data)
+                    self._log_pos += len(data)
+                    self._log_count += len(applied)
+        except Exception as e:
+            logger.error("写入历史索引失败: %s", e)
+            if applied is None:
+                # 未能取得锁或读取日志时仍更新内存索引，只是不写入日志
+                with self._mutex:
+                    for entry in entries:
+                        changed += self._apply(entry)
+            return changed
+
+        if self._log_count >= self.COMPACT_THRESHOLD:
+            self.compact()
+        return changed
+
+    def search(self, query: str, user_id: Optional[str] = None,
+               since: Optional[float] = None, limit: int = 10) -> List[Dict[str, Any]]:
+        """
+        检索历史记录
+
+        参数:
+            query: 空白分隔的关键词，可为问题文字、卦名（如 坎、水雷屯）或吉/凶/平
+            user_id: 仅检索该用户的记录，None 表示全部用户
+            since: 仅返回该时间戳之后的记录
+            limit: 最大返回条数
+
+        返回:
+            命中的记录列表，从新到旧排序
+        """
+        with self._mutex:
+            return self._search(query, user_id, since, limit)
+
+    def _search(self, query: str, user_id: Optional[str], since: Optional[float], limit: int) -> List[Dict[str, Any]]:
+        """持有线程锁时检索"""
+        # 每个关键词对应若干候选词项组，命中任一组即可；各关键词之间求交集
+        groups = [self._query_terms(keyword) for keyword in query.split()]
+        if user_id is not None:
+            groups.append([[f"#u{user_id}"]])
+        groups = [group for group in groups if any(group)]
+        if not groups:
+            return []
+
+        sets = []
+        for group in groups:
+            docs = set()
+            for terms in group:
+                docs |= self._intersect(terms)
+            if not docs:
+                return []
+            sets.append(docs)
+        sets.sort(key=len)
+
+        result = sets[0]
+        for docs in sets[1:]:
+            result = result & docs
+            if not result:
+                return []
+
+        # 文档编号不保证按时间递增（重建时按用户文件顺序编号），按记录时间戳排序
+        docs, deleted = self.docs, self.deleted
+        hits = [
+            doc_id for doc_id in result
+            if doc_id not in deleted and (since is None or docs[doc_id][1] >= since)
+        ]
+        newest = heapq.nlargest(limit, hits, key=lambda doc_id: (docs[doc_id][1], doc_id))
+        return [self._match(docs[doc_id]) for doc_id in newest]
+
+    def _intersect(self, terms: List[str]) -> Set[int]:
+        """同时含有全部词项的文档编号，从最短的倒排列表开始求交集"""
+        lists = []
+        for term in set(terms):
+            posting = self.postings.get(term)
+            if not posting:
+                return set()
+            lists.append(posting)
+        if not lists:
+            return set()
+        lists.sort(key=len)
+
+        result = set(lists[0])
+        for posting in lists[1:]:
+            result.intersection_update(posting)
+            if not result:
+                break
+        return result
+
+    @staticmethod
+    def _match(doc: List[Any]) -> Dict[str, Any]:
+        """索引文档 -> 返回给调用方的记录"""
+        return {
+            "user_id": doc[0],
+            "timestamp": datetime.fromtimestamp(doc[1]).strftime("%Y-%m-%d %H:%M:%S"),
+            "question": doc[2],
+            "hexagram_original": doc[3],
+            "hexagram_changed": doc[4],
+            "fortune": doc[5]
+        }
+
+    def rebuild(self, records: Iterable[tuple]):
+        """
+        根据已有历史记录重建索引
+
+        参数:
+            records: (用户ID, 记录) 的可迭代对象
+        """
+        with self._mutex:
+            self._reset()
+            for user_id, record in records:
+                self._index_doc(self._make_doc(user_id, record))
+        self.compact(follow=False)
+
+    def _drop_deleted(self):
+        """去掉已删除的文档并重新编号，倒排列表按新旧编号映射，无需重新分词"""
+        deleted = self.deleted
+        remap = array("l", [-1]) * len(self.docs)
+        docs, codes = [], array("H")
+        for doc_id, doc in enumerate(self.docs):
+            if doc_id not in deleted:
+                remap[doc_id] = len(docs)
+                docs.append(doc)
+                codes.append(self.codes[doc_id])
+
+        postings = {}
+        for term, posting in self.postings.items():
+            kept = [remap[doc_id] for doc_id in posting if remap[doc_id] >= 0]
+            if kept:
+                postings[term] = kept
+        buckets = [[] for _ in range(CODES)]
+        for doc_id, code in enumerate(codes):
+            if code != self.NO_CODE:
+                buckets[code].append(doc_id)
+
+        self.docs, self.postings, self.codes, self.buckets = docs, postings, codes, buckets
+        self.deleted = set()
+        self._stale_buckets = set()
+
+    def _reset(self):
+        """清空内存索引"""
+        self.outdated = False
+        self.docs = []
+        self.postings = {}
+        self.codes = array("H")
+        self.buckets = [[] for _ in range(CODES)]
+        self.deleted = set()
+        self._stale_buckets = set()
+
+    def compact(self, follow: bool = True):
+        """
+        将当前索引写为快照并清空日志，已删除的文档不写入快照，其余文档重新编号
+
+        参数:
+            follow: 写入前是否先在锁内重放其他进程的日志；rebuild 由历史文件重建时为 False
+        """
+        try:
+            with self._log_lock.write():
+                with self._mutex:
+                    if follow:
+                        self._sync_log()
+                    if self.deleted:
+                        self._drop_deleted()
+
+                    encoded = {}
+                    for term, posting in self.postings.items():
+                        # 差值编码：倒排列表递增，保存相邻差值更短
+                        deltas = [posting[0]] + [b - a for a, b in zip(posting, posting[1:])]
+                        encoded[term] = deltas
+                    snapshot = json.dumps({"docs": self.docs, "postings": encoded},
+                                          ensure_ascii=False, separators=(",", ":"))
+
+                # 持有日志锁期间其他线程无法写入，落盘时不必挡住查询
+                atomic_write(self.snapshot_file, snapshot)
+                atomic_write(self.log_file, b"")
+                with self._mutex:
+                    self._log_marker = self._path_id(self.log_file)
+                    self._log_pos = 0
+                    self._log_count = 0
+                    self._loaded = True
+        except Exception as e:
+            logger.error("保存历史索引失败: %s", e)
+
+    def reload(self):
+        """补上其他进程写入的日志，日志已被替换时从快照重新加载；接管协调进程时调用"""
+        self._load()
+
+    def __len__(self) -> int:
+        with self._mutex:
+            return len(self.docs) - len(self.deleted)
+
+    def _load(self):
+        """加载快照并重放日志（已加载时只重放新增的日志）"""
+        try:
+            with self._log_lock.read(), self._mutex:
+                self._sync_log()
+        except Exception as e:
+            logger.error("加载历史索引失败: %s", e)
+
+    def _sync_log(self):
+        """持有日志锁时重放其他进程追加的日志"""
+        try:
+            f = open(self.log_file, "rb")
+        except FileNotFoundError:
+            if not self._loaded:
+                self._load_snapshot()
+            return
+        with f:
+            self._follow_log(f)
+
+    def _follow_log(self, f):
+        """持有日志锁时从已打开的日志文件重放新增部分；日志文件已被替换时从快照重新加载"""
+        st = os.fstat(f.fileno())
+        marker = (st.st_dev, st.st_ino)
+        if not self._loaded or marker != self._log_marker or st.st_size < self._log_pos:
+            self._load_snapshot()
+            self._log_marker = marker
+            self._log_pos = 0
+            self._log_count = 0
+
+        f.seek(self._log_pos)
+        data = f.read()
+        # 只处理完整的行
+        end = data.rfind(b"\n") + 1
+        self._log_pos += end
+        for line in data[:end].decode("utf-8").splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                self._apply(json.loads(line))
+            except Exception as e:
+                logger.error("重放历史索引日志失败: %s", e)
+            self._log_count += 1
+
+    def _load_snapshot(self):
+        """清空内存索引并加载快照"""
+        self._reset()
+        self._loaded = True
+        if not os.path.exists(self.snapshot_file):
+            return
+        try:
+            data = read_json(self.snapshot_file, {})
+
+            self.docs = data.get("docs", [])
+            for term, deltas in data.get("postings", {}).items():
+                posting = []
+                current = 0
+                for i, delta in enumerate(deltas):
+                    current = delta if i == 0 else current + delta
+                    posting.append(current)
+                self.postings[term] = posting
+        except Exception as e:
+            logger.error("加载历史索引失败: %s", e)
+            self._reset()
+
+        # 编码桶不保存在快照中，加载时由文档重新计算
+        self.codes = array("H")
+        self.buckets = [[] for _ in range(CODES)]
+        for doc_id, doc in enumerate(self.docs):
+            self._bucket_doc(doc_id, doc)
+
+    @staticmethod
+    def _path_id(path: str) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_dev, st.st_ino
+
+    def _make_doc(self, user_id: str, record: Dict) -> List[Any]:
+        """由历史记录生成索引文档"""
+        return [
+            str(user_id),
+            self._parse_timestamp(record.get("timestamp")),
+            record.get("question", ""),
+            record.get("hexagram_original", 0),
+            record.get("hexagram_changed", 0),
+            record.get("fortune", "平"),
+            stored_code(record)
+        ]
+
+    def _index_doc(self, doc: List[Any]) -> int:
+        """将文档加入内存索引"""
+        doc_id = len(self.docs)
+        self.docs.append(doc)
+
+        terms = set(self._text_terms(doc[2]))
+        terms.add(f"#u{doc[0]}")
+        terms.add(f"#h{doc[3]}")
+        terms.add(f"#h{doc[4]}")
+        terms.add(f"#f{doc[5]}")
+        for term in terms:
+            self.postings.setdefault(term, []).append(doc_id)
+        self._bucket_doc(doc_id, doc)
+        return doc_id
+
+    def _bucket_doc(self, doc_id: int, doc: List[Any]):
+        """按起卦编码将文档放入桶中，旧版本的文档没有编码，在重建前不参与相似查询"""
+        if len(doc) < 7:
+            self.outdated = True
+        code = doc[6] if len(doc) > 6 else None
+        if code is None:
+            self.codes.append(self.NO_CODE)
+            return
+        self.codes.append(code)
+        self.buckets[code].append(doc_id)
+
+    def similar(self, code: int, user_id: Optional[str] = None, distance: int = 1, limit: int = 10,
+                skip: Optional[Sequence[Any]] = None) -> List[Dict[str, Any]]:
+        """
+        查询与指定起卦编码汉明距离不超过 distance 的记录
+
+        参数:
+            code: 12 位起卦编码
+            user_id: 仅查询该用户的记录，None 表示全部用户
+            distance: 最大汉明距离
+            limit: 最大返回条数
+            skip: 需要排除的记录，[用户ID, 时间戳, 问题]（通常为查询所用的那条记录本身）
+
+        返回:
+            记录列表，距离近的在前，同一距离内从新到旧
+        """
+        with self._mutex:
+            return self._similar(code, user_id, distance, limit, skip)
+
+    def _similar(self, code: int, user_id: Optional[str], distance: int, limit: int,
+                 skip: Optional[Sequence[Any]]) -> List[Dict[str, Any]]:
+        """持有线程锁时查询相似记录"""
+        if self._stale_buckets:
+            self._prune_buckets()
+        masks = neighbour_masks(distance)
+        buckets = self.buckets
+        user_docs = self.postings.get(f"#u{user_id}", []) if user_id is not None else None
+        if user_docs is not None and len(user_docs) < sum(len(buckets[code ^ mask]) for mask in masks):
+            # 该用户的记录比候选桶中的记录少，直接按预计算的 1 的个数逐条比较
+            codes = self.codes
+            by_distance: Dict[int, List[int]] = {}
+            for doc_id in user_docs:
+                other = codes[doc_id]
+                if other != self.NO_CODE and POPCOUNT[code ^ other] <= distance:
+                    by_distance.setdefault(POPCOUNT[code ^ other], []).append(doc_id)
+            groups = [(d, by_distance[d]) for d in sorted(by_distance)]
+        else:
+            # 按距离从近到远访问相邻的桶
+            groups = []
+            for mask in masks:
+                bucket = buckets[code ^ mask]
+                if bucket:
+                    d = POPCOUNT[mask]
+                    if groups and groups[-1][0] == d:
+                        groups[-1][1].extend(bucket)
+                    else:
+                        groups.append((d, list(bucket)))
+
+        skip = list(skip) if skip is not None else None
+        matches = []
+        for d, doc_ids in groups:
+            for doc_id in sorted(doc_ids, key=lambda doc_id: (self.docs[doc_id][1], doc_id), reverse=True):
+                doc = self.docs[doc_id]
+                if user_id is not None and doc[0] != user_id:
+                    continue
+                if skip is not None and doc[:3] == skip:
+                    continue
+                match = self._match(doc)
+                match["distance"] = d
+                matches.append(match)
+                if len(matches) >= limit:
+                    return matches
+        return matches
+
+    def clusters(self, distance: int = 1, limit: int = 5) -> List[Tuple[int, int, int]]:
+        """
+        找出相似记录最密集的起卦编码
+
+        参数:
+            distance: 邻域的汉明距离
+            limit: 返回的编码数
+
+        返回:
+            [(编码, 该编码的记录数, 距离不超过 distance 的记录数)]，按后者从多到少
+        """
+        with self._mutex:
+            if self._stale_buckets:
+                self._prune_buckets()
+            counts = [len(bucket) for bucket in self.buckets]
+        masks = neighbour_masks(distance)
+        dense = []
+        for code in range(CODES):
+            if counts[code]:
+                dense.append((code, counts[code], sum(counts[code ^ mask] for mask in masks)))
+        dense.sort(key=lambda item: (-item[2], -item[1], item[0]))
+        return dense[:limit]
+
+    def _text_terms(self, text: str) -> List[str]:
+        """问题文本的单字与双字词项"""
+        text = self.STRIP_PATTERN.sub("", text or "").lower()
+        return list(text) + [text[i:i + 2] for i in range(len(text) - 1)]
+
+    def _query_terms(self, keyword: str) -> List[List[str]]:
+        """
+        查询关键词对应的候选词项组，文档含有任一组的全部词项即为命中
+
+        卦名（如 家人、解、益）同时也是常用词，既匹配卦序也匹配问题文字。
+        """
+        if keyword in self.FORTUNES:
+            return [[f"#f{keyword}"]]
+
+        text = self.STRIP_PATTERN.sub("", keyword).lower()
+        if len(text) <= 1:
+            groups = [list(text)]
+        else:
+            groups = [[text[i:i + 2] for i in range(len(text) - 1)]]
+        if keyword in self.HEXAGRAM_LOOKUP:
+            groups.append([f"#h{self.HEXAGRAM_LOOKUP[keyword]}"])
+        return groups
+
+    @staticmethod
+    def _parse_timestamp(value: Any) -> int:
+        """将记录中的时间转换为时间戳"""
+        if isinstance(value, (int, float)):
+            return int(value)
+        try:
+            return int(datetime.strptime(value, "%Y-%m-%d %H:%M:%S").timestamp())
+        except (TypeError, ValueError):
+            return int(time.time())
@@ -0,0 +1,106 @@
+"""
+卦象相似度
+
+一次起卦可以编码为 12 位整数：低 6 位为本卦的二进制（第 i 位为第 i 爻，自下而上），
+高 6 位为动爻掩码。两次起卦的相似度即两个编码异或后的 1 的个数（汉明距离），
+距离 1 表示只有一爻的阴阳或动静不同。
+
+导入时预先计算 4096 个编码的 1 的个数，以及按 1 的个数排序的全部异或掩码；
+查询距离不超过 k 的编码只需依次异或前 MASK_COUNTS[k] 个掩码。
+"""
+from array import array
+from typing import Dict, List, Optional
+
+from .data_constants import HEXAGRAM_BINARY, HEXAGRAM_MAP, HEXAGRAM_NAMES, LEGACY_HEXAGRAM_MAP
+
+CODE_BITS = 12
+CODES = 1 << CODE_BITS
+
+# 编码 -> 1 的个数
+POPCOUNT = array("B", [bin(code).count("1") for code in range(CODES)])
+
+# 全部异或掩码，按 1 的个数从少到多排列
+MASKS_BY_DISTANCE = array("H", sorted(range(CODES), key=lambda mask: (POPCOUNT[mask], mask)))
+
+# MASK_COUNTS[k] 为距离不超过 k 的掩码个数（1、13、79、299 ……）
+MASK_COUNTS = tuple(sum(1 for mask in range(CODES) if POPCOUNT[mask] <= k) for k in range(CODE_BITS + 1))
+
+LINE_NAMES = ("初爻", "二爻", "三爻", "四爻", "五爻", "上爻")
+
+# 二进制 -> 卦序
+_NUMBER_BY_BINARY = {binary: number for number, binary in enumerate(HEXAGRAM_BINARY) if number}
+
+def reading_code(original: int, changed: int) -> Optional[int]:
+    """
+    由本卦与之卦的卦序得到编码，卦序无效时返回 None
+
+    之卦由本卦的动爻翻转得到，两卦二进制的异或即为动爻掩码。
+    """
+    if not (1 <= original <= 64 and 1 <= changed <= 64):
+        return None
+    binary = HEXAGRAM_BINARY[original]
+    return binary | (binary ^ HEXAGRAM_BINARY[changed]) << 6
+
+# 当前与修正前的映射表（下标为六爻二进制值），以及各自的 卦序 -> 六爻二进制值列表
+_MAPS = tuple(
+    (table, {number: [binary for binary in range(64) if table[binary] == number] for number in range(1, 65)})
+    for table in (tuple(HEXAGRAM_MAP[binary] for binary in range(64)), LEGACY_HEXAGRAM_MAP)
+)
+
+def record_code(original: int, changed: int, moving: int, lines: Optional[int] = None) -> Optional[int]:
+    """
+    由历史记录得到编码，无法确定时返回 None
+
+    记录保存了本卦六爻（lines）时直接使用。映射表修正之前的记录只有卦序与动爻掩码，
+    卦序可能是旧映射下的结果，不能直接按 reading_code 换算：在新旧两张映射表下
+    分别找出本卦为 original、翻转动爻后为 changed 的六爻，只有唯一一种时才可确定。
+
+    参数:
+        original: 本卦卦序
+        changed: 之卦卦序
+        moving: 动爻掩码，下爻为第0位
+        lines: 本卦六爻的二进制值，旧记录为 None
+    """
+    if not 0 <= moving < 64:
+        return None
+    if lines is not None:
+        return lines | moving << 6 if 0 <= lines < 64 else None
+    candidates = {
+        binary for table, binaries in _MAPS for binary in binaries.get(original, ())
+        if table[binary ^ moving] == changed
+    }
+    if len(candidates) != 1:
+        return None
+    return candidates.pop() | moving << 6
+
+def stored_code(record: Dict) -> Optional[int]:
+    """
+    由 HistoryManager 展开的记录字典得到编码，见 record_code
+
+    记录中的 moving 为动爻列表，original（如有）为本卦六爻；没有动爻信息时返回 None。
+    """
+    if "moving" not in record:
+        return None
+    lines = _line_bits(record["original"]) if "original" in record else None
+    return record_code(record.get("hexagram_original", 0), record.get("hexagram_changed", 0),
+                       _line_bits(record["moving"]), lines)
+
+def _line_bits(values: List[int]) -> int:
+    """六爻列表（自下而上） -> 二进制值"""
+    bits = 0
+    for i, bit in enumerate(values):
+        bits |= (bit & 1) << i
+    return bits
+
+def neighbour_masks(distance: int) -> array:
+    """距离不超过 distance 的全部异或掩码，距离小的在前"""
+    distance = max(0, min(CODE_BITS, distance))
+    return MASKS_BY_DISTANCE[:MASK_COUNTS[distance]]
+
+def describe_code(code: int) -> str:
+    """编码的文字说明，如 乾为天（初爻、三爻动）"""
+    binary, mask = code & 0b111111, code >> 6
+    original = _NUMBER_BY_BINARY.get(binary, 0)
+    name = HEXAGRAM_NAMES.get(original, "未知")
+    moving = [LINE_NAMES[i] for i in range(6) if mask >> i & 1]
+    return f"{name}（{'、'.join(moving)}动）" if moving else f"{name}（无动爻）"
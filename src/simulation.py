@@ -0,0 +1,331 @@
+"""
+卦象统计模拟引擎（可选依赖 NumPy）
+
+用于批量生成大量卦象，验证各起卦方法的卦序分布与动爻分布是否合理。
+每次起卦打包为一个 uint16：低 6 位为原卦，高 6 位为动爻（下爻为第0位），
+与 HexagramCalculator 的二进制约定一致。
+"""
+import math
+import hashlib
+from typing import Dict, List, Any, Optional
+
+try:
+    import numpy as np
+except ImportError:  # NumPy 为可选依赖，未安装时仅该模块不可用
+    np = None
+
+from .data_constants import (
+    HEXAGRAM_MAP, LINE_PROBABILITIES, LINE_STATES, COIN_LINE_TABLE, YARROW_LINE_TABLE
+)
+
+
+def _gamma_q(a: float, x: float) -> float:
+    """正则化上不完全伽马函数 Q(a, x)，用于卡方检验的 p 值"""
+    if x <= 0:
+        return 1.0
+    if x < a + 1:
+        # 级数展开求 P(a, x)
+        term = total = 1.0 / a
+        n = a
+        for _ in range(1000):
+            n += 1
+            term *= x / n
+            total += term
+            if abs(term) < abs(total) * 1e-15:
+                break
+        return 1.0 - total * math.exp(-x + a * math.log(x) - math.lgamma(a))
+
+    # 连分式求 Q(a, x)
+    tiny = 1e-300
+    b = x + 1 - a
+    c = 1 / tiny
+    d = 1 / b
+    h = d
+    for i in range(1, 1000):
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        d = tiny if abs(d) < tiny else d
+        c = b + an / c
+        c = tiny if abs(c) < tiny else c
+        d = 1 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1) < 1e-15:
+            break
+    return math.exp(-x + a * math.log(x) - math.lgamma(a)) * h
+
+
+def chi_square(observed: List[float], expected_probs: List[float]) -> Dict[str, float]:
+    """
+    卡方拟合优度检验
+
+    参数:
+        observed: 各类别的观测频数
+        expected_probs: 各类别的理论概率（和为1）
+
+    返回:
+        包含统计量、自由度与 p 值的字典
+    """
+    total = float(sum(observed))
+    statistic = 0.0
+    categories = 0
+    for obs, prob in zip(observed, expected_probs):
+        if prob <= 0:
+            continue
+        expected = total * prob
+        statistic += (obs - expected) ** 2 / expected
+        categories += 1
+
+    dof = max(categories - 1, 1)
+    return {
+        "statistic": statistic,
+        "dof": dof,
+        "p_value": _gamma_q(dof / 2.0, statistic / 2.0)
+    }
+
+
+class HexagramSimulator:
+    """
+    基于 NumPy 的向量化起卦模拟器
+
+    与 HexagramCalculator 中逐爻循环的实现算法一致，但一次生成整批卦象，
+    并通过数组索引查 King Wen 卦序表得到统计直方图。
+    """
+
+    # 支持模拟的起卦方法
+    METHODS = ("random", "text", "数字")
+
+    def __init__(self, seed: Optional[int] = None):
+        if np is None:
+            raise ImportError("统计模拟需要安装 numpy：pip install numpy")
+
+        self.rng = np.random.default_rng(seed)
+
+        # 六位二进制值 -> 卦序 的查找数组
+        self.king_wen = np.zeros(64, dtype=np.uint8)
+        for binary, number in HEXAGRAM_MAP.items():
+            self.king_wen[binary] = number
+
+        # 0-63 的位计数表
+        self.popcount = np.array([bin(i).count("1") for i in range(64)], dtype=np.uint8)
+
+        # 随机起卦的取位查找表，与 HexagramCalculator.RANDOM_MODES 一致
+        self.line_tables = {
+            "coin": (3, np.array(COIN_LINE_TABLE, dtype=np.uint8)),
+            "yarrow": (4, np.array(YARROW_LINE_TABLE, dtype=np.uint8)),
+        }
+
+    def simulate(self, method: str, n: int, random_mode: str = "coin") -> "np.ndarray":
+        """
+        按指定方法批量起卦
+
+        参数:
+            method: 起卦方法，可选 'random', 'text', '数字'
+            n: 起卦次数
+            random_mode: 随机起卦的取位模式，'coin' 或 'yarrow'
+
+        返回:
+            uint16 数组，低 6 位为原卦，高 6 位为动爻
+        """
+        if method == "random":
+            return self.simulate_random(n, random_mode)
+        elif method == "text":
+            return self.simulate_text(n)
+        elif method == "数字":
+            return self.simulate_number(n)
+        raise ValueError(f"不支持模拟的起卦方法: {method}")
+
+    def simulate_random(self, n: int, random_mode: str = "coin") -> "np.ndarray":
+        """随机起卦法：一次取 6 组随机位（掷币每组 3 位，蓍草每组 4 位）后查表"""
+        width, table = self.line_tables[random_mode]
+        bits = self.rng.integers(0, 1 << (width * 6), size=n, dtype=np.uint32)
+        original = np.zeros(n, dtype=np.uint8)
+        moving = np.zeros(n, dtype=np.uint8)
+
+        for i in range(6):
+            state = table[(bits >> (width * i)) & ((1 << width) - 1)]
+            original |= (state & 1) << i
+            moving |= (state >> 1) << i
+
+        return self._pack(original, moving)
+
+    def simulate_text(self, n: int, prefix: str = "问题") -> "np.ndarray":
+        """
+        文本起卦法：对 n 条不同文本计算 SHA256 后按位取卦
+
+        哈希本身无法向量化，此处仅逐条求摘要，取位与统计均在数组上完成。
+        """
+        digests = b"".join(
+            hashlib.sha256(f"{prefix}{i}".encode("utf-8")).digest() for i in range(n)
+        )
+        data = np.frombuffer(digests, dtype=np.uint8).reshape(n, 32)
+
+        # 十六进制字符 i 对应第 i//2 个字节的高半字节（i 为偶数）或低半字节
+        high = data >> 4
+        low = data & 0x0F
+
+        original = np.zeros(n, dtype=np.uint8)
+        moving = np.zeros(n, dtype=np.uint8)
+        for i in range(6):
+            nibble = high[:, i // 2] if i % 2 == 0 else low[:, i // 2]
+            original |= (nibble & 1) << i
+
+            # 倒数第 i+1 个十六进制字符
+            byte = data.shape[1] - 1 - i // 2
+            nibble = low[:, byte] if i % 2 == 0 else high[:, byte]
+            moving |= (nibble < 5).astype(np.uint8) << i
+
+        return self._pack(original, moving)
+
+    def simulate_number(self, n: int, digits: int = 6) -> "np.ndarray":
+        """
+        数字起卦法：随机生成 digits 位数字串
+
+        与 int() 解析一致，前导零会被去掉，不足 6 位的爻用随机阴阳补齐且不为动爻。
+        """
+        values = self.rng.integers(0, 10, size=(n, digits), dtype=np.uint8)
+
+        # 去掉前导零后的有效位数（全零时为 "0"，长度 1）
+        nonzero = values != 0
+        first = np.where(nonzero.any(axis=1), nonzero.argmax(axis=1), digits - 1)
+        length = digits - first
+
+        filler = self.rng.integers(0, 2, size=(n, 6), dtype=np.uint8)
+        original = np.zeros(n, dtype=np.uint8)
+        moving = np.zeros(n, dtype=np.uint8)
+        for i in range(6):
+            if i < digits:
+                digit = values[:, digits - 1 - i]
+            else:
+                digit = np.zeros(n, dtype=np.uint8)
+            present = i < length
+
+            line = np.where(present, digit & 1, filler[:, i]).astype(np.uint8)
+            move = (present & ((digit == 6) | (digit == 9))).astype(np.uint8)
+            original |= line << i
+            moving |= move << i
+
+        return self._pack(original, moving)
+
+    def histograms(self, codes: "np.ndarray") -> Dict[str, "np.ndarray"]:
+        """
+        计算卦序与动爻直方图
+
+        返回:
+            original: 原卦卦序频数（下标 0 对应第 1 卦）
+            changed: 变卦卦序频数
+            moving_count: 动爻个数 0-6 的频数
+            moving_position: 初爻到上爻各自为动爻的次数
+            line_states: 6/7/8/9 四象的频数
+        """
+        original = (codes & 0x3F).astype(np.uint8)
+        moving = (codes >> 6).astype(np.uint8)
+        changed = original ^ moving
+
+        positions = np.arange(6, dtype=np.uint8)
+        line_bits = (original[:, None] >> positions) & 1
+        move_bits = (moving[:, None] >> positions) & 1
+        # 四象编码：阴阳*2 + 动静，再映射到 6/7/8/9
+        state_index = (line_bits * 2 + move_bits).ravel()
+        state_counts = np.bincount(state_index, minlength=4)
+
+        return {
+            "original": np.bincount(self.king_wen[original], minlength=65)[1:],
+            "changed": np.bincount(self.king_wen[changed], minlength=65)[1:],
+            "moving_count": np.bincount(self.popcount[moving], minlength=7),
+            "moving_position": move_bits.sum(axis=0),
+            # (0,0)=8 (0,1)=6 (1,0)=7 (1,1)=9
+            "line_states": np.array([state_counts[1], state_counts[2], state_counts[0], state_counts[3]])
+        }
+
+    def report(self, method: str, n: int, model: str = "coin", random_mode: str = "coin") -> Dict[str, Any]:
+        """
+        生成某起卦方法相对于理想掷币/蓍草概率的卡方检验报告
+
+        参数:
+            method: 起卦方法
+            n: 模拟次数
+            model: 理论模型，'coin' 或 'yarrow'
+            random_mode: 随机起卦的取位模式
+
+        返回:
+            报告字典，包含直方图与三项卡方检验结果
+        """
+        if model not in LINE_PROBABILITIES:
+            raise ValueError(f"未知的概率模型: {model}")
+
+        probs = LINE_PROBABILITIES[model]
+        hist = self.histograms(self.simulate(method, n, random_mode))
+
+        # 理论上每爻为阳的概率
+        p_yang = sum(p for value, p in probs.items() if LINE_STATES[value][0] == 1)
+        p_moving = sum(p for value, p in probs.items() if LINE_STATES[value][1] == 1)
+
+        hexagram_probs = []
+        for binary in range(64):
+            ones = bin(binary).count("1")
+            hexagram_probs.append(p_yang ** ones * (1 - p_yang) ** (6 - ones))
+        # 按卦序累加（映射表若有重复卦序，对应概率会合并）
+        ordered = [0.0] * 64
+        for binary, prob in enumerate(hexagram_probs):
+            ordered[HEXAGRAM_MAP[binary] - 1] += prob
+
+        moving_probs = [
+            math.comb(6, k) * p_moving ** k * (1 - p_moving) ** (6 - k) for k in range(7)
+        ]
+
+        return {
+            "method": method,
+            "model": model,
+            "samples": n,
+            "histograms": hist,
+            # 映射表中没有任何二进制值对应的卦序，这些卦永远不会出现
+            "unreachable": [number for number in range(1, 65) if ordered[number - 1] == 0],
+            "tests": {
+                "hexagram": chi_square(hist["original"].tolist(), ordered),
+                "moving_count": chi_square(hist["moving_count"].tolist(), moving_probs),
+                "line_states": chi_square(hist["line_states"].tolist(), [probs[v] for v in (6, 7, 8, 9)])
+            }
+        }
+
+    def format_report(self, report: Dict[str, Any]) -> str:
+        """将报告格式化为可读文本"""
+        names = {"hexagram": "卦序分布", "moving_count": "动爻个数", "line_states": "四象分布"}
+        lines = [f"方法: {report['method']}  模型: {report['model']}  样本数: {report['samples']}"]
+        for key, result in report["tests"].items():
+            lines.append(
+                f"  {names[key]}: χ²={result['statistic']:.2f} 自由度={result['dof']} p={result['p_value']:.4f}"
+            )
+
+        if report["unreachable"]:
+            lines.append("  无法起出的卦序: " + ", ".join(str(n) for n in report["unreachable"]))
+
+        states = report["histograms"]["line_states"]
+        total = max(int(states.sum()), 1)
+        lines.append("  四象频率: " + " ".join(
+            f"{value}={count / total:.4f}" for value, count in zip((6, 7, 8, 9), states.tolist())
+        ))
+        return "\n".join(lines)
+
+    @staticmethod
+    def _pack(original: "np.ndarray", moving: "np.ndarray") -> "np.ndarray":
+        """将原卦与动爻打包为 uint16"""
+        return original.astype(np.uint16) | (moving.astype(np.uint16) << 6)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="起卦方法分布的统计模拟")
+    parser.add_argument("-n", "--samples", type=int, default=1_000_000)
+    parser.add_argument("--model", default="coin", choices=sorted(LINE_PROBABILITIES))
+    parser.add_argument("--random-mode", default="coin", choices=sorted(LINE_PROBABILITIES))
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    simulator = HexagramSimulator(seed=args.seed)
+    for name in HexagramSimulator.METHODS:
+        print(simulator.format_report(simulator.report(
+            name, args.samples, model=args.model, random_mode=args.random_mode
+        )))
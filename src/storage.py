@@ -0,0 +1,236 @@
+"""
+文件存储基础操作
+
+- atomic_write / atomic_write_json: 先写同目录下的临时文件再 rename 替换，
+  读取方不会看到写了一半或被截断的文件，因此读取无需加锁
+- FileLock: 基于旁路锁文件（<路径>.lock）的读写锁，支持超时与 asyncio 等待，
+  用于跨进程的“读取-修改-写回”
+- fsync 策略: always 每次写入都落盘；interval 合并一段时间内的写入后统一落盘；
+  never 交给操作系统
+"""
+import os
+import json
+import time
+import fcntl
+import asyncio
+import itertools
+import contextlib
+from typing import Any, Optional, Set, Union, Iterator, AsyncIterator
+
+FSYNC_MODES = ("always", "interval", "never")
+
+class LockTimeout(TimeoutError):
+    """等待文件锁超时"""
+
+class FsyncPolicy:
+    """
+    fsync 策略
+
+    interval 模式下写入只记录待落盘的路径，距上次落盘超过 interval 秒时
+    一并 fsync，调用 sync() 可立即落盘（如插件卸载时）。
+    """
+
+    def __init__(self, mode: str = "always", interval: float = 1.0):
+        self.mode = mode if mode in FSYNC_MODES else "always"
+        self.interval = max(0.0, float(interval))
+        self._dirty: Set[str] = set()
+        self._last_sync = time.monotonic()
+
+    def after_write(self, fd: int, path: str):
+        """临时文件写完、替换之前调用"""
+        if self.mode == "always":
+            os.fsync(fd)
+        elif self.mode == "interval":
+            self._dirty.add(path)
+
+    def after_replace(self, path: str):
+        """替换完成后调用，always 模式同步目录项，interval 模式按需批量落盘"""
+        if self.mode == "always":
+            _fsync_dir(os.path.dirname(path))
+        elif self.mode == "interval" and time.monotonic() - self._last_sync >= self.interval:
+            self.sync()
+
+    def sync(self):
+        """将 interval 模式下积累的写入全部落盘"""
+        dirty, self._dirty = self._dirty, set()
+        directories = set()
+        for path in dirty:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                directories.add(os.path.dirname(path))
+            except FileNotFoundError:
+                pass
+        for directory in directories:
+            _fsync_dir(directory)
+        self._last_sync = time.monotonic()
+
+def _fsync_dir(directory: str):
+    """同步目录项，使 rename 本身也落盘"""
+    try:
+        fd = os.open(directory or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+# 临时文件名序号，避免同一进程内并发写入同一路径时冲突
+_tmp_counter = itertools.count()
+
+# 进程内共用的策略与默认锁超时，由插件按配置设置
+_policy = FsyncPolicy()
+_lock_timeout = 10.0
+
+def configure(fsync: str = "always", interval: float = 1.0, lock_timeout: float = 10.0):
+    """设置全局 fsync 策略与文件锁默认超时，切换前先落盘已积累的写入"""
+    global _policy, _lock_timeout
+    _policy.sync()
+    _policy = FsyncPolicy(fsync, interval)
+    _lock_timeout = max(0.0, float(lock_timeout))
+
+def get_policy() -> FsyncPolicy:
+    return _policy
+
+def sync():
+    """立即落盘 interval 模式下积累的写入"""
+    _policy.sync()
+
+def atomic_write(path: str, data: Union[bytes, str], policy: Optional[FsyncPolicy] = None):
+    """
+    原子写入文件
+
+    参数:
+        path: 目标路径
+        data: 文件内容，字符串按 UTF-8 编码
+        policy: fsync 策略，默认使用全局策略
+    """
+    policy = policy or _policy
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, f".{name}.{os.getpid()}.{next(_tmp_counter)}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            policy.after_write(f.fileno(), path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    policy.after_replace(path)
+
+def atomic_write_json(path: str, value: Any, policy: Optional[FsyncPolicy] = None, **dump_kwargs):
+    """将值序列化为 JSON 后原子写入，默认紧凑格式且不转义中文"""
+    dump_kwargs.setdefault("ensure_ascii", False)
+    if "indent" not in dump_kwargs:
+        dump_kwargs.setdefault("separators", (",", ":"))
+    atomic_write(path, json.dumps(value, **dump_kwargs), policy)
+
+def read_json(path: str, default: Any = None) -> Any:
+    """
+    读取 JSON 文件，文件不存在时返回 default
+
+    文件只通过原子替换写入，读取无需加锁；内容损坏时抛出异常，由调用方决定如何处理。
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+async def atomic_write_async(path: str, data: Union[bytes, str], policy: Optional[FsyncPolicy] = None):
+    """在线程中执行 atomic_write，避免 fsync 阻塞事件循环"""
+    await asyncio.to_thread(atomic_write, path, data, policy)
+
+async def read_json_async(path: str, default: Any = None) -> Any:
+    """在线程中执行 read_json"""
+    return await asyncio.to_thread(read_json, path, default)
+
+class FileLock:
+    """
+    基于锁文件的跨进程读写锁
+
+    多个读者可同时持有读锁，写锁独占。锁作用于独立的 <路径>.lock 文件，
+    不影响目标文件本身的原子替换。同一进程内的不同 FileLock 实例之间同样互斥。
+    """
+
+    def __init__(self, path: str, timeout: Optional[float] = None, poll: float = 0.005):
+        """
+        参数:
+            path: 被保护的文件路径
+            timeout: 获取锁的超时时间（秒），默认使用 configure 设置的值
+            poll: 等待锁时的轮询间隔（秒）
+        """
+        self.lock_path = path + ".lock"
+        self._timeout = timeout
+        self.poll = poll
+
+    @property
+    def timeout(self) -> float:
+        return _lock_timeout if self._timeout is None else self._timeout
+
+    def read(self):
+        """读锁（共享）"""
+        return self._hold(fcntl.LOCK_SH)
+
+    def write(self):
+        """写锁（独占）"""
+        return self._hold(fcntl.LOCK_EX)
+
+    def async_read(self):
+        """读锁的异步版本，等待期间让出事件循环"""
+        return self._hold_async(fcntl.LOCK_SH)
+
+    def async_write(self):
+        """写锁的异步版本，等待期间让出事件循环"""
+        return self._hold_async(fcntl.LOCK_EX)
+
+    @contextlib.contextmanager
+    def _hold(self, operation: int) -> Iterator[None]:
+        f = open(self.lock_path, "a")
+        try:
+            deadline = time.monotonic() + self.timeout
+            while not self._try(f, operation):
+                if time.monotonic() >= deadline:
+                    raise LockTimeout(f"等待文件锁超时: {self.lock_path}")
+                time.sleep(self.poll)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        finally:
+            f.close()
+
+    @contextlib.asynccontextmanager
+    async def _hold_async(self, operation: int) -> AsyncIterator[None]:
+        f = open(self.lock_path, "a")
+        try:
+            deadline = time.monotonic() + self.timeout
+            while not self._try(f, operation):
+                if time.monotonic() >= deadline:
+                    raise LockTimeout(f"等待文件锁超时: {self.lock_path}")
+                await asyncio.sleep(self.poll)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        finally:
+            f.close()
+
+    @staticmethod
+    def _try(f, operation: int) -> bool:
+        try:
+            fcntl.flock(f, operation | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
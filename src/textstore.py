@@ -0,0 +1,340 @@
+import os
+import json
+import hashlib
+import threading
+from typing import Dict, List, Any, Optional, Tuple
+
+from .storage import FileLock, atomic_write, get_policy
+from .log import get_logger
+
+logger = get_logger("textstore")
+
+class _Compaction:
+    """分步压缩的进度"""
+
+    def __init__(self, path: str, live: List[Tuple[str, int, int]], data_marker: Optional[Tuple[int, int]]):
+        self.path = path
+        # 开始时存活的 (ID, 偏移, 长度)，以及已复制的条数
+        self.live = live
+        self.next = 0
+        # ID -> 在新数据文件中的偏移
+        self.offsets: Dict[str, int] = {}
+        self.size = 0
+        self.data_marker = data_marker
+
+class TextStore:
+    """
+    按内容寻址的文本存储
+
+    相同的文本只保存一份：以内容哈希为ID，正文追加写入 texts.dat，
+    texts.idx 为追加式日志，记录每个ID的偏移、长度与引用计数变化。
+    引用计数归零的文本在 compact 时回收。
+
+    compact 会原子替换两个文件，其他进程以日志文件的 (设备, inode) 判断是否已被替换，
+    替换后从头重新加载，不再使用旧的偏移与日志位置。
+
+    历史写入与保留期清理在工作线程中执行，与事件循环共用同一实例，内存中的状态
+    （entries、日志位置与文件标记）由线程锁保护；文件锁只负责进程之间的互斥。
+    需要两者时总是先取文件锁再取线程锁，线程锁只在内存操作与短小的文件读写期间持有，
+    等待文件锁的线程不会挡住事件循环上的读取。
+
+    日志格式（每行一条）:
+        A <id> <偏移> <长度>   新增文本，引用计数为 1
+        R <id> <增量>          引用计数变化
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.data_file = os.path.join(self.store_dir, "texts.dat")
+        self.index_file = os.path.join(self.store_dir, "texts.idx")
+        # 数据文件与日志共用一把锁
+        self._lock = FileLock(self.index_file)
+        # 保护内存状态的线程锁
+        self._mutex = threading.RLock()
+
+        # ID -> [偏移, 长度, 引用计数]
+        self.entries: Dict[str, List[int]] = {}
+        # 已重放到的日志位置，其他进程追加的日志可从此处继续读取
+        self._journal_pos = 0
+        # 已加载的日志文件与对应数据文件的 (设备, inode)，compact 替换文件后随之变化
+        self._marker: Optional[Tuple[int, int]] = None
+        self._data_marker: Optional[Tuple[int, int]] = None
+        # 进行中的分步压缩
+        self._compaction: Optional[_Compaction] = None
+        self._load()
+
+    def put(self, value: Any) -> str:
+        """
+        保存文本（可为任意可 JSON 序列化的值），返回其ID
+
+        文本已存在时只增加引用计数。
+        """
+        payload = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        text_id = hashlib.blake2b(payload, digest_size=8).hexdigest()
+
+        with self._lock.write(), self._mutex:
+            # 先补上其他进程的日志（必要时完整重新加载），再判断文本是否已存在
+            self._sync()
+            if text_id in self.entries:
+                self._append_journal(f"R {text_id} 1")
+                return text_id
+
+            with open(self.data_file, "ab") as f:
+                self._data_marker = self._file_id(f)
+                offset = f.seek(0, os.SEEK_END)
+                f.write(payload)
+            self._append_journal(f"A {text_id} {offset} {len(payload)}")
+        return text_id
+
+    def get(self, text_id: str) -> Optional[Any]:
+        """按ID读取文本，不存在时返回 None"""
+        try:
+            if self._replaced():
+                self._load()
+            entry, marker = self._lookup(text_id)
+            if entry is None:
+                # 可能由其他进程写入，重放新增的日志后再查一次
+                self._load()
+                entry, marker = self._lookup(text_id)
+            if entry is None:
+                return None
+            # 偏移与数据文件标记同时取得，打开的文件与标记一致时偏移一定有效
+            with open(self.data_file, "rb") as f:
+                if self._file_id(f) == marker:
+                    f.seek(entry[0])
+                    return json.loads(f.read(entry[1]).decode("utf-8"))
+
+            # 数据文件刚被 compact 替换，持有读锁重新加载后再读取
+            with self._lock.read(), self._mutex:
+                self._sync()
+                entry = self.entries.get(text_id)
+                if entry is None:
+                    return None
+                with open(self.data_file, "rb") as f:
+                    self._data_marker = self._file_id(f)
+                    f.seek(entry[0])
+                    return json.loads(f.read(entry[1]).decode("utf-8"))
+        except Exception as e:
+            logger.error("读取文本存储失败: %s", e)
+            return None
+
+    def _lookup(self, text_id: str) -> Tuple[Optional[Tuple[int, int]], Optional[Tuple[int, int]]]:
+        """取文本的 (偏移, 长度) 与当前数据文件标记"""
+        with self._mutex:
+            entry = self.entries.get(text_id)
+            return (None if entry is None else (entry[0], entry[1])), self._data_marker
+
+    def release(self, text_id: str):
+        """减少引用计数，引用记录被删除时调用"""
+        with self._mutex:
+            entry = self.entries.get(text_id)
+            if entry is None or entry[2] <= 0:
+                return
+        try:
+            with self._lock.write(), self._mutex:
+                # 取得文件锁期间可能已被其他线程释放
+                entry = self.entries.get(text_id)
+                if entry is not None and entry[2] > 0:
+                    self._append_journal(f"R {text_id} -1")
+        except Exception as e:
+            logger.error("写入文本索引失败: %s", e)
+
+    def garbage_ratio(self) -> float:
+        """已无引用的文本占数据文件的比例"""
+        with self._mutex:
+            entries = list(self.entries.values())
+        total = sum(entry[1] for entry in entries)
+        if total == 0:
+            return 0.0
+        dead = sum(entry[1] for entry in entries if entry[2] <= 0)
+        return dead / total
+
+    def compact(self) -> int:
+        """
+        回收无引用的文本，重写数据文件与日志
+
+        返回:
+            回收的字节数
+        """
+        reclaimed = None
+        while reclaimed is None:
+            reclaimed = self.compact_step()
+        return reclaimed
+
+    @property
+    def compacting(self) -> bool:
+        """是否有未完成的分步压缩"""
+        return self._compaction is not None
+
+    def compact_step(self, budget: Optional[int] = None) -> Optional[int]:
+        """
+        分步压缩：每次最多复制 budget 字节的存活文本到临时文件，不持有锁；
+        全部复制后在写锁内补上期间新增的文本，再替换数据文件与日志
+
+        复制只使用开始时取得的存活列表，期间其他线程可以正常读写；
+        同一时间只应有一个线程调用本方法。
+
+        参数:
+            budget: 本次最多复制的字节数，None 表示一次完成
+
+        返回:
+            完成时返回回收的字节数，尚未完成时返回 None
+        """
+        try:
+            state = self._compaction
+            if state is None:
+                with self._lock.read(), self._mutex:
+                    self._sync()
+                    if not self.entries:
+                        return 0
+                    live = [(text_id, entry[0], entry[1]) for text_id, entry in self.entries.items() if entry[2] > 0]
+                    state = _Compaction(self.data_file + ".compact", live, self._data_marker)
+                open(state.path, "wb").close()
+                self._compaction = state
+
+            # 数据文件只追加，开始时记下的偏移在替换前一直有效
+            with open(self.data_file, "rb") as src, open(state.path, "ab") as dst:
+                if self._file_id(src) != state.data_marker:
+                    raise RuntimeError("数据文件已被其他进程替换")
+                copied = 0
+                while state.next < len(state.live) and (budget is None or copied < budget):
+                    text_id, offset, length = state.live[state.next]
+                    src.seek(offset)
+                    dst.write(src.read(length))
+                    state.offsets[text_id] = state.size
+                    state.size += length
+                    copied += length
+                    state.next += 1
+            if state.next < len(state.live):
+                return None
+            return self._finish_compaction(state)
+        except Exception as e:
+            logger.error("压缩文本存储失败: %s", e)
+            self._abort_compaction()
+            return 0
+
+    def _finish_compaction(self, state: "_Compaction") -> int:
+        """在写锁内补上压缩期间新增的文本，并替换数据文件与日志"""
+        policy = get_policy()
+        with self._lock.write(), self._mutex:
+            # 以包含其他进程日志的最新引用计数为准
+            self._sync()
+            if self._data_marker != state.data_marker:
+                raise RuntimeError("数据文件已被其他进程替换")
+            total = sum(entry[1] for entry in self.entries.values())
+
+            new_entries: Dict[str, List[int]] = {}
+            index = []
+            with open(self.data_file, "rb") as src, open(state.path, "ab") as dst:
+                for text_id, (offset, length, refs) in self.entries.items():
+                    if refs <= 0:
+                        continue
+                    new_offset = state.offsets.get(text_id)
+                    if new_offset is None:
+                        # 开始压缩之后才写入或重新被引用的文本
+                        src.seek(offset)
+                        dst.write(src.read(length))
+                        new_offset = state.size
+                        state.size += length
+                    new_entries[text_id] = [new_offset, length, refs]
+                    index.append(f"A {text_id} {new_offset} {length}\n")
+                    if refs != 1:
+                        index.append(f"R {text_id} {refs - 1}\n")
+                dst.flush()
+                policy.after_write(dst.fileno(), self.data_file)
+
+            journal = "".join(index).encode("utf-8")
+            os.replace(state.path, self.data_file)
+            policy.after_replace(self.data_file)
+            atomic_write(self.index_file, journal)
+            self.entries = new_entries
+            self._journal_pos = len(journal)
+            self._marker = self._path_id(self.index_file)
+            self._data_marker = self._path_id(self.data_file)
+            # 释放线程锁后 new_entries 即可能被其他线程修改，回收量在锁内算出
+            reclaimed = total - sum(entry[1] for entry in new_entries.values())
+        self._compaction = None
+        return reclaimed
+
+    def _abort_compaction(self):
+        """放弃未完成的压缩，删除临时文件"""
+        state, self._compaction = self._compaction, None
+        if state is not None:
+            try:
+                os.remove(state.path)
+            except FileNotFoundError:
+                pass
+
+    def __len__(self) -> int:
+        with self._mutex:
+            return len(self.entries)
+
+    def _append_journal(self, line: str):
+        """持有写锁时追加日志，写入前先补上其他进程追加的日志，保持读取位置连续"""
+        record = (line + "\n").encode("utf-8")
+        with open(self.index_file, "a+b") as f:
+            self._follow(f)
+            f.write(record)
+        self._replay(record)
+
+    def _load(self):
+        """从上次的位置继续重放索引日志，日志文件已被替换时从头加载"""
+        try:
+            with self._lock.read(), self._mutex:
+                self._sync()
+        except Exception as e:
+            logger.error("加载文本索引失败: %s", e)
+
+    def _sync(self):
+        """持有锁时重放其他进程追加的日志"""
+        try:
+            f = open(self.index_file, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            self._follow(f)
+
+    def _replaced(self) -> bool:
+        """日志文件是否已被其他进程的 compact 替换"""
+        try:
+            st = os.stat(self.index_file)
+        except FileNotFoundError:
+            return False
+        return (st.st_dev, st.st_ino) != self._marker
+
+    def _follow(self, f):
+        """持有锁时从已打开的日志文件重放新增部分；文件已不是上次加载的那个时清空后从头重放"""
+        st = os.fstat(f.fileno())
+        marker = (st.st_dev, st.st_ino)
+        if marker != self._marker or st.st_size < self._journal_pos:
+            self.entries = {}
+            self._journal_pos = 0
+            self._marker = marker
+            self._data_marker = self._path_id(self.data_file)
+        f.seek(self._journal_pos)
+        self._replay(f.read())
+
+    @staticmethod
+    def _file_id(f) -> Tuple[int, int]:
+        st = os.fstat(f.fileno())
+        return st.st_dev, st.st_ino
+
+    @staticmethod
+    def _path_id(path: str) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_dev, st.st_ino
+
+    def _replay(self, data: bytes):
+        """重放一段日志，只处理完整的行"""
+        end = data.rfind(b"\n") + 1
+        self._journal_pos += end
+        for line in data[:end].decode("utf-8").splitlines():
+            parts = line.split()
+            if len(parts) == 4 and parts[0] == "A":
+                self.entries[parts[1]] = [int(parts[2]), int(parts[3]), 1]
+            elif len(parts) == 3 and parts[0] == "R" and parts[1] in self.entries:
+                self.entries[parts[1]][2] += int(parts[2])
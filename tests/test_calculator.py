@@ -0,0 +1,103 @@
+import asyncio
+import random
+import time
+
+from src.calculator import HexagramCalculator
+
+def _draw(calc, user_id, count=5):
+    return [asyncio.run(calc._random_hexagram(user_id)) for _ in range(count)]
+
+def test_seeded_random_readings_are_reproducible_per_user():
+    config = {"calculator": {"seed": "test"}}
+    first, second = HexagramCalculator(config), HexagramCalculator(config)
+
+    assert _draw(first, "alice") == _draw(second, "alice")
+    # 各用户的序列互不影响
+    _draw(first, "bob")
+    assert _draw(first, "alice") == _draw(second, "alice")
+    assert _draw(first, "carol") != _draw(second, "dave")
+
+def test_seeded_random_sources_are_bounded():
+    calc = HexagramCalculator({"calculator": {"seed": "test"}})
+    calc.SEEDED_USERS = 4
+    expected = _draw(HexagramCalculator({"calculator": {"seed": "test"}}), "u0", 1)
+
+    for i in range(10):
+        _draw(calc, f"u{i}", 1)
+    assert list(calc._user_rngs) == ["u6", "u7", "u8", "u9"]
+    # 被淘汰的用户从种子重新开始
+    assert _draw(calc, "u0", 1) == expected
+
+def test_yarrow_mode_line_probabilities():
+    calc = HexagramCalculator({"calculator": {"random_mode": "yarrow"}}, rng=random.Random(1))
+    counts = {(1, 1): 0, (1, 0): 0, (0, 0): 0, (0, 1): 0}
+    for result in _draw(calc, None, 4000):
+        for line, moving in zip(result["original"], result["moving"]):
+            counts[(line, moving)] += 1
+    total = sum(counts.values())
+    # 6/7/8/9 = 1:5:7:3
+    for key, expected in (((0, 1), 1), ((1, 0), 5), ((0, 0), 7), ((1, 1), 3)):
+        assert abs(counts[key] / total - expected / 16) < 0.02
+
+def _randint_reading(rng):
+    """改为查表之前的掷币实现，作为基准"""
+    original, moving = [], []
+    for _ in range(6):
+        coins = [rng.randint(0, 1) for _ in range(3)]
+        total = sum(coins)
+        if total == 3:
+            original.append(1)
+            moving.append(1)
+        elif total == 0:
+            original.append(0)
+            moving.append(1)
+        else:
+            original.append(1 if total == 2 else 0)
+            moving.append(0)
+    return {"original": original, "moving": moving}
+
+def test_table_draw_is_faster_than_randint():
+    rng = random.Random(1)
+    calc = HexagramCalculator(rng=rng)
+    rounds = 5000
+
+    async def table():
+        for _ in range(rounds):
+            await calc._random_hexagram()
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        _randint_reading(rng)
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    asyncio.run(table())
+    current = time.perf_counter() - start
+
+    assert current < legacy
+
+def test_text_golden_vectors():
+    calc = HexagramCalculator()
+    assert calc.verify_text_compatibility()
+    for text, original, moving, original_number, changed_number in calc.TEXT_GOLDEN_VECTORS:
+        result = asyncio.run(calc.calculate("text", text, "alice"))
+        assert result["original"] == list(calc._MASK_LINES[original])
+        assert result["moving"] == list(calc._MASK_LINES[moving])
+        assert (result["hexagram_original"], result["hexagram_changed"]) == (original_number, changed_number)
+
+def test_text_golden_vectors_ignore_hash_and_cache_settings():
+    # 兼容性向量固定按 SHA256 计算，缓存命中时结果不变
+    calc = HexagramCalculator({"calculator": {"text_hash": "blake2b", "text_cache_size": 2}})
+    assert calc.verify_text_compatibility()
+    text, original, moving = calc.TEXT_GOLDEN_VECTORS[0][:3]
+    plain = HexagramCalculator()
+    for _ in range(2):
+        result = asyncio.run(plain._text_hexagram(text))
+        assert result == {"original": list(plain._MASK_LINES[original]),
+                          "moving": list(plain._MASK_LINES[moving])}
+
+def test_text_normalisation_maps_trivial_variants_together():
+    calc = HexagramCalculator({"calculator": {"text_normalize": ["mentions", "punctuation", "whitespace"]}})
+    base = asyncio.run(calc._text_hexagram("明天 财运"))
+    for variant in ("@bot 明天   财运", "明天 财运！", "  明天\t财运 "):
+        assert asyncio.run(calc._text_hexagram(variant)) == base
@@ -0,0 +1,121 @@
+import os
+import signal
+import asyncio
+import multiprocessing
+
+from src.coordinator import LLMCache, SharedState
+from src.history import HistoryManager
+from src.limit import UsageLimit
+from src.search import HistoryIndex
+
+CONFIG = {"limit": {"daily_max": 100000}}
+HEXAGRAM = {"original": [1] * 6, "moving": [1, 0, 0, 0, 0, 0], "changed": [0, 1, 1, 1, 1, 1],
+            "hexagram_original": 1, "hexagram_changed": 44}
+INTERPRETATION = {"fortune": "平"}
+
+def _shared_state(base):
+    index = HistoryIndex(os.path.join(base, "index"))
+    # 降低阈值，让两个进程在运行中都会合并索引快照
+    index.COMPACT_THRESHOLD = 25
+    history = HistoryManager(os.path.join(base, "history"), index=index, max_records=1000,
+                             validate_cache=True)
+    limit = UsageLimit(CONFIG, os.path.join(base, "limits"))
+    return SharedState(limit, history, LLMCache(), search_index=index,
+                       socket_path=os.path.join(base, "coordinator.sock"), timeout=0.5, retry_interval=1)
+
+async def _run_worker(base, name, rounds, events):
+    shared = await _start(base)
+    events.put((name, "mode", shared.mode))
+    done = 0
+    while rounds is None or done < rounds:
+        await shared.update_usage(name)
+        await shared.save_record(name, f"{name}问题{done}", HEXAGRAM, INTERPRETATION)
+        done += 1
+        events.put((name, "done", done))
+        await asyncio.sleep(0.02)
+    events.put((name, "finished", shared.mode))
+    await shared.close()
+
+async def _start(base):
+    shared = _shared_state(base)
+    await shared.start()
+    return shared
+
+def _worker(base, name, rounds, events):
+    asyncio.run(_run_worker(base, name, rounds, events))
+
+def _wait_for(events, predicate, progress, timeout=30):
+    """读取事件直到满足条件，途中记录各进程已完成的轮数"""
+    while True:
+        event = events.get(timeout=timeout)
+        if event[1] == "done":
+            progress[event[0]] = event[2]
+        if predicate(event):
+            return event
+
+def test_workers_stay_consistent_when_the_coordinator_dies(tmp_path):
+    base = str(tmp_path)
+    context = multiprocessing.get_context("fork")
+    events = context.Queue()
+    progress = {"owner": 0, "worker": 0}
+
+    # 第一个进程成为协调进程，持续写入直到被杀死
+    owner = context.Process(target=_worker, args=(base, "owner", None, events))
+    owner.start()
+    assert _wait_for(events, lambda e: e[1] == "mode", progress) == ("owner", "mode", "server")
+
+    rounds = 150
+    worker = context.Process(target=_worker, args=(base, "worker", rounds, events))
+    worker.start()
+    try:
+        assert _wait_for(events, lambda e: e[0] == "worker" and e[1] == "mode", progress)[2] == "client"
+
+        # 第二个进程写到三分之一时杀死协调进程
+        _wait_for(events, lambda e: e == ("worker", "done", rounds // 3), progress)
+        os.kill(owner.pid, signal.SIGKILL)
+        owner.join()
+        finished = _wait_for(events, lambda e: e[1] == "finished", progress, timeout=60)
+        worker.join(timeout=30)
+    finally:
+        for process in (owner, worker):
+            if process.is_alive():
+                process.kill()
+
+    # 协调进程退出后第二个进程切换为本地模式，随后重新选举为协调进程
+    assert finished == ("worker", "finished", "server")
+
+    # 请求在协调进程处理后、响应前被杀死时会在本地重试一次，因此最多多计一次
+    limit = UsageLimit(CONFIG, os.path.join(base, "limits"))
+    assert rounds <= limit._count("worker") <= rounds + 1
+    owner_done = progress["owner"]
+    assert owner_done <= limit._count("owner") <= owner_done + 1
+
+    history = HistoryManager(os.path.join(base, "history"), max_records=1000)
+    worker_rows = history.load_rows("worker")
+    owner_rows = history.load_rows("owner")
+    assert rounds <= len(worker_rows) <= rounds + 1
+    assert owner_done <= len(owner_rows) <= owner_done + 1
+
+    # 接管的进程合并索引快照时保留了上一个协调进程写入的记录
+    index = HistoryIndex(os.path.join(base, "index"))
+    assert len(index.search("worker问题", user_id="worker", limit=1000)) == len(worker_rows)
+    assert len(index.search("owner问题", user_id="owner", limit=1000)) == len(owner_rows)
+    assert len(index) == len(worker_rows) + len(owner_rows)
+
+def test_local_mode_reads_do_not_rewrite_usage(tmp_path):
+    base = str(tmp_path)
+    shared = _shared_state(base)
+    # 未调用 start，处于本地文件模式
+    assert shared.mode == "local"
+
+    async def run():
+        await shared.update_usage("alice")
+        stat = os.stat(shared.limit.limit_file)
+        assert await shared.check_user_limit("alice")
+        assert await shared.get_remaining("alice") == CONFIG["limit"]["daily_max"] - 1
+        assert (await shared.get_usage_statistics())["total_usage"] == 1
+        return stat
+
+    before = asyncio.run(run())
+    after = os.stat(shared.limit.limit_file)
+    assert (after.st_ino, after.st_mtime_ns) == (before.st_ino, before.st_mtime_ns)
@@ -0,0 +1,27 @@
+import asyncio
+import time
+
+from src.group import GroupReadingPool
+from src.history import HistoryManager
+
+HEXAGRAM = {"original": [1] * 6, "moving": [0] * 6, "changed": [1] * 6,
+            "hexagram_original": 1, "hexagram_changed": 1}
+INTERPRETATION = {"fortune": "吉"}
+
+def test_pooled_records_keep_the_reading_time(tmp_path):
+    history = HistoryManager(str(tmp_path / "history"))
+    pool = GroupReadingPool(window=60, flush_delay=60)
+    pool.set_writer(history.save_records)
+
+    async def run():
+        pool.record("alice", "问题", HEXAGRAM, INTERPRETATION, 1_700_000_000)
+        pool.record("bob", "问题", HEXAGRAM, INTERPRETATION)
+        recorded = time.time()
+        # 写入晚于起卦时，记录仍使用登记时的时间
+        await asyncio.sleep(1.1)
+        assert pool.flush() == 2
+        return recorded
+
+    recorded = asyncio.run(run())
+    assert history.load_rows("alice")[0][0] == 1_700_000_000
+    assert abs(history.load_rows("bob")[0][0] - recorded) < 1
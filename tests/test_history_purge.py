@@ -0,0 +1,61 @@
+import os
+import time
+
+from src.history import HistoryManager
+from src.record import CompactRecord
+from src.retention import HistoryArchive, RetentionSweeper
+from src.search import HistoryIndex
+from src.similar import reading_code
+
+def _setup(tmp_path):
+    index = HistoryIndex(str(tmp_path / "index"))
+    history = HistoryManager(str(tmp_path / "history"), index=index, max_records=20)
+    return index, history
+
+def _record(ts, question):
+    # 乾初爻动，变为姤
+    return CompactRecord(int(ts), question, 1, 44, 1)
+
+def test_expired_records_are_purged_from_search(tmp_path):
+    index, history = _setup(tmp_path)
+    now = time.time()
+    history.save_compact([
+        ("alice", _record(now - 10 * 86400, "投资旧问题")),
+        ("alice", _record(now - 60, "投资新问题")),
+    ])
+    assert len(index.search("投资", user_id="alice")) == 2
+
+    sweeper = RetentionSweeper(history, HistoryArchive(str(tmp_path / "archive")),
+                               expire_days=7, archive_after_days=0)
+    assert sweeper.tick() == 1
+
+    assert [m["question"] for m in index.search("投资")] == ["投资新问题"]
+    assert len(index.similar(reading_code(1, 44), distance=0)) == 1
+
+    # 删除记录写入日志，重新加载后仍然生效
+    reloaded = HistoryIndex(str(tmp_path / "index"))
+    assert [m["question"] for m in reloaded.search("投资")] == ["投资新问题"]
+
+def test_cleared_user_is_purged_from_search(tmp_path):
+    index, history = _setup(tmp_path)
+    now = time.time()
+    history.save_compact([
+        ("alice", _record(now - 120, "婚姻运势")),
+        ("alice", _record(now - 60, "婚姻何时")),
+        ("bob", _record(now - 30, "婚姻如何")),
+    ])
+    assert len(index.search("婚姻")) == 3
+
+    assert history.clear_history("alice")
+    assert not os.path.exists(tmp_path / "history" / "alice.json")
+
+    assert [m["user_id"] for m in index.search("婚姻")] == ["bob"]
+    assert index.search("婚姻", user_id="alice") == []
+    assert "#ualice" not in index.postings
+    assert [m["user_id"] for m in index.similar(reading_code(1, 44), distance=0)] == ["bob"]
+
+    # 合并快照后被清除的用户不再出现
+    index.compact()
+    reloaded = HistoryIndex(str(tmp_path / "index"))
+    assert len(reloaded) == 1
+    assert [m["user_id"] for m in reloaded.search("婚姻")] == ["bob"]
@@ -0,0 +1,136 @@
+import sys
+import asyncio
+
+from src.interpreter import HexagramInterpreter
+from src.pregen import PregenStore, Pregenerator, combinations
+from src.scheduler import RequestScheduler
+
+GENERIC = {"overall_meaning": "通用解读", "fortune": "吉", "advice": "通用建议"}
+
+class _Response:
+    def __init__(self, text):
+        self.completion_text = text
+
+class _FakeProvider:
+    """记录调用次数的假模型，固定返回三段式回复"""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def text_chat(self, **kwargs):
+        self.calls += 1
+        return _Response("针对问题的解读\n\n吉凶：凶\n\n针对问题的建议")
+
+class _FakeContext:
+    def __init__(self):
+        self.provider = _FakeProvider()
+
+    def get_using_provider(self):
+        return self.provider
+
+def _interpreter(tmp_path, pregen):
+    interpreter = HexagramInterpreter({}, base_dir=str(tmp_path))
+    interpreter.pregen = pregen
+    return interpreter
+
+def test_saturated_pool_serves_pregenerated_text_without_queueing(tmp_path):
+    pregen = PregenStore(str(tmp_path / "pregen"))
+    pregen.put(1, 0, GENERIC)
+    interpreter = _interpreter(tmp_path, pregen)
+    interpreter.scheduler = RequestScheduler(workers=1, max_pending=3)
+    context = _FakeContext()
+
+    async def run():
+        release = asyncio.Event()
+        # 一个请求占住唯一的工作名额，另一个在排队，工作池已饱和
+        busy = [asyncio.create_task(interpreter.scheduler.run(user, release.wait)) for user in ("a", "b")]
+        await asyncio.sleep(0)
+        assert interpreter.scheduler.saturated()
+
+        saturated = await interpreter.interpret(1, 1, [0] * 6, "问题", True, context, user_id="c")
+        # 本卦没有预生成的解释时仍然排队调用模型
+        queued = asyncio.create_task(interpreter.interpret(2, 2, [0] * 6, "问题", True, context, user_id="c"))
+        await asyncio.sleep(0)
+        assert interpreter.scheduler.pending("c") == 1
+        release.set()
+        await asyncio.gather(*busy)
+        return saturated, await queued
+
+    saturated, queued = asyncio.run(run())
+    assert saturated["pregenerated"] and saturated["overall_meaning"] == "通用解读"
+    assert not queued["pregenerated"] and queued["overall_meaning"] == "针对问题的解读"
+    assert context.provider.calls == 1
+
+def test_cached_only_never_calls_the_provider(tmp_path):
+    pregen = PregenStore(str(tmp_path / "pregen"))
+    pregen.put(1, 0, GENERIC)
+    interpreter = _interpreter(tmp_path, pregen)
+    context = _FakeContext()
+
+    async def run():
+        stored = await interpreter.interpret(1, 1, [0] * 6, "问题", True, context, cached_only=True)
+        missing = await interpreter.interpret(2, 2, [0] * 6, "问题", True, context, cached_only=True)
+        return stored, missing
+
+    stored, missing = asyncio.run(run())
+    assert stored["pregenerated"] and stored["fortune"] == "吉"
+    # 没有预生成的解释时退回静态解释
+    assert not missing["pregenerated"] and not missing["llm_generated"]
+    assert context.provider.calls == 0
+
+def _generic(number, mask):
+    return {"overall_meaning": f"{number}-{mask}" * (1 + mask % 7), "fortune": "平", "advice": ""}
+
+def test_pregeneration_threads_and_loop_readers_see_consistent_slots(tmp_path):
+    store = PregenStore(str(tmp_path / "pregen"))
+    # 另一个实例模拟其他进程，通过索引文件的变化重新加载
+    other = PregenStore(str(tmp_path / "pregen"))
+    combos = combinations(1)
+    errors = []
+
+    async def generate(number, mask):
+        await asyncio.sleep(0)
+        return _generic(number, mask)
+
+    async def read(reader, pregenerator):
+        # 写入在工作线程中进行，事件循环上的读取与之交错
+        while pregenerator.running:
+            for number, mask in combos[::7]:
+                value = reader.get(number, mask)
+                if value is not None and value != _generic(number, mask):
+                    errors.append((number, mask, value))
+            await asyncio.sleep(0)
+
+    async def run(limit=None):
+        pregenerator = Pregenerator(store, generate, concurrency=4)
+        pregenerator.start(combos)
+        readers = [asyncio.create_task(read(reader, pregenerator)) for reader in (store, other)]
+        if limit is not None:
+            while pregenerator.done < limit:
+                await asyncio.sleep(0.001)
+            await pregenerator.stop()
+        else:
+            await pregenerator._task
+        await asyncio.gather(*readers)
+        return pregenerator.status()
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        asyncio.run(run(limit=100))
+        # 停止时已在工作线程中的写入仍会完成，事件循环结束后再统计
+        stored = len(store)
+        # 中断后重新开始，只生成尚未写入的组合
+        second = asyncio.run(run())
+    finally:
+        sys.setswitchinterval(interval)
+        store.close()
+
+    assert errors == []
+    assert 100 <= stored < len(combos)
+    assert second["total"] == len(combos) - stored
+    assert second["failed"] == 0
+    assert len(store) == len(PregenStore(str(tmp_path / "pregen"))) == len(combos)
+    other.refresh()
+    assert all(other.get(number, mask) == _generic(number, mask) for number, mask in combos)
+    other.close()
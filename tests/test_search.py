@@ -0,0 +1,33 @@
+from src.search import HistoryIndex
+from src.similar import reading_code
+
+def _record(ts, question, original=1, changed=1, fortune="平"):
+    return {"timestamp": ts, "question": question, "hexagram_original": original,
+            "hexagram_changed": changed, "moving": [0] * 6, "fortune": fortune}
+
+def test_results_are_newest_first_after_rebuild(tmp_path):
+    index = HistoryIndex(str(tmp_path / "index"))
+    # 重建时按用户文件顺序编号，编号与时间先后不一致
+    index.rebuild([
+        ("alice", _record(1000, "工作一")),
+        ("alice", _record(4000, "工作四")),
+        ("bob", _record(2000, "工作二")),
+        ("bob", _record(3000, "工作三")),
+    ])
+    expected = ["工作四", "工作三", "工作二", "工作一"]
+    assert [m["question"] for m in index.search("工作")] == expected
+    assert [m["question"] for m in index.search("工作", limit=2)] == expected[:2]
+    assert [m["question"] for m in index.similar(reading_code(1, 1), distance=0)] == expected
+
+def test_hexagram_names_also_match_question_text(tmp_path):
+    index = HistoryIndex(str(tmp_path / "index"))
+    index.add("alice", _record(1000, "家人身体如何"))
+    index.add("alice", _record(2000, "换工作", original=37))
+    index.add("alice", _record(3000, "能否升职"))
+
+    # 家人 是第 37 卦的简称，同时匹配卦序与问题文字
+    assert [m["question"] for m in index.search("家人")] == ["换工作", "家人身体如何"]
+    assert [m["question"] for m in index.search("升")] == ["能否升职"]
+    # 卦名与其他关键词仍按交集处理
+    assert [m["question"] for m in index.search("家人 身体")] == ["家人身体如何"]
+    assert index.search("吉") == []
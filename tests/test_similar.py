@@ -0,0 +1,76 @@
+import json
+
+from src.data_constants import HEXAGRAM_MAP, LEGACY_HEXAGRAM_MAP
+from src.history import HistoryManager
+from src.record import CompactRecord
+from src.search import HistoryIndex
+from src.similar import reading_code, record_code
+
+# 下卦乾、上卦坤，初爻动：修正前显示为 泰(11) 变 大畜(26)，修正后为 否(12) 变 无妄(25)
+LINES, MOVING = 0b111000, 0b000001
+CODE = LINES | MOVING << 6
+
+def test_legacy_rows_are_decoded_with_the_map_they_were_written_with():
+    legacy = (LEGACY_HEXAGRAM_MAP[LINES], LEGACY_HEXAGRAM_MAP[LINES ^ MOVING])
+    current = (HEXAGRAM_MAP[LINES], HEXAGRAM_MAP[LINES ^ MOVING])
+    assert legacy == (11, 26) and current == (12, 25)
+
+    # 按当前映射直接换算旧记录的卦序会得到另一组爻象
+    assert reading_code(*legacy) != CODE
+    assert record_code(*legacy, MOVING) == CODE
+    assert record_code(*current, MOVING) == CODE == reading_code(*current)
+    # 保存了本卦六爻的记录直接使用
+    assert record_code(0, 0, MOVING, LINES) == CODE
+
+def test_ambiguous_legacy_rows_are_left_out():
+    # 旧映射下 坤(2) 对应两种爻象，无动爻时无法区分
+    assert [b for b in range(64) if LEGACY_HEXAGRAM_MAP[b] == 2] == [0b000000, 0b100111]
+    assert record_code(2, 2, 0) is None
+    # 与卦序矛盾的动爻
+    assert record_code(1, 1, MOVING) is None
+
+def test_new_records_keep_their_lines():
+    hexagram = {"original": [(LINES >> i) & 1 for i in range(6)], "moving": [1, 0, 0, 0, 0, 0],
+                "hexagram_original": 12, "hexagram_changed": 25}
+    record = CompactRecord.from_reading("问题", hexagram, {"fortune": "吉"}, ts=1_700_000_000)
+    assert record.lines == LINES
+    assert CompactRecord.from_row(json.loads(json.dumps(record.to_row()))).lines == LINES
+    assert record.to_dict()["original"] == hexagram["original"]
+
+def test_index_buckets_legacy_rows_by_their_cast_lines(tmp_path):
+    history_dir = tmp_path / "history"
+    history_dir.mkdir()
+    # 修正前写入的字典格式与紧凑格式记录，只有卦序与动爻
+    (history_dir / "alice.json").write_text(json.dumps([
+        {"timestamp": "2024-01-01 08:00:00", "question": "旧字典", "hexagram_original": 11,
+         "hexagram_changed": 26, "moving": [1, 0, 0, 0, 0, 0], "result_summary": "", "interpretation_summary": ""},
+        [1_704_100_000, "旧紧凑", 11, 26, MOVING, 0],
+        [1_704_200_000, "无法确定", 2, 2, 0, 0],
+    ], ensure_ascii=False), encoding="utf-8")
+    history = HistoryManager(str(history_dir))
+
+    index_dir = str(tmp_path / "index")
+    index = HistoryIndex(index_dir)
+    index.rebuild(history.iter_records())
+    assert {m["question"] for m in index.similar(CODE, distance=0)} == {"旧字典", "旧紧凑"}
+    assert index.similar(reading_code(11, 26), distance=0) == []
+    assert sum(len(bucket) for bucket in index.buckets) == 2
+
+def test_snapshots_without_codes_are_marked_for_rebuild(tmp_path):
+    index_dir = tmp_path / "index"
+    index_dir.mkdir()
+    # 旧版本的快照，文档中没有起卦编码
+    (index_dir / "index.json").write_text(json.dumps({
+        "docs": [["alice", 1_704_100_000, "旧", 11, 26, "平"]],
+        "postings": {"#ualice": [0], "旧": [0]},
+    }, ensure_ascii=False), encoding="utf-8")
+    index = HistoryIndex(str(index_dir))
+    assert index.outdated
+    assert len(index.search("旧")) == 1
+    assert index.similar(reading_code(11, 26), distance=0) == []
+
+    index.rebuild([("alice", {"timestamp": 1_704_100_000, "question": "旧", "hexagram_original": 11,
+                              "hexagram_changed": 26, "moving": [1, 0, 0, 0, 0, 0]})])
+    assert not index.outdated
+    assert not HistoryIndex(str(index_dir)).outdated
+    assert len(HistoryIndex(str(index_dir)).similar(CODE, distance=0)) == 1
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import signal
+import asyncio
+import multiprocessing
+
+import pytest
+
+from src import storage
+from src.storage import FileLock, FsyncPolicy, LockTimeout, atomic_write_json, read_json
+
+def _rewrite_forever(path):
+    # 每次写入不同长度的内容，截断或写了一半的文件都无法解析
+    for i in range(10 ** 9):
+        atomic_write_json(path, {"round": i, "payload": "卦" * (i % 500)}, FsyncPolicy("never"))
+
+def test_readers_never_see_a_partial_file_when_the_writer_is_killed(tmp_path):
+    path = str(tmp_path / "state.json")
+    atomic_write_json(path, {"round": -1, "payload": ""})
+    context = multiprocessing.get_context("fork")
+    writer = context.Process(target=_rewrite_forever, args=(path,))
+    writer.start()
+    try:
+        rounds = set()
+        deadline = time.monotonic() + 0.5
+        while time.monotonic() < deadline:
+            value = read_json(path)
+            assert len(value["payload"]) == max(value["round"], 0) % 500
+            rounds.add(value["round"])
+        # 写入途中杀死写入进程
+        os.kill(writer.pid, signal.SIGKILL)
+        writer.join()
+    finally:
+        if writer.is_alive():
+            writer.kill()
+    assert len(rounds) > 1
+
+    # 目标文件仍是最后一次完整写入的内容，残留的只有临时文件
+    value = read_json(path)
+    assert len(value["payload"]) == max(value["round"], 0) % 500
+    assert all(name == "state.json" or name.endswith(".tmp") for name in os.listdir(tmp_path))
+
+def _increment(path, times):
+    lock = FileLock(path)
+    for _ in range(times):
+        with lock.write():
+            value = read_json(path, {"count": 0})
+            value["count"] += 1
+            atomic_write_json(path, value, FsyncPolicy("never"))
+
+def test_write_lock_serialises_read_modify_write_across_processes(tmp_path):
+    path = str(tmp_path / "counter.json")
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_increment, args=(path, 200)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=60)
+        assert worker.exitcode == 0
+    assert read_json(path) == {"count": 800}
+
+def test_lock_wait_times_out(tmp_path):
+    path = str(tmp_path / "data.json")
+    with FileLock(path).read():
+        # 读锁可以共享，写锁需等待
+        with FileLock(path, timeout=0.1).read():
+            pass
+        started = time.monotonic()
+        with pytest.raises(LockTimeout):
+            with FileLock(path, timeout=0.1).write():
+                pass
+        assert time.monotonic() - started >= 0.1
+
+def test_async_lock_wait_keeps_the_event_loop_running(tmp_path):
+    path = str(tmp_path / "data.json")
+
+    async def run():
+        ticks = 0
+        stop = asyncio.Event()
+
+        async def ticker():
+            nonlocal ticks
+            while not stop.is_set():
+                ticks += 1
+                await asyncio.sleep(0.005)
+
+        task = asyncio.create_task(ticker())
+        # 工作线程持有写锁 0.3 秒，事件循环上的等待期间其他协程照常运行
+        holding = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        def hold():
+            with FileLock(path).write():
+                loop.call_soon_threadsafe(holding.set)
+                time.sleep(0.3)
+
+        holder = asyncio.create_task(asyncio.to_thread(hold))
+        await holding.wait()
+        before = ticks
+        async with FileLock(path).async_write():
+            waited = ticks - before
+        await holder
+        stop.set()
+        await task
+        return waited
+
+    assert asyncio.run(run()) >= 10
+
+def _count_fsyncs(monkeypatch):
+    calls = []
+    real_fsync = os.fsync
+    monkeypatch.setattr(storage.os, "fsync", lambda fd: (calls.append(fd), real_fsync(fd)))
+    return calls
+
+@pytest.mark.parametrize("mode", storage.FSYNC_MODES)
+def test_fsync_policies(tmp_path, monkeypatch, mode):
+    calls = _count_fsyncs(monkeypatch)
+    # 间隔足够长，interval 模式在测试期间不会自动落盘
+    policy = FsyncPolicy(mode, interval=3600)
+    paths = [str(tmp_path / f"{i % 5}.json") for i in range(50)]
+
+    started = time.perf_counter()
+    for i, path in enumerate(paths):
+        atomic_write_json(path, {"i": i}, policy)
+    elapsed = time.perf_counter() - started
+    written = len(calls)
+    policy.sync()
+
+    # always 每次写入同步文件与目录；interval 只在 sync 时按文件与目录各同步一次
+    expected = {"always": (100, 100), "interval": (0, 6), "never": (0, 0)}[mode]
+    assert (written, len(calls)) == expected
+    assert all(json.loads(open(path).read()) == {"i": 45 + i} for i, path in enumerate(paths[:5]))
+    print(f"{mode}: {len(paths) / elapsed:.0f} 次写入/秒")
@@ -0,0 +1,58 @@
+import sys
+import threading
+
+from src.textstore import TextStore
+
+def _refs(store):
+    return {text_id: entry[2] for text_id, entry in store.entries.items() if entry[2] > 0}
+
+def test_compaction_in_a_thread_keeps_store_consistent(tmp_path, caplog):
+    path = str(tmp_path / "texts")
+    store = TextStore(path)
+    # 另一个实例模拟其他进程，其追加的日志由 store 在读取与压缩时重放
+    other = TextStore(path)
+    keep = [store.put([f"解释{i}" * 50, f"建议{i}"]) for i in range(100)]
+
+    errors = []
+    stop = threading.Event()
+
+    def compact():
+        # 与保留期清理相同：在线程中分小步压缩
+        try:
+            while not stop.is_set():
+                while store.compact_step(budget=4096) is None:
+                    pass
+        except Exception as e:
+            errors.append(e)
+
+    # 缩短线程切换间隔，让两个线程频繁交错
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    worker = threading.Thread(target=compact)
+    worker.start()
+    try:
+        for round in range(300):
+            other.release(other.put([f"过期{round}" * 50, ""]))
+            other.put([f"新增{round}", ""])
+            for i in range(0, len(keep), 10):
+                if store.get(keep[i]) != [f"解释{i}" * 50, f"建议{i}"]:
+                    errors.append((round, i))
+            # 其他进程新写入的文本，读取时重放日志，引用计数应为 1
+            text_id = other.put([f"新增{round}", round])
+            store.get(text_id)
+            with store._mutex:
+                if store.entries[text_id][2] != 1:
+                    errors.append((round, list(store.entries[text_id])))
+            store.garbage_ratio()
+    finally:
+        stop.set()
+        worker.join()
+        sys.setswitchinterval(interval)
+
+    assert errors == []
+    # 压缩出错时只记录日志并放弃本轮
+    assert not [r for r in caplog.records if r.levelname == "ERROR"]
+    store.compact()
+    # 内存中的引用计数与从文件重新加载的一致，没有重复重放日志
+    assert _refs(store) == _refs(TextStore(path))
+    assert all(_refs(store)[text_id] == 1 for text_id in keep)